@@ -0,0 +1,128 @@
+"""
+Runs the benchmarks and compares the results with the baseline.
+
+Usage::
+
+    python -m benchmarks [--save-baseline [--save-times]] [--baseline PATH]
+                         [--time-tolerance FRACTION]
+
+Exits with a non-zero status if any benchmark has regressed compared with the baseline, or
+if there is no baseline for a benchmark.
+"""
+
+import argparse
+import fnmatch
+import os
+import sys
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog = 'python -m benchmarks')
+    parser.add_argument(
+        'patterns',
+        nargs = '*',
+        help = 'Only run the benchmarks whose names match these glob patterns.'
+    )
+    parser.add_argument(
+        '--baseline',
+        default = DEFAULT_BASELINE,
+        help = 'The file containing the baseline results.'
+    )
+    parser.add_argument(
+        '--save-baseline',
+        action = 'store_true',
+        help = 'Save the results as the new baseline instead of comparing with it.'
+    )
+    parser.add_argument(
+        '--save-times',
+        action = 'store_true',
+        help = (
+            'Include the timings in the saved baseline. Timings depend on the machine, so '
+            'this should not be used for the committed baseline.'
+        )
+    )
+    parser.add_argument(
+        '--time-tolerance',
+        type = float,
+        default = 0.5,
+        help = 'The fraction by which a timing may exceed the baseline before it fails.'
+    )
+    parser.add_argument(
+        '--number',
+        type = int,
+        default = 1000,
+        help = 'The number of calls in each timing.'
+    )
+    parser.add_argument(
+        '--repeat',
+        type = int,
+        default = 5,
+        help = 'The number of timings to take for each benchmark.'
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity = 0, interactive = False)
+
+    from . import harness, scenarios
+
+    names = [
+        name
+        for name in harness.registry
+        if not args.patterns or any(fnmatch.fnmatch(name, p) for p in args.patterns)
+    ]
+    baseline = None if args.save_baseline else harness.load_baseline(args.baseline)
+    if not args.save_baseline and baseline is None:
+        print('No baseline found at {} - run with --save-baseline to create one.'.format(
+            args.baseline
+        ))
+        return 1
+    results = {}
+    failed = False
+    width = max(len(name) for name in names)
+    for name in names:
+        result = harness.run(name, args.number, args.repeat)
+        results[name] = result if args.save_times else dict(queries = result['queries'])
+        line = '{}  {:>10.1f}us  {:>3} queries'.format(
+            name.ljust(width),
+            result['time_us'],
+            result['queries']
+        )
+        if baseline is not None:
+            if name in baseline:
+                regressions = harness.compare(result, baseline[name], args.time_tolerance)
+                if regressions:
+                    failed = True
+                    line += '  REGRESSED: ' + ', '.join(regressions)
+                elif 'time_us' in baseline[name]:
+                    line += '  ok ({:+.0%})'.format(
+                        result['time_us'] / baseline[name]['time_us'] - 1
+                    )
+                else:
+                    line += '  ok'
+            else:
+                # New benchmarks must be added to the baseline
+                failed = True
+                line += '  NO BASELINE'
+        print(line)
+    if args.save_baseline:
+        # Keep the baseline for any benchmarks that were not run
+        saved = dict(harness.load_baseline(args.baseline) or {}, **results)
+        harness.save_baseline(args.baseline, saved)
+        print('Saved baseline to {}.'.format(args.baseline))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,13 @@
+"""
+URLconf for the load harness that uses the async login views.
+"""
+
+from django.urls import include, path
+
+from .urls import urlpatterns as sync_urlpatterns
+
+
+urlpatterns = [
+    path('auth/', include('jasmin_auth.async_urls')) if str(pattern.pattern) == 'auth/' else pattern
+    for pattern in sync_urlpatterns
+]
@@ -0,0 +1,111 @@
+"""
+Utilities for timing the benchmarks and comparing the results with a baseline.
+"""
+
+import json
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+#: The registered benchmarks, in the order they were registered
+registry = {}
+
+
+def benchmark(name):
+    """
+    Decorator that registers a benchmark.
+
+    The decorated function performs any setup and returns a callable that makes a single
+    call to the code being measured. It may be a generator, in which case any code after
+    the yield is run as teardown once the benchmark is complete.
+    """
+    def decorator(func):
+        registry[name] = func
+        return func
+    return decorator
+
+
+def measure(func, number, repeat):
+    """
+    Returns a dictionary containing the time per call in microseconds and the number of
+    queries per call for the given callable.
+    """
+    # Make one call to warm up any caches and measure the queries for a warm call
+    func()
+    with CaptureQueriesContext(connection) as context:
+        func()
+    queries = len(context.captured_queries)
+    # Use the fastest repeat, as the slower ones are slowed down by other processes
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return dict(time_us = round(min(timings) * 1e6, 3), queries = queries)
+
+
+def run(name, number, repeat):
+    """
+    Runs the named benchmark and returns the result.
+    """
+    setup = registry[name]()
+    # Generator-based benchmarks yield the callable and tear down when resumed
+    if hasattr(setup, '__next__'):
+        func = next(setup)
+        try:
+            return measure(func, number, repeat)
+        finally:
+            next(setup, None)
+    else:
+        return measure(setup, number, repeat)
+
+
+def load_baseline(path):
+    """
+    Loads the baseline results from the given path, returning ``None`` if there are none.
+    """
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(path, results):
+    """
+    Saves the given results as the baseline.
+    """
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent = 2, sort_keys = True)
+        fh.write('\n')
+
+
+def compare(result, baseline, time_tolerance):
+    """
+    Compares a result with the baseline for the same benchmark and returns a list of
+    the regressions.
+
+    Any increase in the number of queries is a regression. Timings vary between runs,
+    so the time is only a regression if it exceeds the baseline by more than the
+    given fraction. Timings are only compared if the baseline includes them.
+    """
+    regressions = []
+    if result['queries'] > baseline['queries']:
+        regressions.append(
+            'queries {} > {}'.format(result['queries'], baseline['queries'])
+        )
+    if (
+        'time_us' in baseline and
+        result['time_us'] > baseline['time_us'] * (1 + time_tolerance)
+    ):
+        regressions.append(
+            'time {:.1f}us > {:.1f}us + {:.0%}'.format(
+                result['time_us'],
+                baseline['time_us'],
+                time_tolerance
+            )
+        )
+    return regressions
@@ -0,0 +1,169 @@
+"""
+Measures the cost of importing the package in a fresh worker using ``python -X importtime``.
+
+Usage::
+
+    python -m benchmarks.importtime [--budget MILLISECONDS] [--repeat N] [--top N]
+
+The child process sets up Django and imports the URLconfs and the middleware, as a worker
+does before serving its first request. The time attributed to the package is the cumulative
+import time of the ``jasmin_auth`` modules, including anything they import that was not
+already imported.
+
+Exits with a non-zero status if the time exceeds the budget or if the package imports any
+of the modules that should only be imported on first use, e.g. the OAuth stack.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+#: The code that is run in the child process
+CHILD_CODE = '; '.join([
+    'import django',
+    'django.setup()',
+    'import jasmin_auth.urls, jasmin_auth.async_urls, jasmin_auth.middleware',
+])
+
+#: The top-level packages that should not be imported until they are used
+LAZY_PACKAGES = {
+    'httpx',
+    'jwt',
+    'oauthlib',
+    'requests',
+    'requests_oauthlib',
+    'tsunami',
+    'urllib3',
+}
+
+#: The prefix of the lines written by -X importtime
+PREFIX = 'import time:'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog = 'python -m benchmarks.importtime')
+    parser.add_argument(
+        '--budget',
+        type = float,
+        default = 60,
+        help = 'The maximum import time in milliseconds that is attributed to the package.'
+    )
+    parser.add_argument(
+        '--repeat',
+        type = int,
+        default = 5,
+        help = 'The number of processes to measure - the fastest is reported.'
+    )
+    parser.add_argument(
+        '--top',
+        type = int,
+        default = 10,
+        help = 'The number of package modules to list, by cumulative import time.'
+    )
+    return parser.parse_args()
+
+
+def parse_importtime(output):
+    """
+    Parses the output of ``-X importtime`` and returns a list of
+    ``(module, depth, self_us, cumulative_us)`` tuples in the order they were written.
+
+    Modules are written after the modules they import, with deeper indentation for
+    nested imports.
+    """
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith(PREFIX):
+            continue
+        self_us, cumulative_us, name = line[len(PREFIX):].split('|', 2)
+        # The header line has no numbers
+        if not self_us.strip().isdigit():
+            continue
+        module = name.lstrip()
+        depth = (len(name) - len(module) - 1) // 2
+        entries.append((module, depth, int(self_us), int(cumulative_us)))
+    return entries
+
+
+def package_imports(entries):
+    """
+    Returns a tuple of ``(outermost, imported)`` where ``outermost`` is a list of
+    ``(module, cumulative_us)`` for the ``jasmin_auth`` modules that were not imported by
+    another ``jasmin_auth`` module and ``imported`` is the set of modules that were
+    imported by the package.
+    """
+    outermost = []
+    imported = set()
+    # Walking backwards visits each module before the modules it imported
+    inside = None
+    for module, depth, _, cumulative_us in reversed(entries):
+        if inside is not None and depth > inside:
+            imported.add(module)
+            continue
+        inside = None
+        if module == 'jasmin_auth' or module.startswith('jasmin_auth.'):
+            outermost.append((module, cumulative_us))
+            imported.add(module)
+            inside = depth
+    return outermost, imported
+
+
+def lazy_imports(entries):
+    """
+    Returns a sorted list of the packages in ``LAZY_PACKAGES`` that were imported by the
+    package.
+    """
+    _, imported = package_imports(entries)
+    return sorted({ module.split('.')[0] for module in imported } & LAZY_PACKAGES)
+
+
+def measure():
+    """
+    Runs the child process once and returns the parsed import times.
+    """
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD_CODE],
+        env = env,
+        capture_output = True,
+        text = True
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit('Failed to import the package.')
+    return parse_importtime(result.stderr)
+
+
+def main():
+    args = parse_args()
+    runs = [measure() for _ in range(args.repeat)]
+    totals = [sum(us for _, us in package_imports(entries)[0]) for entries in runs]
+    best = min(range(len(runs)), key = totals.__getitem__)
+    entries = runs[best]
+    total_ms = totals[best] / 1000
+    # List the slowest package modules, including the modules that they import
+    by_module = {}
+    for module, depth, _, cumulative_us in entries:
+        if module.startswith('jasmin_auth'):
+            by_module[module] = max(by_module.get(module, 0), cumulative_us)
+    slowest = sorted(by_module.items(), key = lambda item: item[1], reverse = True)
+    width = max((len(module) for module, _ in slowest[:args.top]), default = 0)
+    for module, cumulative_us in slowest[:args.top]:
+        print('{}  {:>8.1f}ms'.format(module.ljust(width), cumulative_us / 1000))
+    failed = False
+    print('Package import time: {:.1f}ms (budget {:.1f}ms)'.format(total_ms, args.budget))
+    if total_ms > args.budget:
+        print('FAILED: the import time exceeds the budget.')
+        failed = True
+    lazy = lazy_imports(entries)
+    if lazy:
+        print('FAILED: imported by the package at startup: {}'.format(', '.join(lazy)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""
+Drives concurrent end-to-end logins through the login and callback views against a local
+stub identity provider.
+
+Usage::
+
+    python -m benchmarks.load [--logins N] [--concurrency N] [--server wsgi|asgi]
+                              [--views sync|async] [--latency SECONDS] [--error-rate FRACTION]
+                              [--setting NAME=VALUE ...]
+
+Reports the throughput, the latency percentiles of a complete login, the number of database
+queries per login and the number of connections opened to the identity provider.
+"""
+
+import argparse
+import ast
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+from .stub_idp import StubIdentityProvider
+
+
+class QueryCounter:
+    """
+    Thread-safe counter for the queries executed on every database connection.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog = 'python -m benchmarks.load')
+    parser.add_argument('--logins', type = int, default = 500, help = 'The number of logins.')
+    parser.add_argument(
+        '--concurrency',
+        type = int,
+        default = 20,
+        help = 'The number of logins in progress at once.'
+    )
+    parser.add_argument(
+        '--server',
+        choices = ['wsgi', 'asgi'],
+        default = 'wsgi',
+        help = 'Whether to drive the logins using WSGI threads or ASGI tasks.'
+    )
+    parser.add_argument(
+        '--views',
+        choices = ['sync', 'async'],
+        default = 'sync',
+        help = 'Whether to use jasmin_auth.urls or jasmin_auth.async_urls.'
+    )
+    parser.add_argument(
+        '--latency',
+        type = float,
+        default = 0.05,
+        help = 'The latency in seconds of each request to the identity provider.'
+    )
+    parser.add_argument(
+        '--error-rate',
+        type = float,
+        default = 0,
+        help = 'The fraction of requests to the identity provider that fail with a 503.'
+    )
+    parser.add_argument(
+        '--users',
+        type = int,
+        default = None,
+        help = 'The number of distinct users, so that some logins are repeats. Defaults to one per login.'
+    )
+    parser.add_argument(
+        '--setting',
+        action = 'append',
+        default = [],
+        metavar = 'NAME=VALUE',
+        help = (
+            'Override a JASMIN_AUTH setting, e.g. PROVIDER_MAX_CONCURRENCY=10. '
+            'The value is parsed as a Python literal if possible. May be given more than once.'
+        )
+    )
+    return parser.parse_args()
+
+
+def parse_setting(setting):
+    """
+    Parses a setting override of the form ``NAME=VALUE``.
+    """
+    name, _, value = setting.partition('=')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def callback_url(response, username):
+    """
+    Returns the callback URL for the given login response, as the provider would
+    redirect to it.
+    """
+    query = parse_qs(urlparse(response['Location']).query)
+    return '/auth/callback/?code={}&state={}'.format(username, query['state'][0])
+
+
+def succeeded(response):
+    return response.status_code == 302 and response['Location'] == '/plain/'
+
+
+def run_wsgi(logins, concurrency):
+    """
+    Runs the logins in a pool of threads and returns a list of ``(seconds, ok)``.
+    """
+    from django.test import Client
+
+    def login(username):
+        client = Client(raise_request_exception = False)
+        start = time.perf_counter()
+        response = client.get('/auth/login/')
+        response = client.get(callback_url(response, username))
+        return time.perf_counter() - start, succeeded(response)
+
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        return list(executor.map(login, logins))
+
+
+def run_asgi(logins, concurrency):
+    """
+    Runs the logins as tasks on an event loop and returns a list of ``(seconds, ok)``.
+    """
+    from django.test import AsyncClient
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def login(username):
+            async with semaphore:
+                client = AsyncClient(raise_request_exception = False)
+                start = time.perf_counter()
+                response = await client.get('/auth/login/')
+                response = await client.get(callback_url(response, username))
+                return time.perf_counter() - start, succeeded(response)
+
+        return await asyncio.gather(*(login(username) for username in logins))
+
+    return asyncio.run(main())
+
+
+def percentile(values, fraction):
+    """
+    Returns the given percentile of the sorted values using the nearest rank.
+    """
+    return values[max(0, int(round(fraction * len(values))) - 1)]
+
+
+def main():
+    args = parse_args()
+    # The stub identity provider does not use TLS
+    os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.load_settings')
+
+    idp = StubIdentityProvider(args.latency, args.error_rate).start()
+
+    import django
+    from django.conf import settings
+    from django.test.utils import override_settings
+    django.setup()
+
+    # Start from an empty database each time
+    database = settings.DATABASES['default']['NAME']
+    if os.path.exists(database):
+        os.remove(database)
+    from django.core.management import call_command
+    call_command('migrate', verbosity = 0, interactive = False)
+
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+    counter = QueryCounter()
+    connection_created.connect(counter.install, weak = False)
+    for connection in connections.all(initialized_only = True):
+        counter.install(connection)
+
+    override_settings(
+        ROOT_URLCONF = 'benchmarks.async_urls' if args.views == 'async' else 'benchmarks.urls',
+        JASMIN_AUTH = dict(
+            settings.JASMIN_AUTH,
+            AUTHORIZE_URL = idp.base_url + '/authorize',
+            ACCESS_TOKEN_URL = idp.base_url + '/token',
+            PROFILE_URL = idp.base_url + '/profile',
+            **dict(parse_setting(setting) for setting in args.setting)
+        )
+    ).enable()
+
+    users = args.users or args.logins
+    logins = ['user{}'.format(index % users) for index in range(args.logins)]
+    run = run_asgi if args.server == 'asgi' else run_wsgi
+    start = time.perf_counter()
+    results = run(logins, args.concurrency)
+    elapsed = time.perf_counter() - start
+    idp.stop()
+
+    latencies = sorted(seconds * 1000 for seconds, _ in results)
+    failures = sum(1 for _, ok in results if not ok)
+    print('Server:              {} ({} views)'.format(args.server, args.views))
+    print('Logins:              {} ({} failed)'.format(len(results), failures))
+    print('Concurrency:         {}'.format(args.concurrency))
+    print('Throughput:          {:.1f} logins/s'.format(len(results) / elapsed))
+    print('Latency p50:         {:.1f} ms'.format(percentile(latencies, 0.5)))
+    print('Latency p95:         {:.1f} ms'.format(percentile(latencies, 0.95)))
+    print('Latency p99:         {:.1f} ms'.format(percentile(latencies, 0.99)))
+    print('Latency mean:        {:.1f} ms'.format(statistics.mean(latencies)))
+    print('Queries per login:   {:.1f}'.format(counter.count / len(results)))
+    print('Provider requests:   {} ({} injected errors)'.format(
+        idp.counts['requests'],
+        idp.counts['errors']
+    ))
+    print('Provider connections: {}'.format(idp.counts['connections']))
+    return 1 if failures and not args.error_rate else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
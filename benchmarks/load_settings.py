@@ -0,0 +1,28 @@
+"""
+Django settings for the load harness.
+
+Unlike the micro-benchmarks, the logins run in several threads, so the database must be a
+file that all the threads can see. Sessions are stored in the database, as they are by default.
+"""
+
+import os
+import tempfile
+
+from .settings import *
+
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get(
+            'JASMIN_AUTH_LOAD_DB',
+            os.path.join(tempfile.gettempdir(), 'jasmin_auth_load.sqlite3')
+        ),
+        # Wait for concurrent writers rather than failing
+        'OPTIONS': { 'timeout': 30 },
+    },
+}
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
+LOGIN_REDIRECT_URL = '/plain/'
@@ -0,0 +1,212 @@
+"""
+The benchmark scenarios for the middleware and login hot paths.
+"""
+
+import itertools
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.cache import SessionStore
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+
+from jasmin_auth.admin_site import AdminSite
+from jasmin_auth.helpers import create_or_update_user, impersonation_permitted_request
+from jasmin_auth.middleware import ImpersonateMiddleware
+from jasmin_auth.settings import app_settings
+
+from .harness import benchmark
+from .urls import DEPTH
+
+
+#: The path of the view at the bottom of the nested URLconf
+DEEP_PATH = ''.join('/level{}'.format(level) for level in range(1, DEPTH + 1)) + '/leaf/'
+
+#: The number of disabled patterns for the many patterns scenarios
+MANY_PATTERNS = 200
+
+
+def jasmin_auth_settings(**kwargs):
+    """
+    Returns a context manager that overrides the given JASMIN_AUTH settings.
+    """
+    return override_settings(JASMIN_AUTH = dict(settings.JASMIN_AUTH, **kwargs))
+
+
+def many_patterns():
+    """
+    Returns a tuple of disabled patterns, none of which match the benchmark paths.
+    """
+    return ('^/admin', ) + tuple(
+        '^/disabled{}/(?P<pk>[0-9]+)/'.format(index)
+        for index in range(MANY_PATTERNS - 1)
+    )
+
+
+def get_users():
+    """
+    Returns a tuple of ``(staff_user, regular_user)``, creating them if required.
+    """
+    UserModel = get_user_model()
+    staff, _ = UserModel.objects.get_or_create(
+        username = 'staff',
+        defaults = dict(is_staff = True, is_superuser = True)
+    )
+    regular, _ = UserModel.objects.get_or_create(username = 'regular')
+    return staff, regular
+
+
+def middleware_call(path, impersonated_pk = None, anonymous = False):
+    """
+    Returns a callable that passes a request for the given path through the middleware
+    and accesses the user, as almost every view does.
+
+    If ``anonymous`` is given, the request has no session cookie or user.
+    """
+    staff, _ = get_users()
+    session = SessionStore()
+    if impersonated_pk is not None:
+        session[app_settings.IMPERSONATE_SESSION_KEY] = impersonated_pk
+    session.save()
+    factory = RequestFactory()
+
+    def get_response(request):
+        request.user.pk
+        return HttpResponse()
+
+    middleware = ImpersonateMiddleware(get_response)
+
+    def call():
+        request = factory.get(path)
+        if anonymous:
+            request.session = SessionStore()
+            request.user = AnonymousUser()
+        else:
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = session.session_key
+            request.session = SessionStore(session.session_key)
+            request.user = staff
+        return middleware(request)
+
+    return call
+
+
+@benchmark('middleware.anonymous')
+def middleware_anonymous():
+    return middleware_call('/plain/', anonymous = True)
+
+
+@benchmark('middleware.no_impersonation')
+def middleware_no_impersonation():
+    return middleware_call('/plain/')
+
+
+@benchmark('middleware.impersonation')
+def middleware_impersonation():
+    _, regular = get_users()
+    return middleware_call('/plain/', regular.pk)
+
+
+@benchmark('middleware.impersonation_cached')
+def middleware_impersonation_cached():
+    _, regular = get_users()
+    with jasmin_auth_settings(IMPERSONATE_CACHE_TIMEOUT = 300):
+        yield middleware_call('/plain/', regular.pk)
+
+
+@benchmark('middleware.impersonation_disabled_path')
+def middleware_impersonation_disabled_path():
+    _, regular = get_users()
+    return middleware_call('/admin/', regular.pk)
+
+
+@benchmark('middleware.exempt_path')
+def middleware_exempt_path():
+    _, regular = get_users()
+    with jasmin_auth_settings(IMPERSONATE_EXEMPT_PATH_PREFIXES = ('/plain/', )):
+        yield middleware_call('/plain/', regular.pk)
+
+
+def permitted_request_call(path):
+    """
+    Returns a callable that tests if impersonation is permitted for the given path.
+    """
+    request = RequestFactory().get(path)
+    return lambda: impersonation_permitted_request(request)
+
+
+@benchmark('permitted_request.few_patterns')
+def permitted_request_few_patterns():
+    with jasmin_auth_settings(IMPERSONATE_PATH_CACHE_SIZE = 0):
+        yield permitted_request_call('/plain/')
+
+
+@benchmark('permitted_request.many_patterns')
+def permitted_request_many_patterns():
+    with jasmin_auth_settings(
+        IMPERSONATE_DISABLED_PATTERNS = many_patterns(),
+        IMPERSONATE_PATH_CACHE_SIZE = 0
+    ):
+        yield permitted_request_call('/plain/')
+
+
+@benchmark('permitted_request.deep_urlconf')
+def permitted_request_deep_urlconf():
+    with jasmin_auth_settings(IMPERSONATE_PATH_CACHE_SIZE = 0):
+        yield permitted_request_call(DEEP_PATH)
+
+
+@benchmark('permitted_request.deep_urlconf_cached')
+def permitted_request_deep_urlconf_cached():
+    with jasmin_auth_settings(IMPERSONATE_DISABLED_PATTERNS = many_patterns()):
+        yield permitted_request_call(DEEP_PATH)
+
+
+def profile(**kwargs):
+    return dict(
+        username = 'jbloggs',
+        first_name = 'Joe',
+        last_name = 'Bloggs',
+        email = 'joe.bloggs@example.com',
+        **kwargs
+    )
+
+
+@benchmark('create_or_update_user.unchanged')
+def create_or_update_user_unchanged():
+    unchanged = profile()
+    return lambda: create_or_update_user(unchanged)
+
+
+@benchmark('create_or_update_user.changed')
+def create_or_update_user_changed():
+    # Alternate between two profiles so that every call changes the user
+    profiles = itertools.cycle([profile(), dict(profile(), email = 'jbloggs@example.com')])
+    return lambda: create_or_update_user(next(profiles))
+
+
+def admin_login_call(user):
+    """
+    Returns a callable that calls the admin login view as the given user.
+    """
+    site = AdminSite()
+    factory = RequestFactory()
+
+    def call():
+        request = factory.get('/admin/login/')
+        request.session = SessionStore()
+        request.user = user
+        return site.login(request)
+
+    return call
+
+
+@benchmark('admin_login.anonymous')
+def admin_login_anonymous():
+    return admin_login_call(AnonymousUser())
+
+
+@benchmark('admin_login.authenticated')
+def admin_login_authenticated():
+    staff, _ = get_users()
+    return admin_login_call(staff)
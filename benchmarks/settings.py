@@ -0,0 +1,72 @@
+"""
+Minimal Django settings for running the benchmarks.
+"""
+
+SECRET_KEY = 'benchmarks-only'
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['*']
+
+INSTALLED_APPS = [
+    'jasmin_auth',
+    'jasmin_auth.apps.AdminConfig',
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+]
+
+MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'jasmin_auth.middleware.ImpersonateMiddleware',
+]
+
+ROOT_URLCONF = 'benchmarks.urls'
+
+# Use an in-memory database so that the benchmarks measure the code rather than the disk
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Keep sessions out of the database so that the query counts only include our queries
+SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
+
+# Hashing passwords is deliberately slow and is not what we are measuring
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.request',
+                'django.contrib.auth.context_processors.auth',
+                'django.contrib.messages.context_processors.messages',
+            ],
+        },
+    },
+]
+
+USE_TZ = True
+
+LOGIN_URL = 'jasmin_auth:login'
+
+JASMIN_AUTH = {
+    'CLIENT_ID': 'benchmarks',
+    'CLIENT_SECRET': 'benchmarks',
+    # The audit events are not what we are measuring
+    'AUDIT_IMPERSONATION': False,
+}
@@ -0,0 +1,107 @@
+"""
+A local stub of the OAuth 2.0 and profile endpoints of the identity provider.
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for the stub identity provider.
+
+    The authorisation code sent to the token endpoint is used as the username, so that each
+    simulated login can be for a different user.
+    """
+    # Use HTTP/1.1 so that clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulate(self):
+        """
+        Applies the configured latency and returns true if an error should be injected.
+        """
+        self.server.count('requests')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.count('errors')
+            self.send_json(503, dict(error = 'temporarily_unavailable'))
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(self.rfile.read(length).decode())
+        if self.simulate():
+            return
+        code = params.get('code', [''])[0]
+        self.send_json(200, dict(
+            access_token = 'token-' + code,
+            token_type = 'Bearer',
+            expires_in = 3600
+        ))
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/profile':
+            return self.send_json(404, dict(error = 'not_found'))
+        if self.simulate():
+            return
+        username = self.headers.get('Authorization', '').rpartition('token-')[2]
+        self.send_json(200, dict(
+            username = username,
+            first_name = 'Load',
+            last_name = 'Test',
+            email = '{}@example.com'.format(username)
+        ))
+
+
+class StubIdentityProvider(ThreadingHTTPServer):
+    """
+    Stub identity provider with configurable latency and error injection.
+
+    Counts the requests, injected errors and connections that it receives.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency = 0, error_rate = 0, port = 0):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.counts_lock = threading.Lock()
+        self.counts = dict(connections = 0, requests = 0, errors = 0)
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] += 1
+
+    def process_request(self, request, client_address):
+        # This is called once for each new connection
+        self.count('connections')
+        super().process_request(request, client_address)
+
+    def start(self):
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
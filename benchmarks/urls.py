@@ -0,0 +1,43 @@
+"""
+URLconf for the benchmarks, including a deeply nested section to exercise resolving.
+"""
+
+from django.contrib import admin
+from django.http import HttpResponse
+from django.urls import include, path
+
+from jasmin_auth.decorators import no_impersonation
+
+
+#: The number of levels of nested includes
+DEPTH = 8
+
+#: The number of sibling patterns at each level
+WIDTH = 20
+
+
+def view(request, **kwargs):
+    return HttpResponse()
+
+
+def nested(level):
+    """
+    Returns the patterns for the given level of the nested URLconf.
+    """
+    patterns = [
+        path('page{}/<int:pk>/'.format(index), view, name = 'page{}'.format(index))
+        for index in range(WIDTH)
+    ]
+    if level < DEPTH:
+        patterns.append(path('level{}/'.format(level + 1), include(nested(level + 1))))
+    else:
+        patterns.append(path('leaf/', no_impersonation(view), name = 'leaf'))
+    return patterns
+
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('auth/', include('jasmin_auth.urls')),
+    path('plain/', view, name = 'plain'),
+    path('level1/', include(nested(1))),
+]
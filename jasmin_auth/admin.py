@@ -0,0 +1,41 @@
+from django.contrib import admin, messages
+
+from . import registry
+from .models import ActiveImpersonation
+
+
+@admin.register(ActiveImpersonation)
+class ActiveImpersonationAdmin(admin.ModelAdmin):
+    """
+    Admin for listing and revoking active impersonations.
+    """
+    list_display = ('impersonator', 'impersonatee', 'started_at', 'expires_at')
+    list_select_related = ('impersonator', 'impersonatee')
+    search_fields = ('impersonator__username', 'impersonatee__username')
+    date_hierarchy = 'started_at'
+    actions = ('revoke_selected', )
+
+    def get_queryset(self, request):
+        # Only show impersonations whose session has not expired
+        return super().get_queryset(request).active()
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        # Deleting an entry would leave the impersonation active in the session
+        actions.pop('delete_selected', None)
+        return actions
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj = None):
+        return False
+
+    @admin.action(description = 'Revoke selected impersonations', permissions = ['delete'])
+    def revoke_selected(self, request, queryset):
+        revoked = registry.revoke(queryset)
+        self.message_user(
+            request,
+            'Revoked {} impersonation(s).'.format(revoked),
+            messages.SUCCESS
+        )
@@ -10,6 +10,7 @@ from django.utils.http import url_has_allowed_host_and_scheme, urlencode
 from django.utils.translation import gettext as _
 from django.views.decorators.cache import never_cache
 
+from . import registry
 from .decorators import no_impersonation
 from .settings import app_settings
 from .signals import impersonation_ended, impersonation_started
@@ -120,6 +121,17 @@ class AdminSite(admin.AdminSite):
                 request.session[app_settings.IMPERSONATE_SESSION_KEY] = pk
                 # Dispatch the signal to indicate that an impersonation has started
                 if previous_pk != pk:
+                    # Change the session key so that caches that vary on the session
+                    # cookie do not return responses for the previous identity
+                    previous_session_key = request.session.session_key
+                    request.session.cycle_key()
+                    # Record the impersonation in the registry under the new key
+                    registry.register(
+                        request,
+                        request.user,
+                        impersonatee,
+                        previous_session_key
+                    )
                     messages.add_message(
                         request,
                         messages.SUCCESS,
@@ -150,9 +162,12 @@ class AdminSite(admin.AdminSite):
         """
         View to end impersonating a user.
         """
-        # Remove the key from the session
+        # Remove the key from the session, changing the session key so that caches that
+        # vary on the session cookie do not return responses for the impersonated user
         if app_settings.IMPERSONATE_SESSION_KEY in request.session:
             del request.session[app_settings.IMPERSONATE_SESSION_KEY]
+            registry.unregister(request.session.session_key)
+            request.session.cycle_key()
         # If there is an impersonation active on this request, dispatch the signal
         if request.impersonatee:
             messages.add_message(
@@ -9,6 +9,13 @@ class AppConfig(apps.AppConfig):
     name = 'jasmin_auth'
     verbose_name = 'JASMIN Auth'
     default = True
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        """
+        When the application becomes ready, register the signal handlers.
+        """
+        from . import handlers
 
 
 class AdminConfig(admin_apps.AdminConfig):
@@ -0,0 +1,11 @@
+from django.urls import path
+
+from .async_views import login, callback
+
+
+app_name = 'jasmin_auth'
+
+urlpatterns = [
+    path('login/', login, name = 'login'),
+    path('callback/', callback, name = 'callback'),
+]
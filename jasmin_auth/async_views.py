@@ -0,0 +1,151 @@
+from asgiref.sync import sync_to_async
+
+from django.conf import settings as django_settings
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY,
+    REDIRECT_FIELD_NAME,
+    SESSION_KEY,
+    alogin as auth_login,
+    get_user_model
+)
+from django.shortcuts import redirect, resolve_url
+
+from .coalesce import get_flight
+from .instrumentation import mark_view_finished, timed
+from .settings import app_settings
+from .snapshot import save_snapshot
+from .views import render_oauth_error
+
+
+async def login(request):
+    """
+    Starts the OAuth 2.0 login flow.
+
+    Async version of :py:func:`jasmin_auth.views.login`.
+    """
+    # As for the sync views, the OAuth stack is only imported when it is needed
+    from .oauth import get_provider, make_state, set_state_cookie
+    # Initialise the OAuth session
+    # Generating the redirect URL and state does not make any requests
+    provider = get_provider(request)
+    # For a stateless login, the next url goes in the state and the session is not touched
+    if app_settings.STATELESS_STATE:
+        state, nonce = make_state(request.GET.get(REDIRECT_FIELD_NAME))
+        auth_url, state = provider.authorization_url(app_settings.AUTHORIZE_URL, state = state)
+        response = redirect(auth_url)
+        set_state_cookie(response, request, nonce)
+        return response
+    # Get the redirect URL and state
+    auth_url, state = provider.authorization_url(app_settings.AUTHORIZE_URL)
+    # Store the next url, if given, and the state in the session
+    # Loading the session may hit the database, so it must happen in a thread
+    @sync_to_async
+    def update_session():
+        if REDIRECT_FIELD_NAME in request.GET:
+            request.session[app_settings.NEXT_URL_SESSION_KEY] = request.GET[REDIRECT_FIELD_NAME]
+        request.session[app_settings.STATE_SESSION_KEY] = state
+    await update_session()
+    return redirect(auth_url)
+
+
+async def reuse_callback_result(request, flight, result):
+    """
+    Async version of :py:func:`jasmin_auth.views.reuse_callback_result`.
+    """
+    from .oauth import delete_state_cookie
+    session_user = await sync_to_async(request.session.get)(SESSION_KEY)
+    if not flight.can_reuse(result, session_user):
+        return None
+    if session_user != result['user']:
+        user = await get_user_model()._default_manager.filter(pk = result['user']).afirst()
+        if user is None:
+            return None
+        await auth_login(request, user, result['backend'])
+        await sync_to_async(save_snapshot)(request, user)
+    @sync_to_async
+    def clean_session():
+        request.session.pop(app_settings.STATE_SESSION_KEY, None)
+        request.session.pop(app_settings.NEXT_URL_SESSION_KEY, None)
+    await clean_session()
+    response = redirect(result['redirect_url'])
+    if app_settings.STATELESS_STATE:
+        delete_state_cookie(response)
+    return response
+
+
+async def callback(request):
+    """
+    Handles the OAuth 2.0 callback.
+
+    Async version of :py:func:`jasmin_auth.views.callback`. The requests to the identity
+    provider are made using an async HTTP client, so they do not tie up a thread.
+    """
+    flight = get_flight(request)
+    if flight is None:
+        return await handle_callback(request)
+    result = await flight.ajoin()
+    if result is not None:
+        response = await reuse_callback_result(request, flight, result)
+        if response is not None:
+            return response
+    try:
+        return await handle_callback(request, flight)
+    finally:
+        await flight.arelease()
+
+
+async def handle_callback(request, flight = None):
+    """
+    Async version of :py:func:`jasmin_auth.views.handle_callback`.
+    """
+    from httpx import HTTPError
+    from oauthlib.oauth2.rfc6749.errors import OAuth2Error
+    from .oauth import afetch_token, delete_state_cookie, load_state
+    from .oidc import IdTokenError
+    from .profiles import aget_user_for_token
+    from .resilience import ProviderUnavailable
+    if app_settings.STATELESS_STATE:
+        # Verifying the state is pure computation, so it can happen on the event loop
+        try:
+            state, next_url = load_state(request)
+        except OAuth2Error as exc:
+            return await sync_to_async(render_oauth_error)(request, exc.error, exc.description)
+    else:
+        state = await sync_to_async(request.session.pop)(app_settings.STATE_SESSION_KEY, None)
+    try:
+        with timed('fetch_token'):
+            client = await afetch_token(request, state)
+    except OAuth2Error as exc:
+        # If there is an OAuth error, show the error page
+        return await sync_to_async(render_oauth_error)(request, exc.error, exc.description)
+    except HTTPError:
+        # The provider could not be reached or did not respond in time
+        return await sync_to_async(render_oauth_error)(request, ProviderUnavailable.error)
+    # If a token is obtained successfully, get the profile and create a local user
+    try:
+        user = await aget_user_for_token(client, client.token)
+    except IdTokenError:
+        return await sync_to_async(render_oauth_error)(request, 'invalid_id_token')
+    except ProviderUnavailable as exc:
+        return await sync_to_async(render_oauth_error)(request, exc.error, exc.description)
+    except HTTPError:
+        return await sync_to_async(render_oauth_error)(request, ProviderUnavailable.error)
+    # Log the user in, using the configured backend if there is one
+    with timed('login'):
+        await auth_login(request, user, app_settings.LOGIN_BACKEND or None)
+    await sync_to_async(save_snapshot)(request, user)
+    # Redirect to the specified URL
+    if app_settings.STATELESS_STATE:
+        response = redirect(next_url or resolve_url(django_settings.LOGIN_REDIRECT_URL))
+        delete_state_cookie(response)
+    else:
+        next_url = await sync_to_async(request.session.pop)(
+            app_settings.NEXT_URL_SESSION_KEY,
+            resolve_url(django_settings.LOGIN_REDIRECT_URL)
+        )
+        response = redirect(next_url)
+    if flight is not None:
+        # The session has already been loaded by the login
+        await flight.acomplete(user, request.session[BACKEND_SESSION_KEY], response.url)
+    mark_view_finished(request)
+    return response
@@ -0,0 +1,128 @@
+import atexit
+import logging
+import os
+import threading
+
+from django.apps import apps
+from django.db import connection, transaction
+
+from .settings import app_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_events(events):
+    """
+    Writes the given events, which are tuples of
+    ``(event_type, impersonator, impersonatee, created_at)``, to the database.
+
+    If the tsunami application is installed, tsunami events are created. Otherwise,
+    the events are recorded using the built-in model.
+    """
+    if apps.is_installed('tsunami'):
+        from tsunami.models import Event
+        # Tsunami events are created individually in case they rely on save
+        with transaction.atomic():
+            for event_type, impersonator, impersonatee, _ in events:
+                Event.objects.create(
+                    event_type = event_type,
+                    target = impersonatee,
+                    user = impersonator
+                )
+    else:
+        from .models import ImpersonationEvent
+        ImpersonationEvent.objects.bulk_create([
+            ImpersonationEvent(
+                event_type = event_type,
+                impersonator_id = impersonator.pk,
+                impersonatee_id = impersonatee.pk,
+                created_at = created_at
+            )
+            for event_type, impersonator, impersonatee, created_at in events
+        ])
+
+
+class AuditBuffer:
+    """
+    Buffers audit events and writes them in batches from a background thread.
+    """
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._events = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def after_fork_in_child(self):
+        """
+        Resets the buffer in a forked child process.
+
+        The background thread does not survive a fork, so the child must start its own.
+        Any events inherited from the parent are dropped, as the parent writes them.
+        """
+        self._reset()
+
+    def add(self, event):
+        """
+        Adds an event to the buffer.
+        """
+        with self._lock:
+            self._events.append(event)
+            count = len(self._events)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target = self._run,
+                    name = 'jasmin-auth-audit',
+                    daemon = True
+                )
+                self._thread.start()
+        if count >= app_settings.AUDIT_BATCH_SIZE:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes any buffered events to the database.
+        """
+        with self._lock:
+            events, self._events = self._events, []
+        if events:
+            write_events(events)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(app_settings.AUDIT_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error writing impersonation audit events')
+            finally:
+                # Don't hold a database connection open between flushes
+                connection.close()
+
+
+_buffer = AuditBuffer()
+# Make sure that buffered events are written when the process exits
+# Events that are buffered when the process is killed, e.g. by SIGKILL, are lost
+atexit.register(_buffer.flush)
+# Servers that fork workers after importing the application, e.g. gunicorn with --preload,
+# would otherwise leave the workers with a thread that does not exist
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = _buffer.after_fork_in_child)
+
+
+def record(event_type, impersonator, impersonatee, created_at):
+    """
+    Records an audit event once the current transaction, if any, has committed.
+
+    If ``AUDIT_BACKGROUND`` is set, the event is written in a batch from a background
+    thread so that the request does not wait for it.
+    """
+    event = (event_type, impersonator, impersonatee, created_at)
+    if app_settings.AUDIT_BACKGROUND:
+        transaction.on_commit(lambda: _buffer.add(event))
+    else:
+        transaction.on_commit(lambda: write_events([event]))
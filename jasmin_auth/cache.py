@@ -0,0 +1,225 @@
+import threading
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.functional import lazy
+
+from .instrumentation import timed
+from .settings import app_settings
+
+
+class CacheStats:
+    """
+    Thread-safe hit and miss counters for a cache.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def as_dict(self):
+        with self._lock:
+            return dict(hits = self.hits, misses = self.misses)
+
+
+#: Hit and miss counters for the impersonatee cache
+impersonatee_cache_stats = CacheStats()
+
+#: The request header used to vary cached responses on the identity of the user
+IDENTITY_HEADER = 'X-Jasmin-Auth-Identity'
+
+
+def get_cache():
+    """
+    Returns the cache to use for cached data.
+    """
+    return caches[app_settings.CACHE_ALIAS]
+
+
+def make_key(*parts):
+    """
+    Returns a cache key made from the configured prefix and the given parts.
+    """
+    return ':'.join(str(part) for part in (app_settings.CACHE_KEY_PREFIX, ) + parts)
+
+
+def user_generation_key(pk):
+    """
+    Returns the cache key for the generation of the user with the given pk.
+    """
+    return make_key('user_generation', pk)
+
+
+def invalidate_users(pks, using = None):
+    """
+    Invalidates any cached data that depends on the users with the given pks.
+
+    Rather than tracking every key that refers to a user, each user has a generation
+    that is stored alongside the cached data. Changing the generation makes any data
+    stored with the previous generation invalid.
+
+    The generations are changed when the current transaction on the given database
+    commits. Changing them earlier would allow a concurrent request to store the
+    uncommitted, i.e. old, data under the new generation.
+
+    Generations are only maintained when a feature that uses them is enabled.
+    """
+    if not (app_settings.IMPERSONATE_CACHE_TIMEOUT or app_settings.USER_SNAPSHOT):
+        return
+    keys = [user_generation_key(pk) for pk in pks]
+    if keys:
+        transaction.on_commit(
+            lambda: get_cache().set_many({ key: uuid.uuid4().hex for key in keys }, None),
+            using = using
+        )
+
+
+def invalidate_user(pk, using = None):
+    """
+    Invalidates any cached data that depends on the user with the given pk.
+
+    See :py:func:`invalidate_users`.
+    """
+    invalidate_users([pk], using)
+
+
+def get_user_generations(cache, *pks):
+    """
+    Returns a tuple containing the current generation of each of the given users,
+    initialising the generation of any user that does not have one.
+    """
+    keys = [user_generation_key(pk) for pk in pks]
+    generations = cache.get_many(keys)
+    missing = [key for key in keys if not generations.get(key)]
+    if missing:
+        # Use add so that we don't overwrite a generation set by another process
+        for key in missing:
+            cache.add(key, uuid.uuid4().hex, None)
+        generations.update(cache.get_many(missing))
+    return tuple(generations.get(key) for key in keys)
+
+
+def _load_impersonatee(impersonator, impersonatee_pk):
+    """
+    Loads the impersonatee from the database and tests if the impersonation is permitted.
+    """
+    User = get_user_model()
+    try:
+        impersonatee = User.objects.get(pk = impersonatee_pk)
+    except ObjectDoesNotExist:
+        return None, False
+    return impersonatee, app_settings.IMPERSONATE_IS_PERMITTED_USER(impersonator, impersonatee)
+
+
+def get_impersonatee(impersonator, impersonatee_pk):
+    """
+    Returns a tuple of ``(impersonatee, permitted)`` for the given impersonator and
+    impersonatee pk, where ``impersonatee`` is ``None`` if the user does not exist.
+
+    If ``IMPERSONATE_CACHE_TIMEOUT`` is set, the impersonatee and the permission decision
+    are cached until the timeout expires or either user is saved or deleted.
+    """
+    # The outcome of the phase indicates where the impersonatee came from
+    with timed('impersonation_lookup') as phase:
+        return _get_impersonatee(impersonator, impersonatee_pk, phase)
+
+
+def _get_impersonatee(impersonator, impersonatee_pk, phase):
+    timeout = app_settings.IMPERSONATE_CACHE_TIMEOUT
+    if not timeout:
+        phase.outcome = 'db'
+        return _load_impersonatee(impersonator, impersonatee_pk)
+    cache = get_cache()
+    entry_key = make_key('impersonatee', impersonator.pk, impersonatee_pk)
+    generation_keys = [
+        user_generation_key(impersonator.pk),
+        user_generation_key(impersonatee_pk)
+    ]
+    # Fetch the entry and the current generations of both users in one round trip
+    cached = cache.get_many([entry_key] + generation_keys)
+    generations = tuple(cached.get(key) for key in generation_keys)
+    entry = cached.get(entry_key)
+    # The entry is only valid if neither user has changed since it was stored
+    if entry is not None and all(generations) and entry[0] == generations:
+        impersonatee_cache_stats.hit()
+        phase.outcome = 'cache_hit'
+        return entry[1], entry[2]
+    impersonatee_cache_stats.miss()
+    phase.outcome = 'cache_miss'
+    # Make sure we have the generations from BEFORE the users are loaded, so that an
+    # invalidation that happens while we are loading them is not lost
+    if not all(generations):
+        generations = get_user_generations(cache, impersonator.pk, impersonatee_pk)
+    impersonatee, permitted = _load_impersonatee(impersonator, impersonatee_pk)
+    # We don't cache missing users as the middleware removes them from the session
+    if impersonatee is not None:
+        cache.set(entry_key, (generations, impersonatee, permitted), timeout)
+    return impersonatee, permitted
+
+
+def get_identity_key(request):
+    """
+    Returns a string that identifies both the effective user and the impersonator for
+    the given request, for use as a component of cache keys.
+    """
+    user = getattr(request, 'user', None)
+    impersonator = getattr(request, 'impersonator', None)
+    return '{}:{}'.format(
+        user.pk if user and user.is_authenticated else 'anonymous',
+        impersonator.pk if impersonator else '-'
+    )
+
+
+def set_identity_header(request):
+    """
+    Sets the identity header on the given request so that Django's cache framework can
+    vary responses on it.
+
+    The value is lazy, so the user is only loaded if a cache key is actually computed.
+    """
+    header = 'HTTP_' + IDENTITY_HEADER.upper().replace('-', '_')
+    request.META[header] = lazy(get_identity_key, str)(request)
+
+
+def patch_identity_vary_headers(request, response):
+    """
+    Updates the Vary header of the given response so that Django's cache framework caches
+    it per identity.
+
+    Only the identity header is added, so that other cookies do not fragment the cache.
+    The identity header is never sent by clients, so downstream caches must be kept out
+    using :py:func:`patch_identity_cache_control`.
+    """
+    patch_vary_headers(response, (IDENTITY_HEADER, ))
+
+
+def patch_identity_cache_control(request, response):
+    """
+    Marks the given response as private if it is for an authenticated user, so that
+    downstream caches do not share it between users.
+
+    Responses for anonymous users are left as they are, so they can still be shared.
+
+    Django's cache framework does not store private responses, so this must be applied
+    after the response has been cached.
+    """
+    user = getattr(request, 'user', None)
+    if user and user.is_authenticated:
+        patch_cache_control(response, private = True)
@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import threading
+import time
+
+from django.conf import settings as django_settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from .cache import get_cache, make_key
+from .settings import app_settings
+
+
+#: The number of seconds between checks for the result of a flight in another process
+POLL_INTERVAL = 0.05
+
+# Events for the flights that are led by this process, so that requests in other threads
+# can wait for them without polling the cache
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_binding(request):
+    """
+    Returns a value that binds a callback result to the browser that made the request.
+
+    A duplicate callback has the same cookies as the original request, unless the original
+    request has already completed, in which case the user is already logged in.
+    """
+    value = '{}|{}'.format(
+        request.COOKIES.get(django_settings.SESSION_COOKIE_NAME, ''),
+        request.COOKIES.get(app_settings.STATE_COOKIE_NAME, '')
+    )
+    return salted_hmac('jasmin_auth.coalesce', value).hexdigest()
+
+
+class Flight:
+    """
+    Coalesces callback requests that have the same authorization code and state.
+
+    The first request to join a flight becomes the leader and handles the callback as
+    normal. Duplicate requests, in this or another process, wait for the leader to finish
+    and reuse its result rather than trying to exchange the code again.
+    """
+    def __init__(self, request, timeout, wait):
+        digest = hashlib.sha256(
+            '{}|{}'.format(request.GET['code'], request.GET.get('state', '')).encode()
+        ).hexdigest()
+        self.key = digest
+        self.lock_key = make_key('callback', digest, 'lock')
+        self.result_key = make_key('callback', digest, 'result')
+        self.binding = get_binding(request)
+        self.timeout = timeout
+        self.wait = wait
+        self.leader = False
+        self.completed = False
+        self.event = None
+
+    def join(self):
+        """
+        Joins the flight and returns the result of the leader, or ``None`` if this request
+        should handle the callback itself.
+        """
+        cache = get_cache()
+        # The lock only protects the flights in this process, so the cache is not accessed
+        # while holding it
+        # If another thread in this process wins the race to add the cache key before it
+        # registers its event, this request just polls the cache
+        with _flights_lock:
+            event = _flights.get(self.key)
+        if event is None and cache.add(self.lock_key, True, self.timeout):
+            self.become_leader()
+            return None
+        if event is not None:
+            # The leader is in this process, so wait for it to finish
+            event.wait(self.wait)
+            return cache.get(self.result_key)
+        # The leader is in another process, or has already finished
+        deadline = time.monotonic() + self.wait
+        while True:
+            result = cache.get(self.result_key)
+            # If the lock has gone, the leader failed without a result
+            if result is not None or cache.get(self.lock_key) is None:
+                return result
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+    async def ajoin(self):
+        """
+        Async version of :py:meth:`join`.
+        """
+        cache = get_cache()
+        with _flights_lock:
+            event = _flights.get(self.key)
+        if event is None and await cache.aadd(self.lock_key, True, self.timeout):
+            self.become_leader()
+            return None
+        # Waiting on the event would block the event loop, so poll instead
+        deadline = time.monotonic() + self.wait
+        while True:
+            if event is None or event.is_set():
+                result = await cache.aget(self.result_key)
+                if result is not None or await cache.aget(self.lock_key) is None:
+                    return result
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def become_leader(self):
+        self.leader = True
+        self.event = threading.Event()
+        with _flights_lock:
+            _flights[self.key] = self.event
+
+    def make_result(self, user, backend, redirect_url):
+        return dict(
+            user = user._meta.pk.value_to_string(user),
+            backend = backend,
+            binding = self.binding,
+            redirect_url = redirect_url
+        )
+
+    def complete(self, user, backend, redirect_url):
+        """
+        Records the result of a successful callback for any duplicate requests.
+        """
+        if self.leader:
+            get_cache().set(self.result_key, self.make_result(user, backend, redirect_url), self.timeout)
+            self.completed = True
+
+    async def acomplete(self, user, backend, redirect_url):
+        """
+        Async version of :py:meth:`complete`.
+        """
+        if self.leader:
+            await get_cache().aset(
+                self.result_key,
+                self.make_result(user, backend, redirect_url),
+                self.timeout
+            )
+            self.completed = True
+
+    def release(self):
+        """
+        Releases the flight, waking any duplicate requests in this process.
+        """
+        if not self.leader:
+            return
+        # If the leader failed, let the next request try instead
+        if not self.completed:
+            get_cache().delete(self.lock_key)
+        self.finish()
+
+    async def arelease(self):
+        """
+        Async version of :py:meth:`release`.
+        """
+        if not self.leader:
+            return
+        if not self.completed:
+            await get_cache().adelete(self.lock_key)
+        self.finish()
+
+    def finish(self):
+        with _flights_lock:
+            _flights.pop(self.key, None)
+        self.event.set()
+
+    def can_reuse(self, result, session_user):
+        """
+        Returns true if the given result can be reused for this request, where
+        ``session_user`` is the user key currently stored in the request's session.
+        """
+        return (
+            session_user == result['user'] or
+            constant_time_compare(self.binding, result['binding'])
+        )
+
+
+def get_flight(request):
+    """
+    Returns the flight for the given callback request, or ``None`` if callbacks are not
+    being coalesced.
+    """
+    timeout = app_settings.CALLBACK_COALESCE_TIMEOUT
+    if timeout and 'code' in request.GET:
+        return Flight(request, timeout, app_settings.CALLBACK_COALESCE_WAIT)
+    return None
@@ -1,5 +1,13 @@
 from functools import update_wrapper
 
+from django.views.decorators.cache import cache_page
+
+from .cache import (
+    patch_identity_cache_control,
+    patch_identity_vary_headers,
+    set_identity_header
+)
+
 
 def no_impersonation(view):
     """
@@ -10,3 +18,44 @@ def no_impersonation(view):
         return view(*args, **kwargs)
     wrapper.no_impersonation = True
     return update_wrapper(wrapper, view)
+
+
+def vary_on_identity(view):
+    """
+    Decorator that varies the response for the given view on both the effective user
+    and the impersonator, so that it can be safely cached per user.
+
+    Responses for authenticated users are also marked as private for downstream caches.
+    """
+    def wrapper(request, *args, **kwargs):
+        set_identity_header(request)
+        response = view(request, *args, **kwargs)
+        patch_identity_vary_headers(request, response)
+        patch_identity_cache_control(request, response)
+        return response
+    return update_wrapper(wrapper, view)
+
+
+def cache_page_per_identity(timeout, *, cache = None, key_prefix = None):
+    """
+    Decorator that caches the response for the given view per identity, i.e. separately
+    for each combination of effective user and impersonator.
+
+    The arguments are the same as for ``django.views.decorators.cache.cache_page``.
+    """
+    def decorator(view):
+        # The response must have the identity in the Vary header before the cache sees it
+        def varied_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            patch_identity_vary_headers(request, response)
+            return response
+        cached_view = cache_page(timeout, cache = cache, key_prefix = key_prefix)(varied_view)
+        # The identity must be on the request before the cache is checked, and the
+        # response is only marked as private once the cache has seen it
+        def wrapper(request, *args, **kwargs):
+            set_identity_header(request)
+            response = cached_view(request, *args, **kwargs)
+            patch_identity_cache_control(request, response)
+            return response
+        return update_wrapper(wrapper, view)
+    return decorator
@@ -1,23 +1,84 @@
-from django.apps import apps
+from django.conf import settings as django_settings
+from django.contrib.auth.signals import user_logged_out
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.utils import timezone
 
-from .signals import impersonation_started
+from . import audit, registry
+from .cache import invalidate_user
+from .helpers import clear_path_decisions
+from .instrumentation import configure_metrics
+from .models import ImpersonationEvent
+from .settings import app_settings
+from .signals import impersonation_ended, impersonation_started
 
 
-# If the tsunami application is installed, register a handler that makes a tsunami
-# event every time an impersonation is started
-if apps.is_installed('tsunami'):
-    from tsunami.models import Event
+# Connect the metrics collector if metrics are enabled
+configure_metrics()
 
 
-    @receiver(impersonation_started)
-    def make_tsunami_event(sender, impersonator, impersonatee, **kwargs):
-        """
-        Make a tsunami event indicating that an impersonation was started.
-        """
-        # Get the opts for the user class
-        Event.objects.create(
-            event_type = 'jasmin_auth.user_impersonated',
-            target = impersonatee,
-            user = impersonator
-        )
+@receiver(post_save, sender = django_settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender = django_settings.AUTH_USER_MODEL)
+def invalidate_user_cache(sender, instance, **kwargs):
+    """
+    Invalidate any cached data for a user when the user is saved or deleted.
+
+    The data is invalidated when the transaction commits. Writes that do not send these
+    signals, e.g. ``QuerySet.update``, must call ``invalidate_users`` themselves.
+    """
+    invalidate_user(instance.pk, kwargs.get('using'))
+
+
+@receiver(post_delete, sender = django_settings.AUTH_USER_MODEL)
+def clear_user_sync_record(sender, instance, **kwargs):
+    """
+    Make sure the profile is fetched in full if a deleted user logs in again.
+    """
+    # The profiles module imports the OAuth stack, which is not imported until needed
+    from .profiles import clear_sync_record
+    clear_sync_record(instance.get_username())
+
+
+@receiver(setting_changed)
+def clear_cached_settings(sender, setting, **kwargs):
+    """
+    Clear any data derived from the settings when they change, e.g. in tests.
+    """
+    if setting in {'JASMIN_AUTH', 'ROOT_URLCONF'}:
+        clear_path_decisions()
+    if setting == 'JASMIN_AUTH':
+        from .oauth import reset_adapter
+        from .oidc import clear_documents
+        from .resilience import reset_guard
+        reset_adapter()
+        reset_guard()
+        clear_documents()
+        configure_metrics()
+
+
+@receiver(impersonation_started)
+def audit_impersonation_started(sender, impersonator, impersonatee, **kwargs):
+    """
+    Record an audit event when an impersonation is started.
+    """
+    if app_settings.AUDIT_IMPERSONATION:
+        audit.record(ImpersonationEvent.STARTED, impersonator, impersonatee, timezone.now())
+
+
+@receiver(impersonation_ended)
+def audit_impersonation_ended(sender, impersonator, impersonatee, **kwargs):
+    """
+    Record an audit event when an impersonation is ended.
+    """
+    if app_settings.AUDIT_IMPERSONATION:
+        audit.record(ImpersonationEvent.ENDED, impersonator, impersonatee, timezone.now())
+
+
+@receiver(user_logged_out)
+def unregister_impersonation(sender, request, **kwargs):
+    """
+    Remove any registered impersonation for the session when the user logs out.
+    """
+    if request is not None and hasattr(request, 'session'):
+        registry.unregister(request.session.session_key)
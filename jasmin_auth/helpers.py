@@ -1,4 +1,7 @@
+import functools
 import re
+import threading
+from collections import OrderedDict
 
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
@@ -7,12 +10,11 @@ from django.urls import resolve
 from .settings import app_settings
 
 
-def create_or_update_user(profile):
+def get_user_fields(profile):
     """
-    Creates or updates a user from the given profile using the
+    Returns a tuple of ``(username, user_fields)`` for the given profile using the
     mappings configured in the settings.
     """
-    UserModel = get_user_model()
     # Extract the username from the profile - this should always be present
     username = profile[app_settings.PROFILE_USERNAME_KEY]
     # Map the other fields as specified in the settings
@@ -20,16 +22,77 @@ def create_or_update_user(profile):
         user_field: profile.get(profile_key)
         for profile_key, user_field in app_settings.PROFILE_USER_MAPPING.items()
     }
+    return username, user_fields
+
+
+def update_user_fields(user, user_fields):
+    """
+    Sets the given fields on the user and returns the names of the fields that changed.
+    """
+    changed = []
+    for field, value in user_fields.items():
+        if getattr(user, field) != value:
+            setattr(user, field, value)
+            changed.append(field)
+    return changed
+
+
+def save_user_from_profile(profile):
+    """
+    Creates or updates a user from the given profile using the
+    mappings configured in the settings.
+
+    Existing users are only written to if one of the mapped fields has changed, and then
+    only the changed fields are saved.
+
+    Returns a tuple of ``(user, written)`` where ``written`` indicates whether the
+    user was written to the database.
+    """
+    UserModel = get_user_model()
+    username, user_fields = get_user_fields(profile)
     # Create or update the user
     # We don't use get_or_create because we want to use create_user in the case
     # where the user does not exist
     try:
         user = UserModel.objects.get(username = username)
-        for field, value in user_fields.items():
-            setattr(user, field, value)
-        user.save()
     except ObjectDoesNotExist:
-        user = UserModel.objects.create_user(username, **user_fields)
+        return UserModel.objects.create_user(username, **user_fields), True
+    changed = update_user_fields(user, user_fields)
+    if changed:
+        user.save(update_fields = changed)
+    return user, bool(changed)
+
+
+async def asave_user_from_profile(profile):
+    """
+    Async version of :py:func:`save_user_from_profile` that uses the async ORM interface.
+    """
+    UserModel = get_user_model()
+    username, user_fields = get_user_fields(profile)
+    try:
+        user = await UserModel.objects.aget(username = username)
+    except ObjectDoesNotExist:
+        return await UserModel.objects.acreate_user(username, **user_fields), True
+    changed = update_user_fields(user, user_fields)
+    if changed:
+        await user.asave(update_fields = changed)
+    return user, bool(changed)
+
+
+def create_or_update_user(profile):
+    """
+    Creates or updates a user from the given profile using the
+    mappings configured in the settings.
+    """
+    user, _ = save_user_from_profile(profile)
+    return user
+
+
+async def acreate_or_update_user(profile):
+    """
+    Async version of :py:func:`create_or_update_user` that uses the async ORM interface.
+    """
+    user, _ = await asave_user_from_profile(profile)
     return user
 
 
@@ -53,14 +116,82 @@ def impersonation_permitted_user(impersonator, impersonatee):
     return False
 
 
-def impersonation_permitted_request(request):
+# Matches numbered backreferences and conditionals, which refer to groups by position
+NUMBERED_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?\(')
+
+
+@functools.lru_cache(maxsize = None)
+def compile_disabled_patterns(patterns):
     """
-    Tests if impersonation is allowed for the given request.
+    Compiles the given tuple of patterns into a tuple of regular expressions.
+
+    Where possible, the patterns are combined into a single alternation so that a path
+    can be checked against all of them with one search.
+    """
+    if not patterns:
+        return ()
+    # Combining the patterns renumbers their groups, so patterns that refer to a group by
+    # its number would silently match different paths
+    if not any(
+        isinstance(pattern, str) and NUMBERED_GROUP_REFERENCE.search(pattern)
+        for pattern in patterns
+    ):
+        try:
+            return (re.compile('|'.join('(?:{})'.format(pattern) for pattern in patterns)), )
+        except (TypeError, re.error):
+            # Patterns that are already compiled or that use global flags cannot be combined
+            pass
+    return tuple(re.compile(pattern) for pattern in patterns)
+
+
+# LRU cache of (urlconf, path_info) => decision for impersonation_permitted_request
+_path_decisions = OrderedDict()
+_path_decisions_lock = threading.Lock()
+
+
+def clear_path_decisions():
+    """
+    Clears the cached impersonation decisions and compiled patterns.
+    """
+    with _path_decisions_lock:
+        _path_decisions.clear()
+    compile_disabled_patterns.cache_clear()
+
+
+def _impersonation_permitted_path(path_info, urlconf):
     """
-    # First, see if the request path matches any of the excluded paths
-    for pattern in app_settings.IMPERSONATE_DISABLED_PATTERNS:
-        if re.search(pattern, request.path_info) is not None:
-            return False
+    Tests if impersonation is allowed for the given path.
+    """
+    # First, see if the path matches any of the excluded patterns
+    patterns = compile_disabled_patterns(tuple(app_settings.IMPERSONATE_DISABLED_PATTERNS))
+    if any(pattern.search(path_info) is not None for pattern in patterns):
+        return False
     # Then check if the view has disabled impersonation using the decorator
-    view_func, *notused = resolve(request.path_info, getattr(request, 'urlconf', None))
+    view_func, *notused = resolve(path_info, urlconf)
     return not getattr(view_func, 'no_impersonation', False)
+
+
+def impersonation_permitted_request(request):
+    """
+    Tests if impersonation is allowed for the given request.
+
+    The decision for each path is cached, up to ``IMPERSONATE_PATH_CACHE_SIZE`` paths.
+    """
+    urlconf = getattr(request, 'urlconf', None)
+    maxsize = app_settings.IMPERSONATE_PATH_CACHE_SIZE
+    if not maxsize:
+        return _impersonation_permitted_path(request.path_info, urlconf)
+    key = (urlconf, request.path_info)
+    with _path_decisions_lock:
+        try:
+            _path_decisions.move_to_end(key)
+            return _path_decisions[key]
+        except KeyError:
+            pass
+    # Paths that do not resolve raise here, so are never cached
+    permitted = _impersonation_permitted_path(request.path_info, urlconf)
+    with _path_decisions_lock:
+        _path_decisions[key] = permitted
+        while len(_path_decisions) > maxsize:
+            _path_decisions.popitem(last = False)
+    return permitted
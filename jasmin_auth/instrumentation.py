@@ -0,0 +1,247 @@
+import bisect
+import threading
+import time
+
+from django.http import Http404, HttpResponse
+
+from .settings import app_settings
+from .signals import phase_timed
+
+
+#: The attribute of the request used to record when the callback view finished
+VIEW_FINISHED_ATTR = '_jasmin_auth_view_finished'
+
+#: The error codes that are used as outcomes when an exception has an ``error`` attribute
+#: These are the OAuth 2.0 and OpenID Connect error codes plus our own, so that a provider
+#: cannot create an unbounded number of series by returning arbitrary error codes
+ERROR_OUTCOMES = frozenset({
+    # RFC 6749
+    'invalid_request',
+    'unauthorized_client',
+    'access_denied',
+    'unsupported_response_type',
+    'invalid_scope',
+    'server_error',
+    'temporarily_unavailable',
+    'invalid_client',
+    'invalid_grant',
+    'unsupported_grant_type',
+    # OpenID Connect Core
+    'interaction_required',
+    'login_required',
+    'consent_required',
+    # Raised by oauthlib itself
+    'mismatching_state',
+    'missing_token',
+    'insecure_transport',
+    # jasmin_auth
+    'provider_unavailable',
+    'invalid_id_token',
+})
+
+
+def get_error_outcome(exc):
+    """
+    Returns the outcome for a phase that raised the given exception.
+    """
+    error = getattr(exc, 'error', None)
+    return error if error in ERROR_OUTCOMES else 'error'
+
+
+def escape_label_value(value):
+    """
+    Escapes the given value for use as a label value in the Prometheus text format.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Phase:
+    """
+    Context manager that times a phase and dispatches the ``phase_timed`` signal.
+
+    The outcome defaults to ``ok`` and can be changed by setting the ``outcome`` attribute
+    inside the block. If an exception is raised, the outcome is the ``error`` attribute of
+    the exception if it is a known error code, e.g. for an ``OAuth2Error``, or ``error``
+    otherwise.
+    """
+    __slots__ = ('name', 'outcome', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.outcome = 'ok'
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None and self.outcome == 'ok':
+            self.outcome = get_error_outcome(exc_value)
+        send(self.name, duration, self.outcome)
+        return False
+
+
+class NullPhase:
+    """
+    Context manager that does nothing, used when there are no receivers.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+def timed(name):
+    """
+    Returns a context manager that times the named phase.
+
+    If there are no receivers for the ``phase_timed`` signal, the returned context manager
+    does nothing so that the overhead is negligible.
+    """
+    # Checking the list directly avoids the overhead of has_listeners
+    return Phase(name) if phase_timed.receivers else NULL_PHASE
+
+
+def send(name, duration, outcome = 'ok'):
+    """
+    Dispatches the ``phase_timed`` signal for the given phase.
+    """
+    phase_timed.send(sender = None, phase = name, duration = duration, outcome = outcome)
+
+
+def mark_view_finished(request):
+    """
+    Records the time at which the view finished on the request, so that
+    :py:class:`~jasmin_auth.middleware.SessionTimingMiddleware` can time the
+    session save.
+    """
+    if phase_timed.receivers:
+        setattr(request, VIEW_FINISHED_ATTR, time.perf_counter())
+
+
+class MetricsCollector:
+    """
+    Receiver for the ``phase_timed`` signal that aggregates the durations and outcomes of
+    each phase in memory, for exposition in the Prometheus text format.
+
+    The metrics are per-process, so each worker process must be scraped separately.
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # phase => [bucket counts..., sum, count]
+            self.durations = {}
+            # (phase, outcome) => count
+            self.outcomes = {}
+
+    def receive(self, sender, phase, duration, outcome, **kwargs):
+        index = bisect.bisect_left(self.buckets, duration)
+        with self.lock:
+            try:
+                histogram = self.durations[phase]
+            except KeyError:
+                histogram = self.durations[phase] = [0] * (len(self.buckets) + 2)
+            # The bucket counts are not cumulative here - they are summed when rendered
+            if index < len(self.buckets):
+                histogram[index] += 1
+            histogram[-2] += duration
+            histogram[-1] += 1
+            key = (phase, outcome)
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        with self.lock:
+            durations = { phase: list(histogram) for phase, histogram in self.durations.items() }
+            outcomes = dict(self.outcomes)
+        lines = [
+            '# HELP jasmin_auth_phase_duration_seconds Duration of each login and request phase.',
+            '# TYPE jasmin_auth_phase_duration_seconds histogram',
+        ]
+        for phase, histogram in sorted(durations.items()):
+            phase = escape_label_value(phase)
+            cumulative = 0
+            for bucket, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append(
+                    'jasmin_auth_phase_duration_seconds_bucket{{phase="{}",le="{}"}} {}'.format(
+                        phase,
+                        bucket,
+                        cumulative
+                    )
+                )
+            lines.extend([
+                'jasmin_auth_phase_duration_seconds_bucket{{phase="{}",le="+Inf"}} {}'.format(
+                    phase,
+                    histogram[-1]
+                ),
+                'jasmin_auth_phase_duration_seconds_sum{{phase="{}"}} {}'.format(
+                    phase,
+                    histogram[-2]
+                ),
+                'jasmin_auth_phase_duration_seconds_count{{phase="{}"}} {}'.format(
+                    phase,
+                    histogram[-1]
+                ),
+            ])
+        lines.extend([
+            '# HELP jasmin_auth_phase_total Number of times each phase finished with each outcome.',
+            '# TYPE jasmin_auth_phase_total counter',
+        ])
+        for (phase, outcome), count in sorted(outcomes.items()):
+            lines.append(
+                'jasmin_auth_phase_total{{phase="{}",outcome="{}"}} {}'.format(
+                    escape_label_value(phase),
+                    escape_label_value(outcome),
+                    count
+                )
+            )
+        return '\n'.join(lines) + '\n'
+
+
+#: The collector used by the metrics view, if metrics are enabled
+collector = None
+
+
+def configure_metrics():
+    """
+    Connects or disconnects the metrics collector depending on ``METRICS_ENABLED``.
+    """
+    global collector
+    phase_timed.disconnect(dispatch_uid = 'jasmin_auth.metrics')
+    if app_settings.METRICS_ENABLED:
+        collector = MetricsCollector(app_settings.METRICS_BUCKETS)
+        phase_timed.connect(collector.receive, weak = False, dispatch_uid = 'jasmin_auth.metrics')
+    else:
+        collector = None
+
+
+def metrics(request):
+    """
+    View that renders the collected metrics in the Prometheus text format.
+
+    This view is not included in ``jasmin_auth.urls``, as it should usually be protected
+    or only exposed internally.
+    """
+    if collector is None:
+        raise Http404('Metrics are not enabled.')
+    return HttpResponse(
+        collector.render(),
+        content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from ... import registry
+
+
+class Command(BaseCommand):
+    """
+    Management command that removes stale entries from the impersonation registry.
+    """
+    help = (
+        'Removes entries from the impersonation registry whose session has expired or '
+        'no longer exists.'
+    )
+
+    def handle(self, *args, **options):
+        removed = registry.prune()
+        self.stdout.write('Removed {} impersonation registry entries.'.format(removed))
@@ -0,0 +1,320 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from asgiref.sync import async_to_sync, iscoroutinefunction
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from oauthlib.oauth2.rfc6749.errors import OAuth2Error
+
+from ...helpers import get_user_fields
+from ...oauth import get_client_session
+from ...settings import app_settings
+
+
+#: Status codes that indicate a problem with the portal rather than with a specific user
+SYSTEMIC_STATUS_CODES = {401, 403, 429, 502, 503, 504}
+
+
+def is_systemic(exc):
+    """
+    Returns true if the given error from fetching a profile means that no profiles can
+    be fetched, e.g. the portal is down or our token is not accepted.
+    """
+    # This includes ProviderUnavailable from the circuit breaker and token errors
+    if isinstance(exc, (OAuth2Error, requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(exc, 'response', None)
+    return response is not None and response.status_code in SYSTEMIC_STATUS_CODES
+
+
+class ProfileClient:
+    """
+    Fetches profiles from the identity provider using a client credentials token.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.session = get_client_session(app_settings.SYNC_SCOPES, workers)
+
+    def get(self, url, **kwargs):
+        response = self.session.get(url, **kwargs)
+        # If the token has expired, get a new one and try again
+        if response.status_code == 401:
+            token = self.session.token
+            with self.lock:
+                # Only refresh the token if another thread has not already done it
+                if self.session.token is token:
+                    self.session = get_client_session(app_settings.SYNC_SCOPES, self.workers)
+            response = self.session.get(url, **kwargs)
+        return response
+
+    def fetch_profile(self, username):
+        """
+        Returns the profile for the given username, or ``None`` if there is no such user.
+        """
+        url = app_settings.SYNC_PROFILE_URL.format(username = quote(username, safe = ''))
+        response = self.get(url)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def fetch_profiles(self, usernames):
+        """
+        Returns a dictionary of username => profile for the given usernames using the
+        bulk endpoint. Users that do not exist are not included.
+        """
+        response = self.get(
+            app_settings.SYNC_BULK_PROFILE_URL,
+            params = [('username', username) for username in usernames]
+        )
+        response.raise_for_status()
+        return {
+            profile[app_settings.PROFILE_USERNAME_KEY]: profile
+            for profile in response.json()
+        }
+
+
+class Command(BaseCommand):
+    """
+    Management command that updates local users from their JASMIN profiles.
+    """
+    help = (
+        'Updates local users from their JASMIN profiles and reports users that no '
+        'longer exist in the JASMIN accounts portal.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type = int,
+            default = app_settings.SYNC_CHUNK_SIZE,
+            help = 'The number of users to process in each transaction.'
+        )
+        parser.add_argument(
+            '--workers',
+            type = int,
+            default = app_settings.SYNC_WORKERS,
+            help = 'The number of concurrent requests to make.'
+        )
+        parser.add_argument(
+            '--start-after',
+            type = int,
+            default = None,
+            help = 'Only process users whose pk is greater than this value.'
+        )
+        parser.add_argument(
+            '--state-file',
+            default = None,
+            help = (
+                'File used to record progress. If it exists, processing resumes after '
+                'the last completed chunk.'
+            )
+        )
+        parser.add_argument(
+            '--all-users',
+            action = 'store_true',
+            help = (
+                'Process all users. By default, users with a usable password are assumed '
+                'to be local users and are skipped.'
+            )
+        )
+        parser.add_argument(
+            '--deactivate-missing',
+            action = 'store_true',
+            help = 'Mark users that no longer exist in the portal as inactive.'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action = 'store_true',
+            help = 'Fetch the profiles and report what would change without saving.'
+        )
+
+    def read_state(self, state_file):
+        if state_file and os.path.exists(state_file):
+            with open(state_file) as fh:
+                return int(fh.read().strip())
+        return None
+
+    def write_state(self, state_file, last_pk):
+        if state_file:
+            # Write to a temporary file and rename so the state is never half-written
+            with open(state_file + '.tmp', 'w') as fh:
+                fh.write(str(last_pk))
+            os.replace(state_file + '.tmp', state_file)
+
+    def fetch_profile(self, client, username):
+        """
+        Fetches the profile for a single user and returns a tuple of ``(profile, error)``.
+        """
+        try:
+            return client.fetch_profile(username), None
+        except Exception as exc:
+            return None, exc
+
+    def fetch_batch(self, client, usernames):
+        """
+        Fetches the profiles for a batch of users using the bulk endpoint and returns a
+        dictionary of username => ``(profile, error)``.
+        """
+        try:
+            profiles = client.fetch_profiles(usernames)
+        except Exception as exc:
+            # If profiles can also be fetched individually, do that so that one broken
+            # profile does not fail the whole batch
+            if app_settings.SYNC_PROFILE_URL:
+                return {
+                    username: self.fetch_profile(client, username)
+                    for username in usernames
+                }
+            return { username: (None, exc) for username in usernames }
+        return { username: (profiles.get(username), None) for username in usernames }
+
+    def fetch_chunk(self, client, executor, usernames, workers):
+        """
+        Fetches the profiles for a chunk of usernames concurrently and returns a
+        dictionary of username => ``(profile, error)``, where the profile is ``None``
+        for users that do not exist or whose profile could not be fetched.
+        """
+        if app_settings.SYNC_BULK_PROFILE_URL:
+            # Split the chunk into one batch per worker
+            size = max(1, -(-len(usernames) // workers))
+            batches = [usernames[i:i + size] for i in range(0, len(usernames), size)]
+            results = {}
+            for batch_results in executor.map(
+                lambda batch: self.fetch_batch(client, batch),
+                batches
+            ):
+                results.update(batch_results)
+            return results
+        else:
+            return dict(zip(
+                usernames,
+                executor.map(lambda username: self.fetch_profile(client, username), usernames)
+            ))
+
+    def get_changes(self, user, profile):
+        """
+        Returns a list of ``(field, old_value, new_value)`` for the fields of the user that
+        would be changed by the given profile, using ``PROFILE_USER_MAPPING``.
+        """
+        _, user_fields = get_user_fields(profile)
+        return [
+            (field, getattr(user, field), value)
+            for field, value in user_fields.items()
+            if getattr(user, field) != value
+        ]
+
+    def warn(self, message, *args):
+        self.stdout.write(self.style.WARNING(message.format(*args)))
+
+    def handle(self, *args, **options):
+        if not app_settings.SYNC_BULK_PROFILE_URL and not app_settings.SYNC_PROFILE_URL:
+            raise CommandError('One of SYNC_PROFILE_URL or SYNC_BULK_PROFILE_URL must be set.')
+        chunk_size = options['chunk_size']
+        workers = options['workers']
+        state_file = options['state_file']
+        dry_run = options['dry_run']
+        deactivate_missing = options['deactivate_missing']
+        # Work out where to start from
+        last_pk = options['start_after']
+        if last_pk is None:
+            last_pk = self.read_state(state_file)
+        # The function to create or update a user is a setting, and may be async
+        create_or_update_user = app_settings.CREATE_OR_UPDATE_USER_FUNC
+        if iscoroutinefunction(create_or_update_user):
+            create_or_update_user = async_to_sync(create_or_update_user)
+        UserModel = get_user_model()
+        queryset = UserModel.objects.order_by('pk')
+        if not options['all_users']:
+            queryset = queryset.filter(password__startswith = UNUSABLE_PASSWORD_PREFIX)
+        try:
+            client = ProfileClient(workers)
+        except Exception as exc:
+            raise CommandError('Error obtaining a token: {}'.format(exc))
+        synced = changed = missing = failed = 0
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            while True:
+                # Use the pk to page through the users so that each chunk is a cheap
+                # indexed query and we can resume from the last completed chunk
+                chunk_queryset = queryset
+                if last_pk is not None:
+                    chunk_queryset = chunk_queryset.filter(pk__gt = last_pk)
+                chunk = list(chunk_queryset[:chunk_size])
+                if not chunk:
+                    break
+                results = self.fetch_chunk(
+                    client,
+                    executor,
+                    [user.get_username() for user in chunk],
+                    workers
+                )
+                # Failures for individual users are reported and skipped, but if the
+                # problem is not with the users, e.g. the portal is down, stop and leave
+                # the state so that the next run resumes from this chunk
+                for _, error in results.values():
+                    if error is not None and is_systemic(error):
+                        raise CommandError(
+                            'Error fetching profiles after pk {}: {}'.format(last_pk, error)
+                        )
+                with transaction.atomic():
+                    for user in chunk:
+                        username = user.get_username()
+                        profile, error = results[username]
+                        if error is not None:
+                            failed += 1
+                            self.warn('Error fetching profile for user "{}": {}', username, error)
+                        elif profile is None:
+                            missing += 1
+                            self.warn('User "{}" does not exist in the portal.', username)
+                            if deactivate_missing and user.is_active:
+                                if dry_run:
+                                    self.stdout.write(
+                                        'Would deactivate user "{}".'.format(username)
+                                    )
+                                else:
+                                    # Use save so that cached data for the user is invalidated
+                                    user.is_active = False
+                                    user.save(update_fields = ['is_active'])
+                        elif dry_run:
+                            synced += 1
+                            changes = self.get_changes(user, profile)
+                            if changes:
+                                changed += 1
+                                self.stdout.write('Would update user "{}": {}'.format(
+                                    username,
+                                    ', '.join(
+                                        '{} {!r} -> {!r}'.format(*change) for change in changes
+                                    )
+                                ))
+                        else:
+                            try:
+                                # Use a savepoint so that a failure only affects this user
+                                with transaction.atomic():
+                                    create_or_update_user(profile)
+                            except Exception as exc:
+                                failed += 1
+                                self.warn('Error updating user "{}": {}', username, exc)
+                            else:
+                                synced += 1
+                last_pk = chunk[-1].pk
+                if not dry_run:
+                    self.write_state(state_file, last_pk)
+                if options['verbosity'] > 1:
+                    self.stdout.write('Processed users up to pk {}.'.format(last_pk))
+        # Once all the users have been processed, the next run should start from the beginning
+        if state_file and not dry_run and os.path.exists(state_file):
+            os.remove(state_file)
+        if dry_run:
+            summary = 'Found {} users, {} of which would change'.format(synced, changed)
+        else:
+            summary = 'Synchronised {} users'.format(synced)
+        summary += ', {} missing from the portal, {} failed.'.format(missing, failed)
+        self.stdout.write(self.style.WARNING(summary) if failed else self.style.SUCCESS(summary))
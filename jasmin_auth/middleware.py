@@ -1,49 +1,335 @@
-from django.contrib.auth import get_user_model
-from django.core.exceptions import ObjectDoesNotExist
+import functools
+import time
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.urls import Resolver404
+from django.utils.functional import SimpleLazyObject, cached_property
+
+from . import registry
+from .cache import (
+    get_impersonatee,
+    patch_identity_cache_control,
+    patch_identity_vary_headers,
+    set_identity_header
+)
+from .instrumentation import VIEW_FINISHED_ATTR, send, timed
 from .settings import app_settings
+from .snapshot import aget_user, get_user
 
 
-class ImpersonateMiddleware:
+class Impersonation:
     """
-    Middleware that allows a user with sufficient permissions to impersonate
-    another user.
+    Resolves the impersonation for a request the first time it is needed.
     """
-    def __init__(self, get_response):
-        self.get_response = get_response
+    def __init__(self, request, impersonated_pk):
+        self.request = request
+        # Keep hold of the authenticated user, which is usually also lazy
+        self.user = request.user
+        self.impersonated_pk = impersonated_pk
 
-    def __call__(self, request):
-        # Set default values for impersonator and impersonatee
-        request.impersonator = None
-        # Get the impersonated user pk from the session
-        impersonated_pk = request.session.get(app_settings.IMPERSONATE_SESSION_KEY)
-        # If the request is not impersonated, we are done
-        if not impersonated_pk:
-            return self.get_response(request)
+    @cached_property
+    def resolved(self):
+        """
+        Tuple of ``(user, impersonator, impersonatee)`` for the request.
+        """
+        with timed('impersonation') as phase:
+            user, impersonator, impersonatee = self.resolve()
+            if impersonator is not None:
+                phase.outcome = 'active'
+            elif impersonatee is not None:
+                phase.outcome = 'disabled'
+            else:
+                phase.outcome = 'inactive'
+        return user, impersonator, impersonatee
+
+    def resolve(self):
+        """
+        Resolves the impersonation and returns ``(user, impersonator, impersonatee)``.
+        """
+        user = self.user
         # If the user is not authenticated, we are done
-        if not request.user or not request.user.is_authenticated:
-            return self.get_response(request)
-        # Next, try to get the user that is being impersonated
-        User = get_user_model()
-        try:
-            impersonatee = User.objects.get(pk = impersonated_pk)
-        except ObjectDoesNotExist:
+        if not user or not user.is_authenticated:
+            return user, None, None
+        # Next, try to get the user that is being impersonated and check whether the
+        # impersonation is permitted (this may come from the cache)
+        impersonatee, permitted = get_impersonatee(user, self.impersonated_pk)
+        if impersonatee is None:
             # If the user does not exist, remove the key from the session so we don't
             # try again next time
-            del request.session[app_settings.IMPERSONATE_SESSION_KEY]
+            self.request.session.pop(app_settings.IMPERSONATE_SESSION_KEY, None)
             # Then we are done
-            return self.get_response(request)
+            return user, None, None
         # If the user is not permitted to impersonate the requested user, we are done
-        if not app_settings.IMPERSONATE_IS_PERMITTED_USER(request.user, impersonatee):
-            return self.get_response(request)
+        if not permitted:
+            return user, None, None
         # If we get to here then the impersonation would be permitted, however impersonation
         # might be disabled for the specific request
-        if app_settings.IMPERSONATE_IS_PERMITTED_REQUEST(request):
-            # In the case where impersonation is permitted, update the user for the request
-            request.impersonator = request.user
-            request.user = impersonatee
+        # The check may look at request.user, which is the lazy object that is being
+        # resolved, so make sure that it sees the authenticated user instead
+        lazy_user = self.request.user
+        self.request.user = user
+        try:
+            permitted_request = app_settings.IMPERSONATE_IS_PERMITTED_REQUEST(self.request)
+        except Resolver404:
+            # The check may resolve the path, which fails for unknown paths - as this may be
+            # happening while the 404 response is rendered, treat impersonation as disabled
+            permitted_request = False
+        finally:
+            self.request.user = lazy_user
+        if permitted_request:
+            # In the case where impersonation is permitted, the impersonatee becomes the
+            # user for the request
+            return impersonatee, user, None
         else:
             # In the case where impersonation is disabled for the request, we still
             # acknowledge that it could have happened by setting impersonatee
-            request.impersonatee = impersonatee
-        return self.get_response(request)
+            return user, None, impersonatee
+
+
+def resolved_attribute(name, index):
+    """
+    Returns a property for the request attribute with the given name that is taken from
+    the resolved impersonation unless it has been set explicitly.
+    """
+    def fget(request):
+        try:
+            return request.__dict__[name]
+        except KeyError:
+            return request._impersonation.resolved[index]
+    def fset(request, value):
+        request.__dict__[name] = value
+    return property(fget, fset)
+
+
+class ImpersonationRequestMixin:
+    """
+    Mixin for requests that have an impersonated user in the session.
+
+    ``impersonator`` and ``impersonatee`` are resolved on first access but, unlike lazy
+    objects, they are the users themselves or ``None``.
+    """
+    impersonator = resolved_attribute('impersonator', 1)
+    impersonatee = resolved_attribute('impersonatee', 2)
+
+
+@functools.lru_cache(maxsize = None)
+def get_impersonation_request_class(request_class):
+    """
+    Returns a subclass of the given request class that includes the impersonation mixin.
+    """
+    return type(request_class.__name__, (ImpersonationRequestMixin, request_class), {})
+
+
+class ImpersonateMiddleware:
+    """
+    Middleware that allows a user with sufficient permissions to impersonate
+    another user.
+
+    The impersonation is resolved lazily, so requests that never look at ``request.user``,
+    ``request.impersonator`` or ``request.impersonatee`` do not pay for it. To keep the
+    impersonator and impersonatee as users or ``None``, the class of impersonated requests
+    is changed to include :py:class:`ImpersonationRequestMixin`.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if self.is_exempt(request):
+            impersonated_pk = None
+        else:
+            # Get the impersonated user pk from the session
+            impersonated_pk = request.session.get(app_settings.IMPERSONATE_SESSION_KEY)
+        self.process_request(request, impersonated_pk)
+        response = self.get_response(request)
+        if self.session_key_changed(request, impersonated_pk):
+            registry.rekey(request, request.COOKIES[settings.SESSION_COOKIE_NAME])
+        return response
+
+    async def __acall__(self, request):
+        if self.is_exempt(request):
+            impersonated_pk = None
+        else:
+            # Loading the session may hit the database, so it must happen in a thread
+            impersonated_pk = await sync_to_async(request.session.get)(
+                app_settings.IMPERSONATE_SESSION_KEY
+            )
+        self.process_request(request, impersonated_pk)
+        response = await self.get_response(request)
+        if self.session_key_changed(request, impersonated_pk):
+            await sync_to_async(registry.rekey)(
+                request,
+                request.COOKIES[settings.SESSION_COOKIE_NAME]
+            )
+        return response
+
+    def is_exempt(self, request):
+        """
+        Returns ``True`` if the request cannot be impersonated without loading the session.
+        """
+        # Without a session cookie, the session is empty so there is nothing to load
+        if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+            return True
+        prefixes = app_settings.IMPERSONATE_EXEMPT_PATH_PREFIXES
+        return bool(prefixes) and request.path_info.startswith(tuple(prefixes))
+
+    def session_key_changed(self, request, impersonated_pk):
+        """
+        Returns true if the key of an impersonating session changed during the request,
+        e.g. because the key was cycled at login, so the registry entry must be moved.
+        """
+        # The session key is known without loading the session
+        return bool(impersonated_pk) and (
+            request.session.session_key != request.COOKIES[settings.SESSION_COOKIE_NAME]
+        )
+
+    def process_request(self, request, impersonated_pk):
+        # If the request is not impersonated, there is no impersonator or impersonatee
+        if not impersonated_pk:
+            request.impersonator = None
+            request.impersonatee = None
+            return
+        # Otherwise, resolve the impersonation on first access to the user, impersonator
+        # or impersonatee
+        impersonation = request._impersonation = Impersonation(request, impersonated_pk)
+        if not isinstance(request, ImpersonationRequestMixin):
+            request.__class__ = get_impersonation_request_class(request.__class__)
+        request.user = SimpleLazyObject(lambda: impersonation.resolved[0])
+        # Async code uses request.auser, which must also return the effective user
+        async def auser():
+            return (await sync_to_async(lambda: impersonation.resolved)())[0]
+        request.auser = auser
+
+
+class IdentityCacheMiddleware:
+    """
+    Middleware that varies all responses on both the effective user and the impersonator,
+    so that per-user caching can be used safely with impersonation.
+
+    It should come after ``ImpersonateMiddleware`` and before Django's
+    ``FetchFromCacheMiddleware``, and be used with ``IdentityCacheControlMiddleware``.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        set_identity_header(request)
+        response = self.get_response(request)
+        patch_identity_vary_headers(request, response)
+        return response
+
+    async def __acall__(self, request):
+        set_identity_header(request)
+        response = await self.get_response(request)
+        patch_identity_vary_headers(request, response)
+        return response
+
+
+class IdentityCacheControlMiddleware:
+    """
+    Middleware that marks responses for authenticated users as private, so that downstream
+    caches do not share them between users.
+
+    It should come before Django's ``UpdateCacheMiddleware``, as Django does not cache
+    private responses.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        patch_identity_cache_control(request, response)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        # Checking the user may need to load it
+        await sync_to_async(patch_identity_cache_control)(request, response)
+        return response
+
+
+class SessionTimingMiddleware:
+    """
+    Middleware that times the session save after a login, which happens after the
+    callback view has returned.
+
+    It should come immediately before Django's ``SessionMiddleware``. The timing also
+    includes the response processing of any middleware in between.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        self.process_response(request)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        self.process_response(request)
+        return response
+
+    def process_response(self, request):
+        # The attribute is only set by the login views when there are receivers
+        finished = getattr(request, VIEW_FINISHED_ATTR, None)
+        if finished is not None:
+            send('session_save', time.perf_counter() - finished)
+
+
+class SnapshotAuthenticationMiddleware(AuthenticationMiddleware):
+    """
+    Replacement for Django's ``AuthenticationMiddleware`` that serves the user from the
+    snapshot stored in the session at login, if ``USER_SNAPSHOT`` is set, instead of
+    loading it from the database on every request.
+
+    If the snapshot is missing or stale, the user is loaded in the usual way and the
+    snapshot is refreshed.
+    """
+    def process_request(self, request):
+        super().process_request(request)
+        if not app_settings.USER_SNAPSHOT:
+            return
+        def get_cached_user():
+            if not hasattr(request, '_cached_user'):
+                request._cached_user = get_user(request)
+            return request._cached_user
+        async def auser():
+            if not hasattr(request, '_acached_user'):
+                request._acached_user = await aget_user(request)
+            return request._acached_user
+        request.user = SimpleLazyObject(get_cached_user)
+        request.auser = auser
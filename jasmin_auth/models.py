@@ -0,0 +1,102 @@
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+
+class ImpersonationEvent(models.Model):
+    """
+    Audit record for an impersonation starting or ending.
+
+    These are only recorded if the tsunami application is not installed.
+    """
+    #: The event type for an impersonation starting
+    STARTED = 'jasmin_auth.user_impersonated'
+    #: The event type for an impersonation ending
+    ENDED = 'jasmin_auth.user_impersonation_ended'
+
+    event_type = models.CharField(
+        max_length = 100,
+        choices = [(STARTED, 'Impersonation started'), (ENDED, 'Impersonation ended')]
+    )
+    impersonator = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        models.SET_NULL,
+        null = True,
+        related_name = '+'
+    )
+    impersonatee = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        models.SET_NULL,
+        null = True,
+        related_name = '+'
+    )
+    created_at = models.DateTimeField(default = timezone.now, db_index = True)
+
+    class Meta:
+        ordering = ('-created_at', )
+
+    def __str__(self):
+        return '{} - {} impersonating {}'.format(
+            self.get_event_type_display(),
+            self.impersonator,
+            self.impersonatee
+        )
+
+
+class ActiveImpersonationQuerySet(models.QuerySet):
+    """
+    Query set for active impersonations.
+    """
+    def active(self):
+        """
+        Filters the query set to impersonations whose session has not expired.
+
+        If ``SESSION_SAVE_EVERY_REQUEST`` is set, the expiry of a session is extended on
+        every request, so the recorded expiry is ignored and all entries are returned.
+        """
+        if settings.SESSION_SAVE_EVERY_REQUEST:
+            return self.all()
+        return self.filter(expires_at__gt = timezone.now())
+
+    def expired(self):
+        """
+        Filters the query set to impersonations whose session has expired.
+
+        If ``SESSION_SAVE_EVERY_REQUEST`` is set, the recorded expiry is ignored and no
+        entries are returned.
+        """
+        if settings.SESSION_SAVE_EVERY_REQUEST:
+            return self.none()
+        return self.filter(expires_at__lte = timezone.now())
+
+
+class ActiveImpersonation(models.Model):
+    """
+    Registry entry for an impersonation that is active in a session.
+
+    This allows active impersonations to be listed and revoked without decoding every
+    session. Entries are maintained by the admin views that start and end impersonation,
+    and are moved by ``ImpersonateMiddleware`` when the session key changes.
+    """
+    session_key = models.CharField(max_length = 40, unique = True)
+    impersonator = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        models.CASCADE,
+        related_name = '+'
+    )
+    impersonatee = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        models.CASCADE,
+        related_name = '+'
+    )
+    started_at = models.DateTimeField(default = timezone.now)
+    #: The expiry of the session, as of the time the impersonation started
+    expires_at = models.DateTimeField(db_index = True)
+
+    objects = ActiveImpersonationQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('-started_at', )
+
+    def __str__(self):
+        return '{} impersonating {}'.format(self.impersonator, self.impersonatee)
@@ -0,0 +1,279 @@
+import asyncio
+import functools
+import threading
+import weakref
+
+from django.core import signing
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare, get_random_string, salted_hmac
+
+from oauthlib.common import urldecode
+from oauthlib.oauth2 import BackendApplicationClient, WebApplicationClient
+from oauthlib.oauth2.rfc6749.errors import InsecureTransportError, MismatchingStateError
+from oauthlib.oauth2.rfc6749.utils import is_secure_transport
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth2Session
+from urllib3.util.retry import Retry
+
+from .resilience import get_guard
+from .settings import app_settings
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter that applies a default timeout to requests that do not specify one.
+
+    Requests are also subject to the concurrency limit and circuit breaker, if configured.
+    """
+    def __init__(self, *args, timeout = None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout = None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return get_guard().call(
+            functools.partial(super().send, request, timeout = timeout, **kwargs)
+        )
+
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def make_adapter(pool_maxsize = None):
+    """
+    Returns a new HTTP adapter for talking to the identity provider, configured using
+    the settings.
+    """
+    return TimeoutHTTPAdapter(
+        pool_connections = app_settings.HTTP_POOL_CONNECTIONS,
+        pool_maxsize = pool_maxsize or app_settings.HTTP_POOL_MAXSIZE,
+        # By default, urllib3 only retries reads and status codes for
+        # idempotent methods, so the token exchange is never sent twice
+        max_retries = Retry(
+            total = app_settings.HTTP_MAX_RETRIES,
+            backoff_factor = app_settings.HTTP_RETRY_BACKOFF,
+            status_forcelist = (502, 503, 504),
+            raise_on_status = False
+        ),
+        timeout = (
+            app_settings.HTTP_CONNECT_TIMEOUT,
+            app_settings.HTTP_READ_TIMEOUT
+        )
+    )
+
+
+def get_adapter():
+    """
+    Returns the process-wide HTTP adapter used to talk to the identity provider.
+
+    The adapter holds a pool of keep-alive connections that is shared by all requests,
+    so that the TLS handshake is not repeated for every token exchange and profile fetch.
+    """
+    global _adapter
+    if _adapter is None:
+        with _adapter_lock:
+            if _adapter is None:
+                _adapter = make_adapter()
+    return _adapter
+
+
+def reset_adapter():
+    """
+    Closes the process-wide HTTP adapter so that it is recreated on next use.
+    """
+    global _adapter
+    with _adapter_lock:
+        if _adapter is not None:
+            _adapter.close()
+        _adapter = None
+        # Async clients can only be closed from their event loop, so just drop them
+        _async_clients.clear()
+
+
+def get_async_client():
+    """
+    Returns the async HTTP client used to talk to the identity provider from async views.
+
+    Connections cannot be shared between event loops, so there is one client per loop.
+    """
+    import httpx
+    loop = asyncio.get_running_loop()
+    try:
+        return _async_clients[loop]
+    except KeyError:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            timeout = httpx.Timeout(
+                app_settings.HTTP_READ_TIMEOUT,
+                connect = app_settings.HTTP_CONNECT_TIMEOUT
+            ),
+            transport = httpx.AsyncHTTPTransport(
+                verify = app_settings.VERIFY_SSL,
+                limits = httpx.Limits(
+                    max_keepalive_connections = app_settings.HTTP_POOL_MAXSIZE
+                ),
+                # httpx only retries connection errors, which is safe for all requests
+                retries = app_settings.HTTP_MAX_RETRIES
+            )
+        )
+        return client
+
+
+def get_redirect_uri(request):
+    """
+    Returns the absolute URI of the callback view for the given request.
+    """
+    return request.build_absolute_uri(reverse('jasmin_auth:callback'))
+
+
+def get_provider(request, **kwargs):
+    """
+    Returns an OAuth 2.0 session for the given request.
+
+    The OAuth state belongs to the session, so a new session is created for each request,
+    but all sessions share the same connection pool.
+    """
+    provider = OAuth2Session(
+        app_settings.CLIENT_ID,
+        redirect_uri = get_redirect_uri(request),
+        scope = ' '.join(app_settings.SCOPES),
+        **kwargs
+    )
+    adapter = get_adapter()
+    provider.mount('https://', adapter)
+    provider.mount('http://', adapter)
+    return provider
+
+
+STATE_SALT = 'jasmin_auth.oauth.state'
+
+
+def _hash_nonce(nonce):
+    return salted_hmac(STATE_SALT, nonce).hexdigest()
+
+
+def make_state(next_url):
+    """
+    Returns a tuple of ``(state, nonce)`` for a stateless login.
+
+    The state is a signed, time-limited token containing the next URL and a hash of the
+    nonce. The nonce is stored in a cookie, which binds the state to the browser in the
+    same way as storing the state in the session.
+    """
+    nonce = get_random_string(32)
+    state = signing.dumps(
+        dict(n = _hash_nonce(nonce), u = next_url),
+        salt = STATE_SALT,
+        compress = True
+    )
+    return state, nonce
+
+
+def load_state(request):
+    """
+    Verifies the state for a stateless login and returns a tuple of
+    ``(state, next_url)``.
+
+    Raises ``MismatchingStateError`` if the state is invalid, has expired or does not
+    match the nonce cookie.
+    """
+    state = request.GET.get('state', '')
+    nonce = request.COOKIES.get(app_settings.STATE_COOKIE_NAME, '')
+    try:
+        payload = signing.loads(state, salt = STATE_SALT, max_age = app_settings.STATE_MAX_AGE)
+    except signing.BadSignature:
+        raise MismatchingStateError()
+    if not nonce or not constant_time_compare(payload['n'], _hash_nonce(nonce)):
+        raise MismatchingStateError()
+    return state, payload['u']
+
+
+def set_state_cookie(response, request, nonce):
+    """
+    Sets the nonce cookie for a stateless login on the response.
+    """
+    response.set_cookie(
+        app_settings.STATE_COOKIE_NAME,
+        nonce,
+        max_age = app_settings.STATE_MAX_AGE,
+        path = reverse('jasmin_auth:callback'),
+        secure = request.is_secure(),
+        httponly = True,
+        # Lax cookies are sent on the top-level redirect back from the provider
+        samesite = 'Lax'
+    )
+
+
+def delete_state_cookie(response):
+    """
+    Deletes the nonce cookie for a stateless login.
+    """
+    response.delete_cookie(
+        app_settings.STATE_COOKIE_NAME,
+        path = reverse('jasmin_auth:callback'),
+        samesite = 'Lax'
+    )
+
+
+def get_client_session(scopes, pool_maxsize = None):
+    """
+    Returns an OAuth 2.0 session that is authenticated as the client itself, using the
+    client credentials grant, for making server-to-server requests.
+
+    The session has its own connection pool of the given size.
+    """
+    provider = OAuth2Session(
+        client = BackendApplicationClient(client_id = app_settings.CLIENT_ID),
+        scope = ' '.join(scopes)
+    )
+    adapter = make_adapter(pool_maxsize)
+    provider.mount('https://', adapter)
+    provider.mount('http://', adapter)
+    provider.fetch_token(
+        app_settings.ACCESS_TOKEN_URL,
+        client_secret = app_settings.CLIENT_SECRET,
+        verify = app_settings.VERIFY_SSL
+    )
+    return provider
+
+
+async def afetch_token(request, state):
+    """
+    Async equivalent of ``OAuth2Session.fetch_token`` for the callback request.
+
+    Returns an oauthlib client that holds the token.
+    """
+    if not is_secure_transport(app_settings.ACCESS_TOKEN_URL):
+        raise InsecureTransportError()
+    client = WebApplicationClient(app_settings.CLIENT_ID)
+    # Extract the code from the callback URL, checking the state
+    client.parse_request_uri_response(request.build_absolute_uri(), state = state)
+    # Like OAuth2Session, send the client credentials using basic auth
+    body = client.prepare_request_body(
+        code = client.code,
+        redirect_uri = get_redirect_uri(request),
+        include_client_id = False
+    )
+    response = await get_guard().acall(
+        functools.partial(
+            get_async_client().post,
+            app_settings.ACCESS_TOKEN_URL,
+            data = dict(urldecode(body)),
+            auth = (app_settings.CLIENT_ID, app_settings.CLIENT_SECRET),
+            headers = {'Accept': 'application/json'}
+        )
+    )
+    client.parse_request_body_response(response.text, scope = ' '.join(app_settings.SCOPES))
+    return client
+
+
+async def aget(client, url, headers = None):
+    """
+    Makes a GET request to the given URL using the token held by the oauthlib client.
+    """
+    url, headers, _ = client.add_token(url, headers = headers)
+    return await get_guard().acall(
+        functools.partial(get_async_client().get, url, headers = headers)
+    )
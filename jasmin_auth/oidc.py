@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+
+import requests
+
+from .cache import get_cache, make_key
+from .oauth import get_adapter
+from .settings import app_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class IdTokenError(Exception):
+    """
+    Raised when an ID token fails verification.
+    """
+    #: The error code, which is used as the outcome of the timed phase
+    error = 'invalid_id_token'
+
+
+# In-memory copies of the documents fetched from the provider
+# This avoids a cache round trip for every login
+_documents = {}
+_documents_lock = threading.Lock()
+_last_jwks_refresh = 0
+# Set while a thread is fetching the keys after a key ID miss
+_jwks_refresh = None
+
+
+def clear_documents():
+    """
+    Clears the in-memory copies of the provider documents.
+    """
+    global _last_jwks_refresh, _jwks_refresh
+    with _documents_lock:
+        _documents.clear()
+        _last_jwks_refresh = 0
+        _jwks_refresh = None
+
+
+def fetch_json(url):
+    """
+    Fetches the JSON document at the given URL using the shared connection pool.
+    """
+    session = requests.Session()
+    session.mount('https://', get_adapter())
+    session.mount('http://', get_adapter())
+    response = session.get(url, verify = app_settings.VERIFY_SSL)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_document(name, loader, refresh = False):
+    """
+    Returns the named document, using the in-memory copy or the Django cache if possible
+    and calling the loader otherwise.
+    """
+    timeout = app_settings.OIDC_CACHE_TIMEOUT
+    key = make_key('oidc', name)
+    if not refresh:
+        try:
+            expires, value = _documents[name]
+        except KeyError:
+            pass
+        else:
+            if expires > time.monotonic():
+                return value
+        value = get_cache().get(key)
+        if value is not None:
+            _documents[name] = (time.monotonic() + timeout, value)
+            return value
+    value = loader()
+    get_cache().set(key, value, timeout)
+    _documents[name] = (time.monotonic() + timeout, value)
+    return value
+
+
+def get_provider_metadata():
+    """
+    Returns the OpenID Connect discovery metadata for the provider.
+    """
+    return get_document('metadata', lambda: fetch_json(app_settings.OIDC_DISCOVERY_URL))
+
+
+def get_jwks(refresh = False):
+    """
+    Returns a dictionary of key ID => JWK for the provider's signing keys.
+    """
+    def load():
+        url = app_settings.OIDC_JWKS_URL or get_provider_metadata()['jwks_uri']
+        return { jwk.get('kid'): jwk for jwk in fetch_json(url)['keys'] }
+    return get_document('jwks', load, refresh)
+
+
+def get_signing_key(kid):
+    """
+    Returns the JWK for the given key ID, refreshing the keys if the key ID is not known.
+    """
+    global _last_jwks_refresh, _jwks_refresh
+    keys = get_jwks()
+    if kid not in keys:
+        # The provider may have rotated its keys, so refresh them
+        # To avoid tokens with bogus key IDs causing a refresh every time, refreshes are
+        # rate-limited, in which case we use whatever keys another thread has fetched
+        # The lock is only held to decide which thread does the refresh, so that a slow
+        # provider does not block other threads
+        with _documents_lock:
+            refresh = _jwks_refresh
+            since_refresh = time.monotonic() - _last_jwks_refresh
+            refreshing = (
+                refresh is None and
+                since_refresh >= app_settings.OIDC_JWKS_MIN_REFRESH_INTERVAL
+            )
+            if refreshing:
+                _last_jwks_refresh = time.monotonic()
+                refresh = _jwks_refresh = threading.Event()
+        if refreshing:
+            try:
+                keys = get_jwks(refresh = True)
+            finally:
+                with _documents_lock:
+                    _jwks_refresh = None
+                refresh.set()
+        else:
+            # If another thread is fetching the keys, wait for it to finish
+            if refresh is not None:
+                refresh.wait(app_settings.HTTP_CONNECT_TIMEOUT + app_settings.HTTP_READ_TIMEOUT)
+            keys = get_jwks()
+    try:
+        return keys[kid]
+    except KeyError:
+        raise IdTokenError('Unknown signing key "{}".'.format(kid))
+
+
+def decode_id_token(id_token):
+    """
+    Verifies the given ID token and returns the claims.
+    """
+    import jwt
+    try:
+        header = jwt.get_unverified_header(id_token)
+        key = jwt.PyJWK(get_signing_key(header.get('kid'))).key
+        return jwt.decode(
+            id_token,
+            key = key,
+            algorithms = list(app_settings.ID_TOKEN_ALGORITHMS),
+            audience = app_settings.CLIENT_ID,
+            issuer = app_settings.OIDC_ISSUER or get_provider_metadata()['issuer'],
+            leeway = app_settings.ID_TOKEN_LEEWAY,
+            options = dict(require = ['exp', 'iat', 'iss', 'aud', 'sub'])
+        )
+    except jwt.PyJWTError as exc:
+        raise IdTokenError(str(exc)) from exc
+
+
+def get_id_token_claims(token):
+    """
+    Returns the verified claims from the ID token in the given token response.
+
+    Returns ``None`` if the response has no ID token or the provider's keys could not be
+    fetched, in which case the profile should be fetched instead.
+
+    Raises :py:class:`IdTokenError` if the ID token is not valid.
+    """
+    id_token = token.get('id_token')
+    if not id_token:
+        return None
+    try:
+        return decode_id_token(id_token)
+    except requests.RequestException:
+        logger.exception('Error fetching provider keys - falling back to profile')
+        return None
+
+
+def get_profile_from_claims(claims):
+    """
+    Returns a profile built from the given ID token claims.
+
+    Returns ``None`` if there are no claims or the claims do not include all the profile
+    keys that are needed to create a user, in which case the profile should be fetched
+    instead.
+    """
+    if claims is None:
+        return None
+    profile = {
+        profile_key: claims[claim]
+        for claim, profile_key in app_settings.ID_TOKEN_CLAIM_MAPPING.items()
+        if claim in claims
+    }
+    required = { app_settings.PROFILE_USERNAME_KEY, *app_settings.PROFILE_USER_MAPPING }
+    if not required.issubset(profile):
+        return None
+    return profile
@@ -0,0 +1,269 @@
+import time
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
+
+from .cache import get_cache, make_key
+from .instrumentation import timed
+from .oauth import aget
+from .oidc import get_id_token_claims, get_profile_from_claims
+from .resilience import ProviderUnavailable
+from .settings import app_settings
+
+
+def sync_tracking_enabled():
+    """
+    Returns true if the time and ETag of each profile sync should be recorded.
+    """
+    return bool(
+        app_settings.PROFILE_FRESHNESS_WINDOW or
+        app_settings.PROFILE_CONDITIONAL_REQUESTS
+    )
+
+
+def sync_record_key(username):
+    """
+    Returns the cache key for the sync record of the given username.
+    """
+    return make_key('profile_sync', username)
+
+
+def get_token_username(token, claims = None):
+    """
+    Returns the username for the given token response and verified ID token claims, or
+    ``None`` if the user cannot be identified without fetching the profile.
+    """
+    if not sync_tracking_enabled():
+        return None
+    if app_settings.TOKEN_USERNAME_KEY and token.get(app_settings.TOKEN_USERNAME_KEY):
+        return token[app_settings.TOKEN_USERNAME_KEY]
+    if claims:
+        claim = next(
+            (
+                claim
+                for claim, profile_key in app_settings.ID_TOKEN_CLAIM_MAPPING.items()
+                if profile_key == app_settings.PROFILE_USERNAME_KEY
+            ),
+            None
+        )
+        return claims.get(claim)
+    return None
+
+
+def get_sync_record(username):
+    """
+    Returns the record of the last profile sync for the given username, if there is one.
+
+    The record is a dictionary containing the time of the sync and the ETag of the profile.
+    """
+    if not username or not sync_tracking_enabled():
+        return None
+    return get_cache().get(sync_record_key(username))
+
+
+def record_sync(username, etag = None):
+    """
+    Records that the profile for the given username has just been synced.
+    """
+    if username and sync_tracking_enabled():
+        get_cache().set(
+            sync_record_key(username),
+            dict(synced_at = time.time(), etag = etag),
+            None
+        )
+
+
+def clear_sync_record(username):
+    """
+    Removes the sync record for the given username, so that the next login fetches the
+    profile unconditionally.
+    """
+    if sync_tracking_enabled():
+        get_cache().delete(sync_record_key(username))
+
+
+def is_fresh(record):
+    """
+    Returns true if the given sync record is within the freshness window.
+    """
+    window = app_settings.PROFILE_FRESHNESS_WINDOW
+    return bool(window and record and time.time() - record['synced_at'] < window)
+
+
+def get_conditional_headers(record):
+    """
+    Returns the headers for a conditional profile request based on the given sync record.
+    """
+    if app_settings.PROFILE_CONDITIONAL_REQUESTS and record and record.get('etag'):
+        return { 'If-None-Match': record['etag'] }
+    else:
+        return {}
+
+
+def get_response_outcome(response):
+    """
+    Returns the outcome of a profile request for the purposes of instrumentation.
+    """
+    if response.status_code == 304:
+        return 'not_modified'
+    elif response.status_code >= 400:
+        return 'http_{}'.format(response.status_code)
+    else:
+        return 'ok'
+
+
+def check_profile_response(response):
+    """
+    Raises :py:class:`~jasmin_auth.resilience.ProviderUnavailable` if the given profile
+    response is not successful.
+    """
+    if not 200 <= response.status_code < 300:
+        raise ProviderUnavailable(
+            'The provider returned status {} for the profile.'.format(response.status_code)
+        )
+
+
+def get_local_user(username):
+    """
+    Returns the local user with the given username, or ``None`` if there is no such user.
+    """
+    try:
+        return get_user_model().objects.get(username = username)
+    except ObjectDoesNotExist:
+        return None
+
+
+async def aget_local_user(username):
+    """
+    Async version of :py:func:`get_local_user`.
+    """
+    try:
+        return await get_user_model().objects.aget(username = username)
+    except ObjectDoesNotExist:
+        return None
+
+
+def get_user_for_token(provider, token):
+    """
+    Returns the local user for the given token response, creating or updating it from
+    the user's profile if required.
+
+    If the profile was synced within ``PROFILE_FRESHNESS_WINDOW``, the existing local user
+    is returned without fetching the profile. Otherwise, if ``PROFILE_CONDITIONAL_REQUESTS``
+    is set and the profile has not changed since it was last fetched, the local user is
+    returned without being updated.
+
+    Raises :py:class:`~jasmin_auth.oidc.IdTokenError` if the ID token is not valid and
+    :py:class:`~jasmin_auth.resilience.ProviderUnavailable` if the profile cannot be fetched.
+    """
+    # If enabled, verify the ID token once and use the claims to identify the user and
+    # to build the profile without a request
+    claims = profile = etag = None
+    if app_settings.ID_TOKEN_PROFILE:
+        with timed('id_token') as phase:
+            claims = get_id_token_claims(token)
+            profile = get_profile_from_claims(claims)
+            if profile is None:
+                phase.outcome = 'fallback'
+    username = get_token_username(token, claims)
+    record = get_sync_record(username)
+    if is_fresh(record):
+        with timed('create_or_update_user') as phase:
+            phase.outcome = 'fresh'
+            user = get_local_user(username)
+            if user is not None:
+                return user
+            # The user has been deleted locally since the last sync
+            phase.outcome = 'missing'
+    if profile is None:
+        with timed('fetch_profile') as phase:
+            response = provider.get(
+                app_settings.PROFILE_URL,
+                headers = get_conditional_headers(record)
+            )
+            phase.outcome = get_response_outcome(response)
+        if response.status_code == 304:
+            # The profile has not changed since the last sync, so neither has the user
+            # If the record or the user has gone, e.g. because the record was evicted from
+            # the cache, treat it as a miss and fetch the profile unconditionally
+            user = None
+            if record is not None:
+                with timed('create_or_update_user') as phase:
+                    phase.outcome = 'not_modified'
+                    user = get_local_user(username)
+            if user is not None:
+                record_sync(username, response.headers.get('ETag') or record['etag'])
+                return user
+            with timed('fetch_profile') as phase:
+                response = provider.get(app_settings.PROFILE_URL)
+                phase.outcome = get_response_outcome(response)
+        check_profile_response(response)
+        etag = response.headers.get('ETag')
+        profile = response.json()
+    # The function to create or update a user is a setting, and may be async
+    create_or_update_user = app_settings.CREATE_OR_UPDATE_USER_FUNC
+    if iscoroutinefunction(create_or_update_user):
+        create_or_update_user = async_to_sync(create_or_update_user)
+    with timed('create_or_update_user'):
+        user = create_or_update_user(profile)
+    record_sync(profile[app_settings.PROFILE_USERNAME_KEY], etag)
+    return user
+
+
+async def aget_user_for_token(client, token):
+    """
+    Async version of :py:func:`get_user_for_token` that takes an oauthlib client.
+    """
+    claims = profile = etag = None
+    if app_settings.ID_TOKEN_PROFILE:
+        with timed('id_token') as phase:
+            # Verifying the ID token may need to fetch the provider's keys
+            claims = await sync_to_async(get_id_token_claims)(token)
+            profile = get_profile_from_claims(claims)
+            if profile is None:
+                phase.outcome = 'fallback'
+    username = get_token_username(token, claims)
+    record = await sync_to_async(get_sync_record)(username)
+    if is_fresh(record):
+        with timed('create_or_update_user') as phase:
+            phase.outcome = 'fresh'
+            user = await aget_local_user(username)
+            if user is not None:
+                return user
+            phase.outcome = 'missing'
+    if profile is None:
+        with timed('fetch_profile') as phase:
+            response = await aget(
+                client,
+                app_settings.PROFILE_URL,
+                get_conditional_headers(record)
+            )
+            phase.outcome = get_response_outcome(response)
+        if response.status_code == 304:
+            user = None
+            if record is not None:
+                with timed('create_or_update_user') as phase:
+                    phase.outcome = 'not_modified'
+                    user = await aget_local_user(username)
+            if user is not None:
+                await sync_to_async(record_sync)(
+                    username,
+                    response.headers.get('ETag') or record['etag']
+                )
+                return user
+            with timed('fetch_profile') as phase:
+                response = await aget(client, app_settings.PROFILE_URL)
+                phase.outcome = get_response_outcome(response)
+        check_profile_response(response)
+        etag = response.headers.get('ETag')
+        profile = response.json()
+    # The function to create or update a user is a setting, and may be sync
+    create_or_update_user = app_settings.CREATE_OR_UPDATE_USER_FUNC
+    if not iscoroutinefunction(create_or_update_user):
+        create_or_update_user = sync_to_async(create_or_update_user)
+    with timed('create_or_update_user'):
+        user = await create_or_update_user(profile)
+    await sync_to_async(record_sync)(profile[app_settings.PROFILE_USERNAME_KEY], etag)
+    return user
@@ -0,0 +1,123 @@
+from importlib import import_module
+
+from django.conf import settings as django_settings
+from django.db import transaction
+
+from .models import ActiveImpersonation
+from .settings import app_settings
+from .signals import impersonation_ended
+
+
+#: The session engine that stores the session in the cookie, whose sessions cannot be
+#: looked up or modified by key
+SIGNED_COOKIES_ENGINE = 'django.contrib.sessions.backends.signed_cookies'
+
+
+def registry_enabled():
+    """
+    Returns true if active impersonations are recorded in the registry.
+
+    The registry is not maintained for signed cookie sessions, as they cannot be revoked.
+    """
+    return (
+        app_settings.IMPERSONATION_REGISTRY and
+        django_settings.SESSION_ENGINE != SIGNED_COOKIES_ENGINE
+    )
+
+
+def register(request, impersonator, impersonatee, previous_session_key = None):
+    """
+    Records that the session of the given request is impersonating the given user.
+
+    If the session key was changed when the impersonation started, the previous key
+    should also be given so that any entry for it is removed.
+    """
+    if not registry_enabled():
+        return
+    with transaction.atomic():
+        if previous_session_key:
+            ActiveImpersonation.objects.filter(session_key = previous_session_key).delete()
+        ActiveImpersonation.objects.update_or_create(
+            session_key = request.session.session_key,
+            defaults = dict(
+                impersonator = impersonator,
+                impersonatee = impersonatee,
+                expires_at = request.session.get_expiry_date()
+            )
+        )
+
+
+def unregister(session_key):
+    """
+    Removes any registry entry for the given session key.
+    """
+    if registry_enabled() and session_key:
+        ActiveImpersonation.objects.filter(session_key = session_key).delete()
+
+
+def rekey(request, previous_session_key):
+    """
+    Moves any registry entry for the previous session key to the current key of the
+    session of the given request, e.g. when the key is cycled at login.
+
+    If the session is no longer impersonating, e.g. because it was flushed when a
+    different user logged in, the entry is removed instead.
+    """
+    if not registry_enabled() or not previous_session_key:
+        return
+    session_key = request.session.session_key
+    if session_key and request.session.get(app_settings.IMPERSONATE_SESSION_KEY):
+        ActiveImpersonation.objects.filter(session_key = previous_session_key).update(
+            session_key = session_key,
+            expires_at = request.session.get_expiry_date()
+        )
+    else:
+        unregister(previous_session_key)
+
+
+def prune():
+    """
+    Removes the registry entries for sessions that have expired or no longer exist, and
+    returns the number of entries removed.
+    """
+    if not registry_enabled():
+        return 0
+    removed, _ = ActiveImpersonation.objects.expired().delete()
+    # Sessions may also have been deleted before they expired, e.g. by clearsessions or
+    # a password change
+    SessionStore = import_module(django_settings.SESSION_ENGINE).SessionStore
+    gone = [
+        session_key
+        for session_key in ActiveImpersonation.objects.values_list('session_key', flat = True)
+        if not SessionStore().exists(session_key)
+    ]
+    if gone:
+        deleted, _ = ActiveImpersonation.objects.filter(session_key__in = gone).delete()
+        removed += deleted
+    return removed
+
+
+def revoke(queryset):
+    """
+    Ends the impersonations in the given query set by removing the impersonation from
+    each of the affected sessions, and returns the number of impersonations revoked.
+
+    Only the sessions in the query set are loaded and saved. This requires a server-side
+    session engine, i.e. not ``signed_cookies``, for which there are no entries.
+    """
+    SessionStore = import_module(django_settings.SESSION_ENGINE).SessionStore
+    revoked = 0
+    for entry in queryset.select_related('impersonator', 'impersonatee'):
+        session = SessionStore(entry.session_key)
+        # Don't create a new session if the session has already gone
+        if session.exists(entry.session_key):
+            if session.pop(app_settings.IMPERSONATE_SESSION_KEY, None) is not None:
+                session.save()
+                impersonation_ended.send(
+                    entry.impersonatee.__class__,
+                    impersonator = entry.impersonator,
+                    impersonatee = entry.impersonatee
+                )
+                revoked += 1
+        entry.delete()
+    return revoked
@@ -0,0 +1,309 @@
+import asyncio
+import collections
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+
+from oauthlib.oauth2.rfc6749.errors import OAuth2Error
+
+from .settings import app_settings
+
+
+class ProviderUnavailable(OAuth2Error):
+    """
+    Raised when a request to the identity provider is rejected without being sent, either
+    because too many requests are already in flight or because the circuit is open, or
+    when the provider responds with an error.
+
+    This is an OAuth error so that it is reported on the same error page.
+    """
+    error = 'provider_unavailable'
+
+
+class Limiter:
+    """
+    Limits the number of calls that can be in flight at once, with a bounded queue of
+    calls waiting for a slot.
+    """
+    def __init__(self, limit, max_queue, timeout):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+
+    def try_acquire(self):
+        """
+        Acquires a slot if one is free without waiting and returns true if successful.
+        """
+        with self.condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """
+        Acquires a slot, waiting for one to become free if required.
+
+        Raises :py:class:`ProviderUnavailable` if the queue is full or no slot becomes
+        free within the timeout.
+        """
+        with self.condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return
+            if self.waiting >= self.max_queue:
+                raise ProviderUnavailable('Too many requests are waiting for the provider.')
+            self.waiting += 1
+            try:
+                if not self.condition.wait_for(
+                    lambda: self.in_flight < self.limit,
+                    self.timeout
+                ):
+                    raise ProviderUnavailable('Timed out waiting for the provider.')
+                self.in_flight += 1
+            finally:
+                self.waiting -= 1
+
+    async def aacquire(self):
+        """
+        Async version of :py:meth:`acquire`.
+        """
+        # Only tie up a thread if we actually have to wait
+        if self.try_acquire():
+            return
+        waiter = asyncio.ensure_future(
+            sync_to_async(self.acquire, thread_sensitive = False)()
+        )
+        try:
+            # The thread cannot be interrupted, so make sure cancelling the caller does
+            # not cancel the task that is waiting for it
+            await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            # If the thread gets a slot after the caller has gone, give it back
+            waiter.add_done_callback(self._release_abandoned)
+            raise
+
+    def _release_abandoned(self, waiter):
+        if not waiter.cancelled() and waiter.exception() is None:
+            self.release()
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker that stops calls for a while once too many recent calls have failed.
+
+    Once the reset timeout has passed, a limited number of probe calls are allowed. If they
+    all succeed the circuit closes again, otherwise it opens for another reset timeout.
+
+    Each call is tagged with the generation of the circuit when it started, which changes
+    every time the state changes, so that the results of calls that started in an earlier
+    state, e.g. slow calls that started before the circuit opened, are ignored.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window, min_calls, failure_rate, reset_timeout, half_open_calls):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.lock = threading.Lock()
+        # The outcomes of the most recent calls, where true indicates a failure
+        self.outcomes = collections.deque(maxlen = window)
+        self.state = self.CLOSED
+        self.generation = 0
+        self.opened_at = 0
+        self.probes = 0
+        self.successes = 0
+
+    def set_state(self, state):
+        self.state = state
+        self.generation += 1
+
+    def open(self):
+        self.set_state(self.OPEN)
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+
+    def before_call(self):
+        """
+        Called before a call is made, returning the generation that the call belongs to.
+
+        Raises :py:class:`ProviderUnavailable` if the call is not allowed.
+        """
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise ProviderUnavailable('The provider is failing - not sending request.')
+                self.set_state(self.HALF_OPEN)
+                self.probes = self.successes = 0
+            if self.state == self.HALF_OPEN:
+                if self.probes >= self.half_open_calls:
+                    raise ProviderUnavailable('Waiting for probe requests to the provider.')
+                self.probes += 1
+            return self.generation
+
+    def cancel_call(self, generation):
+        """
+        Called if a call is abandoned after ``before_call`` without being made.
+        """
+        with self.lock:
+            if generation == self.generation and self.state == self.HALF_OPEN:
+                self.probes -= 1
+
+    def after_call(self, failed, generation):
+        """
+        Called with the outcome of a call once it has completed.
+        """
+        with self.lock:
+            # Ignore calls that were started in an earlier state
+            if generation != self.generation:
+                return
+            if self.state == self.HALF_OPEN:
+                if failed:
+                    self.open()
+                else:
+                    self.successes += 1
+                    if self.successes >= self.half_open_calls:
+                        self.set_state(self.CLOSED)
+            elif self.state == self.CLOSED:
+                self.outcomes.append(failed)
+                if (
+                    len(self.outcomes) >= self.min_calls and
+                    sum(self.outcomes) >= self.failure_rate * len(self.outcomes)
+                ):
+                    self.open()
+
+
+class ProviderGuard:
+    """
+    Applies the concurrency limit and circuit breaker to calls to the identity provider.
+    """
+    def __init__(self, limiter = None, breaker = None, slow_call_duration = None):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.slow_call_duration = slow_call_duration
+
+    def is_failure(self, response, duration):
+        """
+        Returns true if the given response counts as a failure for the circuit breaker.
+        """
+        if self.slow_call_duration and duration > self.slow_call_duration:
+            return True
+        # Both requests and httpx responses have a status_code
+        return response.status_code >= 500
+
+    def before_call(self):
+        """
+        Called before a call is made, returning the generation of the circuit breaker.
+        """
+        return self.breaker.before_call() if self.breaker else None
+
+    def cancel_call(self, generation):
+        # Being rejected by our own limit says nothing about the provider
+        if self.breaker:
+            self.breaker.cancel_call(generation)
+
+    def after_call(self, response, start, generation):
+        if self.limiter:
+            self.limiter.release()
+        if self.breaker:
+            self.breaker.after_call(
+                response is None or
+                self.is_failure(response, time.monotonic() - start),
+                generation
+            )
+
+    def call(self, func):
+        """
+        Calls the given function, which makes a request and returns the response.
+        """
+        generation = self.before_call()
+        if self.limiter:
+            try:
+                self.limiter.acquire()
+            except ProviderUnavailable:
+                self.cancel_call(generation)
+                raise
+        start = time.monotonic()
+        response = None
+        try:
+            response = func()
+            return response
+        finally:
+            self.after_call(response, start, generation)
+
+    async def acall(self, func):
+        """
+        Async version of :py:meth:`call`, where the function returns an awaitable.
+        """
+        generation = self.before_call()
+        if self.limiter:
+            try:
+                await self.limiter.aacquire()
+            except (ProviderUnavailable, asyncio.CancelledError):
+                self.cancel_call(generation)
+                raise
+        start = time.monotonic()
+        try:
+            response = await func()
+        except asyncio.CancelledError:
+            # The caller has gone away, which says nothing about the provider
+            if self.limiter:
+                self.limiter.release()
+            self.cancel_call(generation)
+            raise
+        except BaseException:
+            self.after_call(None, start, generation)
+            raise
+        self.after_call(response, start, generation)
+        return response
+
+
+_guard = None
+_guard_lock = threading.Lock()
+
+
+def get_guard():
+    """
+    Returns the process-wide guard for calls to the identity provider.
+    """
+    global _guard
+    if _guard is None:
+        with _guard_lock:
+            if _guard is None:
+                _guard = ProviderGuard(
+                    Limiter(
+                        app_settings.PROVIDER_MAX_CONCURRENCY,
+                        app_settings.PROVIDER_MAX_QUEUE,
+                        app_settings.PROVIDER_QUEUE_TIMEOUT
+                    ) if app_settings.PROVIDER_MAX_CONCURRENCY else None,
+                    CircuitBreaker(
+                        app_settings.CIRCUIT_BREAKER_WINDOW,
+                        app_settings.CIRCUIT_BREAKER_MIN_CALLS,
+                        app_settings.CIRCUIT_BREAKER_FAILURE_RATE,
+                        app_settings.CIRCUIT_BREAKER_RESET_TIMEOUT,
+                        app_settings.CIRCUIT_BREAKER_HALF_OPEN_CALLS
+                    ) if app_settings.CIRCUIT_BREAKER_ENABLED else None,
+                    app_settings.CIRCUIT_BREAKER_SLOW_CALL_DURATION
+                )
+    return _guard
+
+
+def reset_guard():
+    """
+    Discards the process-wide guard so that it is recreated from the settings on next use.
+    """
+    global _guard
+    with _guard_lock:
+        _guard = None
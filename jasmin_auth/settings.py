@@ -19,6 +19,42 @@ class AppSettings(SettingsObject):
     #: Indicates whether to perform verification of the SSL certificate
     #: This should be ``True`` in production
     VERIFY_SSL = Setting(default = True)
+    #: The number of connection pools to keep for requests to the identity provider
+    HTTP_POOL_CONNECTIONS = Setting(default = 10)
+    #: The maximum number of keep-alive connections to keep in each pool
+    HTTP_POOL_MAXSIZE = Setting(default = 10)
+    #: The timeout in seconds for connecting to the identity provider
+    HTTP_CONNECT_TIMEOUT = Setting(default = 5)
+    #: The timeout in seconds for reading a response from the identity provider
+    HTTP_READ_TIMEOUT = Setting(default = 10)
+    #: The maximum number of retries for failed requests to the identity provider
+    #: Only connection errors are retried for non-idempotent requests like the token exchange
+    HTTP_MAX_RETRIES = Setting(default = 2)
+    #: The backoff factor in seconds to use between retries
+    HTTP_RETRY_BACKOFF = Setting(default = 0.2)
+    #: The maximum number of requests to the identity provider that can be in flight at
+    #: once in each process, or zero for no limit
+    PROVIDER_MAX_CONCURRENCY = Setting(default = 0)
+    #: The maximum number of requests that can wait for one of the in-flight requests to
+    #: finish before requests are rejected
+    PROVIDER_MAX_QUEUE = Setting(default = 50)
+    #: The maximum number of seconds that a request will wait before being rejected
+    PROVIDER_QUEUE_TIMEOUT = Setting(default = 5)
+    #: Indicates whether to stop sending requests to the identity provider for a while
+    #: once too many requests fail or are slow
+    CIRCUIT_BREAKER_ENABLED = Setting(default = False)
+    #: The number of recent requests used to calculate the failure rate
+    CIRCUIT_BREAKER_WINDOW = Setting(default = 20)
+    #: The minimum number of recent requests before the circuit can open
+    CIRCUIT_BREAKER_MIN_CALLS = Setting(default = 10)
+    #: The fraction of recent requests that must fail for the circuit to open
+    CIRCUIT_BREAKER_FAILURE_RATE = Setting(default = 0.5)
+    #: Requests that take longer than this number of seconds count as failures
+    CIRCUIT_BREAKER_SLOW_CALL_DURATION = Setting(default = 5)
+    #: The number of seconds that the circuit stays open before probe requests are allowed
+    CIRCUIT_BREAKER_RESET_TIMEOUT = Setting(default = 30)
+    #: The number of probe requests that must succeed for the circuit to close again
+    CIRCUIT_BREAKER_HALF_OPEN_CALLS = Setting(default = 1)
     #: The oauth client id
     CLIENT_ID = Setting()
     #: The oauth client secret
@@ -29,6 +65,39 @@ class AppSettings(SettingsObject):
     STATE_SESSION_KEY = Setting(default = 'jasmin_auth_state')
     #: The session key to use for the login redirect url
     NEXT_URL_SESSION_KEY = Setting(default = 'jasmin_auth_next_url')
+    #: The number of seconds for which the result of a callback is kept so that duplicate
+    #: callbacks with the same authorization code can reuse it, or zero to disable
+    #: Uses the cache given by CACHE_ALIAS to coalesce callbacks across processes
+    CALLBACK_COALESCE_TIMEOUT = Setting(default = 0)
+    #: The maximum number of seconds that a duplicate callback waits for the first callback
+    #: to finish before handling the callback itself
+    CALLBACK_COALESCE_WAIT = Setting(default = 2)
+    #: Indicates whether to store a snapshot of the user in the session at login, so that
+    #: SnapshotAuthenticationMiddleware can avoid loading the user on every request
+    USER_SNAPSHOT = Setting(default = False)
+    #: The maximum age in seconds of a snapshot before the user is loaded again, which bounds
+    #: how long changes that bypass the model signals, e.g. QuerySet.update, go unnoticed
+    USER_SNAPSHOT_MAX_AGE = Setting(default = 60)
+    #: The session key used to store the user snapshot
+    USER_SNAPSHOT_SESSION_KEY = Setting(default = 'jasmin_auth_user_snapshot')
+    #: The user fields included in the snapshot - other fields are loaded when accessed
+    USER_SNAPSHOT_FIELDS = Setting(default = (
+        'username',
+        'first_name',
+        'last_name',
+        'email',
+        'is_active',
+        'is_staff',
+        'is_superuser',
+    ))
+    #: Indicates whether to carry the oauth state and next url in a signed state parameter,
+    #: bound to the browser by a short-lived cookie, instead of the session
+    STATELESS_STATE = Setting(default = False)
+    #: The name of the cookie used to bind the state to the browser for stateless logins
+    STATE_COOKIE_NAME = Setting(default = 'jasmin_auth_state')
+    #: The maximum number of seconds between starting a login and the callback for
+    #: stateless logins
+    STATE_MAX_AGE = Setting(default = 600)
     #: Function that creates or updates a user from the profile result
     CREATE_OR_UPDATE_USER_FUNC = ImportStringSetting(
         default = 'jasmin_auth.helpers.create_or_update_user'
@@ -43,9 +112,66 @@ class AppSettings(SettingsObject):
         last_name = "last_name",
         email = "email",
     ))
+    #: The number of seconds after a user's profile is synced during which further logins
+    #: use the existing local user without fetching the profile, or zero to disable
+    #: The user must be identified from the token, see TOKEN_USERNAME_KEY
+    PROFILE_FRESHNESS_WINDOW = Setting(default = 0)
+    #: Indicates whether to fetch the profile using a conditional request with the ETag
+    #: from the previous fetch, so that an unchanged profile is not saved again
+    PROFILE_CONDITIONAL_REQUESTS = Setting(default = False)
+    #: The key in the token response that contains the username, if the provider sends it
+    #: If not given, the username is taken from the ID token when ID_TOKEN_PROFILE is set
+    TOKEN_USERNAME_KEY = Setting(default = None)
+    #: Indicates whether to build the user from the claims in a verified ID token, when
+    #: the provider returns one, rather than fetching the profile
+    #: Requires the openid scope to be included in SCOPES
+    ID_TOKEN_PROFILE = Setting(default = False)
+    #: A mapping of ID token claims to profile keys
+    ID_TOKEN_CLAIM_MAPPING = Setting(default = dict(
+        preferred_username = "username",
+        given_name = "first_name",
+        family_name = "last_name",
+        email = "email",
+    ))
+    #: The algorithms that are permitted for ID token signatures
+    ID_TOKEN_ALGORITHMS = Setting(default = ('RS256', ))
+    #: The leeway in seconds to allow when checking the ID token expiry
+    ID_TOKEN_LEEWAY = Setting(default = 60)
+    #: The OpenID Connect discovery URL for the provider
+    OIDC_DISCOVERY_URL = Setting(
+        default = 'https://accounts.jasmin.ac.uk/.well-known/openid-configuration'
+    )
+    #: The URL of the provider's signing keys
+    #: If not given, it is taken from the discovery metadata
+    OIDC_JWKS_URL = Setting(default = None)
+    #: The expected issuer of ID tokens
+    #: If not given, it is taken from the discovery metadata
+    OIDC_ISSUER = Setting(default = None)
+    #: The number of seconds to cache the discovery metadata and signing keys for
+    OIDC_CACHE_TIMEOUT = Setting(default = 3600)
+    #: The minimum number of seconds between refreshes of the signing keys triggered
+    #: by an unknown key ID
+    OIDC_JWKS_MIN_REFRESH_INTERVAL = Setting(default = 60)
+    #: URL template used by the jasmin_auth_sync command to fetch the profile for a user
+    #: Should contain a {username} placeholder, e.g. https://example.com/users/{username}/
+    SYNC_PROFILE_URL = Setting(default = None)
+    #: URL used by the jasmin_auth_sync command to fetch many profiles in one request
+    #: If given, it is used in preference to SYNC_PROFILE_URL and should accept repeated
+    #: username query parameters and return a list of profiles
+    SYNC_BULK_PROFILE_URL = Setting(default = None)
+    #: The scopes to ask for when obtaining a token for the jasmin_auth_sync command
+    SYNC_SCOPES = Setting(default = lambda s: s.SCOPES)
+    #: The number of concurrent requests to make in the jasmin_auth_sync command
+    SYNC_WORKERS = Setting(default = 8)
+    #: The number of users to process in each transaction in the jasmin_auth_sync command
+    SYNC_CHUNK_SIZE = Setting(default = 500)
     #: The error message for each error code
     ERROR_MESSAGES = MergedDictSetting(defaults = dict(
         access_denied = 'You did not grant the required access.',
+        provider_unavailable = (
+            'The JASMIN accounts portal is not responding at the moment - '
+            'please try again in a few minutes.'
+        ),
     ))
     #: The default error message if the code is not present
     DEFAULT_ERROR_MESSAGE = Setting(
@@ -64,6 +190,42 @@ class AppSettings(SettingsObject):
     )
     #: Iterable of patterns for which impersonation is disabled
     IMPERSONATE_DISABLED_PATTERNS = Setting(default = ('^/admin', ))
+    #: Iterable of path prefixes for which the middleware does not look at the session
+    #: This is cheaper than IMPERSONATE_DISABLED_PATTERNS, but request.user is the real user
+    IMPERSONATE_EXEMPT_PATH_PREFIXES = Setting(default = ())
+    #: The maximum number of paths to cache impersonation decisions for
+    #: Used by the default IMPERSONATE_IS_PERMITTED_REQUEST - 0 disables the cache
+    IMPERSONATE_PATH_CACHE_SIZE = Setting(default = 1024)
+    #: Number of seconds to cache impersonatee lookups and permission decisions for
+    #: The default of 0 disables the cache
+    IMPERSONATE_CACHE_TIMEOUT = Setting(default = 0)
+    #: Indicates whether to record active impersonations in the registry, so that they can
+    #: be listed and revoked in the admin
+    IMPERSONATION_REGISTRY = Setting(default = True)
+    #: Indicates whether to record audit events when impersonations start and end
+    #: Tsunami events are used if tsunami is installed, otherwise a built-in model is used
+    AUDIT_IMPERSONATION = Setting(default = True)
+    #: Indicates whether to write audit events in batches from a background thread
+    #: If false, each event is written when the transaction for the request commits
+    #: Buffered events are lost if the process is killed without exiting cleanly
+    AUDIT_BACKGROUND = Setting(default = True)
+    #: The maximum number of seconds that audit events are buffered for
+    AUDIT_FLUSH_INTERVAL = Setting(default = 1.0)
+    #: The number of buffered audit events that triggers an immediate write
+    AUDIT_BATCH_SIZE = Setting(default = 100)
+
+    #: Indicates whether to collect metrics for the timed phases in each process, for
+    #: exposure using jasmin_auth.instrumentation.metrics
+    METRICS_ENABLED = Setting(default = False)
+    #: The bucket boundaries in seconds for the phase duration histograms
+    METRICS_BUCKETS = Setting(default = (
+        0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    ))
+
+    #: The alias of the Django cache to use for cached data
+    CACHE_ALIAS = Setting(default = 'default')
+    #: The prefix to use for keys in the cache
+    CACHE_KEY_PREFIX = Setting(default = 'jasmin_auth')
 
     # The backend to use to log the user in as.
     # A class path e.g. django.contrib.auth.backends.ModelBackend
@@ -13,3 +13,8 @@ impersonation_started = Signal()
 #: It is NOT dispatched if impersonation ends as a result of some other action such as
 #: the session expiring or the user logging out completely
 impersonation_ended = Signal()
+
+#: Signal that is dispatched when a phase of a login or request has been timed
+#: Receives the name of the phase, the duration in seconds and the outcome as arguments
+#: Phases are only timed when there is at least one receiver connected
+phase_timed = Signal()
@@ -0,0 +1,172 @@
+from asgiref.sync import sync_to_async
+
+from django.conf import settings as django_settings
+from django.contrib import auth
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY,
+    HASH_SESSION_KEY,
+    SESSION_KEY,
+    get_user_model,
+    load_backend
+)
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist
+from django.db import router
+from django.utils.crypto import constant_time_compare
+
+from .cache import get_cache, get_user_generations, user_generation_key
+from .settings import app_settings
+
+
+SNAPSHOT_SALT = 'jasmin_auth.snapshot'
+
+#: The version of the snapshot format, which is changed if the format changes
+SNAPSHOT_VERSION = 1
+
+
+def get_snapshot_fields(UserModel):
+    """
+    Returns the fields of the user model that are included in the snapshot.
+    """
+    fields = [UserModel._meta.pk]
+    for name in app_settings.USER_SNAPSHOT_FIELDS:
+        try:
+            field = UserModel._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if field.concrete and not field.primary_key:
+            fields.append(field)
+    return fields
+
+
+def save_snapshot(request, user, generation = None):
+    """
+    Saves a snapshot of the given user in the session of the given request.
+
+    The user must be logged in to the session, so this should be called after login.
+
+    If given, the generation should have been read before the user was loaded, so that
+    a change that is committed while the user is being loaded makes the snapshot stale.
+    """
+    if not app_settings.USER_SNAPSHOT or not user.is_authenticated:
+        return
+    # Use the generation from the cache, so that any change to the user makes the
+    # snapshot stale
+    if generation is None:
+        generation, = get_user_generations(get_cache(), user.pk)
+    request.session[app_settings.USER_SNAPSHOT_SESSION_KEY] = signing.dumps(
+        dict(
+            v = SNAPSHOT_VERSION,
+            g = generation,
+            b = request.session.get(BACKEND_SESSION_KEY),
+            h = request.session.get(HASH_SESSION_KEY),
+            f = {
+                field.attname: (
+                    None
+                    if field.value_from_object(user) is None
+                    else field.value_to_string(user)
+                )
+                for field in get_snapshot_fields(user.__class__)
+            }
+        ),
+        salt = SNAPSHOT_SALT,
+        compress = True
+    )
+
+
+def load_snapshot(request):
+    """
+    Returns the user from the snapshot in the session of the given request, or ``None``
+    if there is no snapshot or it is not valid for the session.
+
+    The user is a model instance in which only the snapshot fields are loaded. Any other
+    fields are loaded from the database when they are first accessed.
+
+    Snapshots that are older than ``USER_SNAPSHOT_MAX_AGE`` are not valid.
+    """
+    value = request.session.get(app_settings.USER_SNAPSHOT_SESSION_KEY)
+    if not value:
+        return None
+    try:
+        snapshot = signing.loads(
+            value,
+            salt = SNAPSHOT_SALT,
+            max_age = app_settings.USER_SNAPSHOT_MAX_AGE or None
+        )
+    except signing.BadSignature:
+        # This includes an expired snapshot
+        return None
+    if snapshot.get('v') != SNAPSHOT_VERSION:
+        return None
+    # The snapshot must match the user, backend and hash that are logged in to the session
+    UserModel = get_user_model()
+    fields = get_snapshot_fields(UserModel)
+    pk_value = snapshot['f'].get(UserModel._meta.pk.attname)
+    backend_path = request.session.get(BACKEND_SESSION_KEY)
+    if (
+        pk_value is None or
+        request.session.get(SESSION_KEY) != pk_value or
+        backend_path != snapshot['b'] or
+        not constant_time_compare(request.session.get(HASH_SESSION_KEY) or '', snapshot['h'] or '')
+    ):
+        return None
+    # As for Django's get_user, the backend must still be enabled
+    if backend_path not in django_settings.AUTHENTICATION_BACKENDS:
+        return None
+    # The snapshot is stale if the user has changed since it was taken
+    generation = get_cache().get(user_generation_key(UserModel._meta.pk.to_python(pk_value)))
+    if not generation or generation != snapshot['g']:
+        return None
+    # from_db expects the values in the same order as the concrete fields of the model
+    attnames = { field.attname for field in fields if field.attname in snapshot['f'] }
+    loaded = [field for field in UserModel._meta.concrete_fields if field.attname in attnames]
+    user = UserModel.from_db(
+        router.db_for_read(UserModel),
+        [field.attname for field in loaded],
+        [
+            None if snapshot['f'][field.attname] is None
+            else field.to_python(snapshot['f'][field.attname])
+            for field in loaded
+        ]
+    )
+    # Apply the same check as the backend would when loading the user, e.g. is_active
+    backend = load_backend(backend_path)
+    user_can_authenticate = getattr(backend, 'user_can_authenticate', None)
+    if user_can_authenticate is not None and not user_can_authenticate(user):
+        return None
+    user.backend = backend_path
+    return user
+
+
+def get_user(request):
+    """
+    Returns the user for the given request, using the snapshot in the session if it is
+    valid and falling back to Django's ``get_user`` otherwise.
+
+    When the fallback is used, the snapshot is refreshed for the next request.
+    """
+    user = load_snapshot(request)
+    if user is None:
+        # Read the generation before loading the user, so that a change to the user that
+        # is committed after the user is loaded makes the new snapshot stale
+        generation = None
+        pk_value = request.session.get(SESSION_KEY)
+        if app_settings.USER_SNAPSHOT and pk_value is not None:
+            UserModel = get_user_model()
+            generation, = get_user_generations(
+                get_cache(),
+                UserModel._meta.pk.to_python(pk_value)
+            )
+        user = auth.get_user(request)
+        # Only use the generation if it was for the user that was loaded
+        if user.is_authenticated and user._meta.pk.value_to_string(user) != pk_value:
+            generation = None
+        save_snapshot(request, user, generation)
+    return user
+
+
+async def aget_user(request):
+    """
+    Async version of :py:func:`get_user`.
+    """
+    return await sync_to_async(get_user)(request)
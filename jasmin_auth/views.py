@@ -1,31 +1,58 @@
 from django.conf import settings as django_settings
-from django.contrib.auth import REDIRECT_FIELD_NAME, login as auth_login
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY,
+    REDIRECT_FIELD_NAME,
+    SESSION_KEY,
+    get_user_model,
+    login as auth_login
+)
 from django.shortcuts import redirect, render, resolve_url
-from django.urls import reverse
-
-from requests_oauthlib import OAuth2Session
-from oauthlib.oauth2.rfc6749.errors import OAuth2Error
 
+from .coalesce import get_flight
+from .instrumentation import mark_view_finished, timed
 from .settings import app_settings
+from .snapshot import save_snapshot
+
+
+# NOTE: The OAuth stack (oauthlib, requests_oauthlib and requests) is imported by the views
+#       that use it rather than at module level, so that loading the URLconf does not
+#       import it in workers that never handle a login
+
+
+def render_oauth_error(request, error, description = None):
+    """
+    Renders the error page for the given OAuth error code.
+    """
+    return render(request, 'jasmin_auth/oauth_error.html', {
+        'error': error,
+        'error_description': app_settings.ERROR_MESSAGES.get(
+            error,
+            description or app_settings.DEFAULT_ERROR_MESSAGE
+        )
+    })
 
 
 def login(request):
     """
     Starts the OAuth 2.0 login flow.
     """
+    from .oauth import get_provider, make_state, set_state_cookie
     # NOTE: Even if the user is already authenticated, they will be sent round the
     #       redirect loop and re-authenticated
     #       This allows for the case where a user has signed out of the identity provider
     #       in order to sign in using a different account
+    # Initialise the OAuth session
+    provider = get_provider(request)
+    # For a stateless login, the next url goes in the state and the session is not touched
+    if app_settings.STATELESS_STATE:
+        state, nonce = make_state(request.GET.get(REDIRECT_FIELD_NAME))
+        auth_url, state = provider.authorization_url(app_settings.AUTHORIZE_URL, state = state)
+        response = redirect(auth_url)
+        set_state_cookie(response, request, nonce)
+        return response
     # Store the next url in the session if given
     if REDIRECT_FIELD_NAME in request.GET:
         request.session[app_settings.NEXT_URL_SESSION_KEY] = request.GET[REDIRECT_FIELD_NAME]
-    # Initialise the OAuth session
-    provider = OAuth2Session(
-        app_settings.CLIENT_ID,
-        redirect_uri = request.build_absolute_uri(reverse('jasmin_auth:callback')),
-        scope = ' '.join(app_settings.SCOPES),
-    )
     # Get the redirect URL and state
     auth_url, state = provider.authorization_url(app_settings.AUTHORIZE_URL)
     # Store the state for later
@@ -33,48 +60,120 @@ def login(request):
     return redirect(auth_url)
 
 
+def reuse_callback_result(request, flight, result):
+    """
+    Returns a response that reuses the result of the request that led the given flight,
+    or ``None`` if the result cannot be used for this request.
+    """
+    from .oauth import delete_state_cookie
+    session_user = request.session.get(SESSION_KEY)
+    if not flight.can_reuse(result, session_user):
+        return None
+    # If the duplicate request has the same session as the original request, the user
+    # must also be logged in to this session
+    if session_user != result['user']:
+        user = get_user_model()._default_manager.filter(pk = result['user']).first()
+        if user is None:
+            return None
+        auth_login(request, user, result['backend'])
+        save_snapshot(request, user)
+    request.session.pop(app_settings.STATE_SESSION_KEY, None)
+    request.session.pop(app_settings.NEXT_URL_SESSION_KEY, None)
+    response = redirect(result['redirect_url'])
+    if app_settings.STATELESS_STATE:
+        delete_state_cookie(response)
+    return response
+
+
 def callback(request):
     """
     Handles the OAuth 2.0 callback.
+
+    Duplicate requests for the same authorization code, e.g. from a browser refresh, wait
+    for the first request to finish and reuse its result.
     """
+    flight = get_flight(request)
+    if flight is None:
+        return handle_callback(request)
+    result = flight.join()
+    if result is not None:
+        response = reuse_callback_result(request, flight, result)
+        if response is not None:
+            return response
+    try:
+        return handle_callback(request, flight)
+    finally:
+        flight.release()
+
+
+def handle_callback(request, flight = None):
+    """
+    Handles the OAuth 2.0 callback, recording the result in the flight if given.
+    """
+    from oauthlib.oauth2.rfc6749.errors import OAuth2Error
+    from requests import RequestException
+    from .oauth import delete_state_cookie, get_provider, load_state
+    from .oidc import IdTokenError
+    from .profiles import get_user_for_token
+    from .resilience import ProviderUnavailable
+    # Get the state that we expect
+    if app_settings.STATELESS_STATE:
+        # For a stateless login, the state must be valid and match the cookie
+        try:
+            state, next_url = load_state(request)
+        except OAuth2Error as exc:
+            return render_oauth_error(request, exc.error, exc.description)
+    else:
+        state = request.session.pop(app_settings.STATE_SESSION_KEY, None)
     # Initialise the OAuth session
-    provider = OAuth2Session(
-        app_settings.CLIENT_ID,
-        redirect_uri = request.build_absolute_uri(reverse('jasmin_auth:callback')),
-        scope = ' '.join(app_settings.SCOPES),
-        state = request.session.pop(app_settings.STATE_SESSION_KEY, None),
-    )
+    provider = get_provider(request, state = state)
     try:
-        token = provider.fetch_token(
-            app_settings.ACCESS_TOKEN_URL,
-            client_secret = app_settings.CLIENT_SECRET,
-            authorization_response = request.build_absolute_uri(),
-            verify = app_settings.VERIFY_SSL
-        )
+        # The outcome of the phase is the OAuth error code if there is one
+        with timed('fetch_token'):
+            token = provider.fetch_token(
+                app_settings.ACCESS_TOKEN_URL,
+                client_secret = app_settings.CLIENT_SECRET,
+                authorization_response = request.build_absolute_uri(),
+                verify = app_settings.VERIFY_SSL
+            )
     except OAuth2Error as exc:
         # If there is an OAuth error, show the error page
-        return render(request, 'jasmin_auth/oauth_error.html', {
-            'error': exc.error,
-            'error_description': app_settings.ERROR_MESSAGES.get(
-                exc.error,
-                exc.description or app_settings.DEFAULT_ERROR_MESSAGE
-            )
-        })
+        return render_oauth_error(request, exc.error, exc.description)
+    except RequestException:
+        # The provider could not be reached or did not respond in time
+        return render_oauth_error(request, ProviderUnavailable.error)
     else:
-        # If a token is obtained successfully, retrieve the profile and create a local user
-        profile = provider.get(app_settings.PROFILE_URL).json()
-        # The function to create or update a user is a setting
-        user = app_settings.CREATE_OR_UPDATE_USER_FUNC(profile)
+        # If a token is obtained successfully, get the profile and create a local user
+        try:
+            user = get_user_for_token(provider, token)
+        except IdTokenError:
+            return render_oauth_error(request, 'invalid_id_token')
+        except ProviderUnavailable as exc:
+            return render_oauth_error(request, exc.error, exc.description)
+        except RequestException:
+            return render_oauth_error(request, ProviderUnavailable.error)
         # Log the user in.
         # If the backend to use is specified in settings use that one (should be a dotted
         # class path to the backend). Otherwise just use whatever the default one is.
-        if app_settings.LOGIN_BACKEND:
-          auth_login(request, user, app_settings.LOGIN_BACKEND)
-        else:
-          auth_login(request, user)
+        with timed('login'):
+            if app_settings.LOGIN_BACKEND:
+              auth_login(request, user, app_settings.LOGIN_BACKEND)
+            else:
+              auth_login(request, user)
+        # If enabled, store a snapshot of the user so later requests don't need to load it
+        save_snapshot(request, user)
         # Redirect to the specified URL
-        next_url = request.session.pop(
-            app_settings.NEXT_URL_SESSION_KEY,
-            resolve_url(django_settings.LOGIN_REDIRECT_URL)
-        )
-        return redirect(next_url)
+        if app_settings.STATELESS_STATE:
+            response = redirect(next_url or resolve_url(django_settings.LOGIN_REDIRECT_URL))
+            delete_state_cookie(response)
+        else:
+            next_url = request.session.pop(
+                app_settings.NEXT_URL_SESSION_KEY,
+                resolve_url(django_settings.LOGIN_REDIRECT_URL)
+            )
+            response = redirect(next_url)
+        if flight is not None:
+            flight.complete(user, request.session[BACKEND_SESSION_KEY], response.url)
+        # The session is saved by the session middleware after the view returns
+        mark_view_finished(request)
+        return response
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+Runs the tests using the settings in ``tests/settings.py``.
+
+Usage::
+
+    python runtests.py [test labels...]
+"""
+
+import os
+import sys
+
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.test.utils import get_runner
+
+    TestRunner = get_runner(settings)
+    failures = TestRunner().run_tests(sys.argv[1:] or ['tests'])
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
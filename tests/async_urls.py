@@ -0,0 +1,16 @@
+"""
+URLconf for the tests that uses the async login views.
+"""
+
+from django.urls import include, path
+
+from . import urls
+
+
+handler404 = urls.handler404
+
+
+urlpatterns = [
+    path('auth/', include('jasmin_auth.async_urls')) if str(pattern.pattern) == 'auth/' else pattern
+    for pattern in urls.urlpatterns
+]
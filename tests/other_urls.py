@@ -0,0 +1,21 @@
+"""
+Alternative URLconf for the tests, in which impersonation is disabled for every view.
+"""
+
+from django.http import HttpResponse
+from django.urls import path
+
+from jasmin_auth.decorators import no_impersonation
+
+
+@no_impersonation
+def plain(request):
+    """
+    A view that does not permit impersonation.
+    """
+    return HttpResponse('ok')
+
+
+urlpatterns = [
+    path('plain/', plain),
+]
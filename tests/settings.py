@@ -0,0 +1,75 @@
+"""
+Django settings for running the tests.
+"""
+
+import os
+
+
+# The stub identity provider used by the tests is served over plain HTTP
+os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+
+SECRET_KEY = 'tests-only'
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['*']
+
+INSTALLED_APPS = [
+    'jasmin_auth',
+    'jasmin_auth.apps.AdminConfig',
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+]
+
+MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'jasmin_auth.middleware.ImpersonateMiddleware',
+]
+
+ROOT_URLCONF = 'tests.urls'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.request',
+                'django.contrib.auth.context_processors.auth',
+                'django.contrib.messages.context_processors.messages',
+            ],
+        },
+    },
+]
+
+USE_TZ = True
+
+LOGIN_URL = 'jasmin_auth:login'
+
+LOGIN_REDIRECT_URL = '/whoami/'
+
+JASMIN_AUTH = {
+    'CLIENT_ID': 'tests',
+    'CLIENT_SECRET': 'tests',
+    # Write audit events immediately so that the tests can see them
+    'AUDIT_BACKGROUND': False,
+}
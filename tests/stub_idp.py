@@ -0,0 +1,175 @@
+"""
+A local stub of the identity provider and accounts portal endpoints used by the tests.
+"""
+
+import collections
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for the stub identity provider.
+
+    The authorisation code sent to the token endpoint is used as the username, so that each
+    login can be for a different user.
+    """
+    # Use HTTP/1.1 so that clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers = ()):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(self.rfile.read(length).decode())
+        self.server.count('token')
+        if params.get('grant_type') == ['client_credentials']:
+            username = 'client'
+        else:
+            username = params.get('code', [''])[0]
+        if username in self.server.bad_codes:
+            return self.send_json(400, dict(error = 'invalid_grant'))
+        self.send_json(200, dict(
+            access_token = 'token-' + username,
+            token_type = 'Bearer',
+            expires_in = 3600,
+            **self.server.get_token_extra(username)
+        ))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path in self.server.documents:
+            self.server.count(url.path)
+            return self.send_json(200, self.server.documents[url.path])
+        if url.path == '/profile':
+            self.server.count('profile')
+            username = self.headers.get('Authorization', '').rpartition('token-')[2]
+            if username in self.server.broken:
+                return self.send_json(500, dict(error = 'server_error'))
+            profile = self.server.get_profile(username)
+            etag = '"{}"'.format(
+                hashlib.sha256(json.dumps(profile, sort_keys = True).encode()).hexdigest()
+            )
+            if self.server.etags and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            return self.send_json(200, profile, [('ETag', etag)] if self.server.etags else [])
+        if self.server.unavailable and (url.path.startswith('/users/') or url.path == '/bulk'):
+            return self.send_json(503, dict(error = 'temporarily_unavailable'))
+        if url.path.startswith('/users/'):
+            self.server.count('users')
+            username = unquote(url.path.split('/')[2])
+            if username in self.server.broken:
+                return self.send_json(500, dict(error = 'server_error'))
+            if username in self.server.missing:
+                return self.send_json(404, dict(error = 'not_found'))
+            return self.send_json(200, self.server.get_profile(username))
+        if url.path == '/bulk':
+            self.server.count('bulk')
+            usernames = parse_qs(url.query).get('username', [])
+            if self.server.broken.intersection(usernames):
+                return self.send_json(500, dict(error = 'server_error'))
+            return self.send_json(200, [
+                self.server.get_profile(username)
+                for username in usernames
+                if username not in self.server.missing
+            ])
+        self.send_json(404, dict(error = 'not_found'))
+
+
+class StubIdentityProvider(ThreadingHTTPServer):
+    """
+    Stub identity provider that serves tokens, profiles and the portal user endpoints.
+
+    Counts the requests to each endpoint and the connections that it receives.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.counts_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the behaviour and counts of the stub.
+        """
+        #: Profiles to use for specific users, instead of the default profile
+        self.profiles = {}
+        #: Users that do not exist in the portal
+        self.missing = set()
+        #: Users whose profile cannot be fetched from the portal
+        self.broken = set()
+        #: Indicates whether the portal user endpoints are unavailable
+        self.unavailable = False
+        #: Authorisation codes that are rejected by the token endpoint
+        self.bad_codes = {'bad'}
+        #: Function that returns extra fields for the token response for a user
+        self.token_extra = None
+        #: Indicates whether the profile endpoint supports conditional requests
+        self.etags = False
+        #: Path => JSON document for extra endpoints, e.g. OIDC discovery
+        self.documents = {}
+        with self.counts_lock:
+            self.counts = collections.Counter()
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] += 1
+
+    def process_request(self, request, client_address):
+        # This is called once for each new connection
+        self.count('connections')
+        super().process_request(request, client_address)
+
+    def get_profile(self, username):
+        return self.profiles.get(username) or dict(
+            username = username,
+            first_name = 'Joe',
+            last_name = 'Bloggs',
+            email = '{}@example.com'.format(username)
+        )
+
+    def get_token_extra(self, username):
+        return self.token_extra(username) if self.token_extra else {}
+
+    def settings(self, **kwargs):
+        """
+        Returns JASMIN_AUTH settings that use this stub for the given overrides.
+        """
+        return dict(
+            CLIENT_ID = 'tests',
+            CLIENT_SECRET = 'tests',
+            AUTHORIZE_URL = self.base_url + '/authorize',
+            ACCESS_TOKEN_URL = self.base_url + '/token',
+            PROFILE_URL = self.base_url + '/profile',
+            **kwargs
+        )
+
+    def start(self):
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
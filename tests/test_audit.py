@@ -0,0 +1,52 @@
+import os
+import threading
+import unittest
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+
+from jasmin_auth import audit
+from jasmin_auth.models import ImpersonationEvent
+
+
+UserModel = get_user_model()
+
+
+class AuditTestCase(TestCase):
+    """
+    Tests for recording impersonation audit events.
+    """
+    def setUp(self):
+        self.staff = UserModel.objects.create_user('staff', is_staff = True)
+        self.target = UserModel.objects.create_user('target')
+
+    def test_events_are_written_on_commit(self):
+        with self.captureOnCommitCallbacks(execute = True):
+            audit.record(ImpersonationEvent.STARTED, self.staff, self.target, timezone.now())
+            self.assertFalse(ImpersonationEvent.objects.exists())
+        event = ImpersonationEvent.objects.get()
+        self.assertEqual(event.impersonator, self.staff)
+        self.assertEqual(event.impersonatee, self.target)
+
+    def test_buffered_events_are_flushed(self):
+        buffer = audit.AuditBuffer()
+        buffer._thread = threading.current_thread()
+        buffer.add((ImpersonationEvent.ENDED, self.staff, self.target, timezone.now()))
+        self.assertFalse(ImpersonationEvent.objects.exists())
+        buffer.flush()
+        self.assertEqual(ImpersonationEvent.objects.get().event_type, ImpersonationEvent.ENDED)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_buffer_is_reset_after_fork(self):
+        event = (ImpersonationEvent.STARTED, self.staff, self.target, timezone.now())
+        with mock.patch.object(audit._buffer, '_thread', threading.current_thread()), \
+             mock.patch.object(audit._buffer, '_events', [event]):
+            pid = os.fork()
+            if pid == 0:
+                # In the child, the buffer must start again with no thread and no events
+                ok = audit._buffer._thread is None and audit._buffer._events == []
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
@@ -0,0 +1,150 @@
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
+
+from jasmin_auth.cache import (
+    IDENTITY_HEADER,
+    get_cache,
+    get_impersonatee,
+    impersonatee_cache_stats,
+    user_generation_key
+)
+from jasmin_auth.settings import app_settings
+
+
+UserModel = get_user_model()
+
+
+@override_settings(JASMIN_AUTH = dict(CLIENT_ID = 'tests', IMPERSONATE_CACHE_TIMEOUT = 300))
+class ImpersonateeCacheTestCase(TestCase):
+    """
+    Tests for the impersonatee cache.
+    """
+    def setUp(self):
+        get_cache().clear()
+        impersonatee_cache_stats.reset()
+        self.staff = UserModel.objects.create_user('staff', is_staff = True)
+        self.target = UserModel.objects.create_user('target')
+
+    def impersonate(self):
+        self.client.force_login(self.staff)
+        session = self.client.session
+        session[app_settings.IMPERSONATE_SESSION_KEY] = str(self.target.pk)
+        session.save()
+
+    def test_lookup_is_cached(self):
+        self.assertEqual(get_impersonatee(self.staff, self.target.pk), (self.target, True))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_impersonatee(self.staff, self.target.pk), (self.target, True))
+        self.assertEqual(impersonatee_cache_stats.as_dict(), dict(hits = 1, misses = 1))
+
+    def test_middleware_uses_cache(self):
+        self.impersonate()
+        self.client.get('/whoami/')
+        # Only the session and the impersonator are loaded
+        with self.assertNumQueries(2):
+            response = self.client.get('/whoami/')
+        self.assertEqual(response.json(), dict(user = 'target', impersonator = 'staff'))
+
+    def test_save_invalidates_after_commit(self):
+        get_impersonatee(self.staff, self.target.pk)
+        key = user_generation_key(self.target.pk)
+        generation = get_cache().get(key)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.target.is_staff = True
+            self.target.save()
+            # Until the transaction commits, other requests would see the old row
+            self.assertEqual(get_cache().get(key), generation)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(get_cache().get(key), generation)
+        # Staff users cannot be impersonated by other staff users
+        self.assertEqual(get_impersonatee(self.staff, self.target.pk), (self.target, False))
+        self.assertEqual(impersonatee_cache_stats.as_dict(), dict(hits = 0, misses = 2))
+
+    def test_permission_changes_apply_immediately(self):
+        self.impersonate()
+        self.assertEqual(self.client.get('/whoami/').json()['user'], 'target')
+        with self.captureOnCommitCallbacks(execute = True):
+            self.target.is_staff = True
+            self.target.save()
+        self.assertEqual(self.client.get('/whoami/').json()['user'], 'staff')
+        with self.captureOnCommitCallbacks(execute = True):
+            self.staff.is_superuser = True
+            self.staff.save()
+        self.assertEqual(self.client.get('/whoami/').json()['user'], 'target')
+
+    def test_delete_invalidates(self):
+        self.impersonate()
+        self.client.get('/whoami/')
+        with self.captureOnCommitCallbacks(execute = True):
+            self.target.delete()
+        self.assertEqual(self.client.get('/whoami/').json()['user'], 'staff')
+        self.assertNotIn(app_settings.IMPERSONATE_SESSION_KEY, self.client.session)
+
+
+class IdentityCacheTestCase(TestCase):
+    """
+    Tests for caching responses per identity.
+    """
+    def setUp(self):
+        get_cache().clear()
+        cache.clear()
+        self.staff = UserModel.objects.create_user('staff', is_staff = True)
+        self.target = UserModel.objects.create_user('target')
+
+    def test_anonymous_response_is_shared(self):
+        response = self.client.get('/cached/')
+        self.assertIn(IDENTITY_HEADER, response['Vary'])
+        self.assertNotIn('private', response.get('Cache-Control', ''))
+        # Other cookies do not affect the cache key
+        self.client.cookies['tracking'] = 'abc'
+        with mock.patch('tests.urls.whoami', side_effect = AssertionError):
+            self.assertEqual(self.client.get('/cached/').json()['user'], '')
+
+    def test_authenticated_response_is_private(self):
+        self.client.force_login(self.staff)
+        response = self.client.get('/cached/')
+        self.assertIn('private', response['Cache-Control'])
+        self.assertEqual(response.json()['user'], 'staff')
+        # The response is still cached, and is also private when served from the cache
+        self.client.cookies['tracking'] = 'abc'
+        with mock.patch('tests.urls.whoami', side_effect = AssertionError):
+            response = self.client.get('/cached/')
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_cached_per_identity(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get('/cached/').json()['user'], 'staff')
+        # The same user in another session gets the cached response
+        other = Client()
+        other.force_login(self.staff)
+        with mock.patch('tests.urls.whoami', side_effect = AssertionError):
+            self.assertEqual(other.get('/cached/').json()['user'], 'staff')
+        # Impersonating changes the identity
+        session = self.client.session
+        session[app_settings.IMPERSONATE_SESSION_KEY] = str(self.target.pk)
+        session.save()
+        response = self.client.get('/cached/')
+        self.assertEqual(response.json(), dict(user = 'target', impersonator = 'staff'))
+
+    def test_per_site_cache(self):
+        middleware = [
+            'jasmin_auth.middleware.IdentityCacheControlMiddleware',
+            'django.middleware.cache.UpdateCacheMiddleware',
+            *settings.MIDDLEWARE,
+            'jasmin_auth.middleware.IdentityCacheMiddleware',
+            'django.middleware.cache.FetchFromCacheMiddleware',
+        ]
+        with self.settings(MIDDLEWARE = middleware):
+            self.client.force_login(self.staff)
+            response = self.client.get('/whoami/')
+            self.assertIn('private', response['Cache-Control'])
+            with mock.patch('tests.urls.JsonResponse', side_effect = AssertionError):
+                response = self.client.get('/whoami/')
+            self.assertEqual(response.json()['user'], 'staff')
+            self.client.logout()
+            self.assertEqual(self.client.get('/whoami/').json()['user'], '')
@@ -0,0 +1,83 @@
+import time
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from django.test import RequestFactory, TestCase, override_settings
+
+from jasmin_auth import coalesce
+from jasmin_auth.cache import get_cache
+
+from .stub_idp import StubIdentityProvider
+
+
+class CoalesceTestCase(TestCase):
+    """
+    Tests for coalescing duplicate callbacks.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.idp = StubIdentityProvider().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.idp.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.idp.reset()
+        get_cache().clear()
+        self.settings = self.idp.settings(
+            CALLBACK_COALESCE_TIMEOUT = 10,
+            CALLBACK_COALESCE_WAIT = 0.2
+        )
+
+    def make_request(self):
+        return RequestFactory().get('/auth/callback/', dict(code = 'jbloggs', state = 'abc'))
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(coalesce.get_flight(self.make_request()))
+
+    def test_duplicate_callback_reuses_result(self):
+        with override_settings(JASMIN_AUTH = self.settings):
+            response = self.client.get('/auth/login/')
+            state = parse_qs(urlparse(response.url).query)['state'][0]
+            params = dict(code = 'jbloggs', state = state)
+            first = self.client.get('/auth/callback/', params)
+            second = self.client.get('/auth/callback/', params)
+        self.assertEqual(second.status_code, 302)
+        self.assertEqual(second.url, first.url)
+        self.assertEqual(self.idp.counts['token'], 1)
+
+    def test_follower_wait_is_bounded(self):
+        with override_settings(JASMIN_AUTH = self.settings):
+            leader = coalesce.get_flight(self.make_request())
+            self.assertIsNone(leader.join())
+            self.assertTrue(leader.leader)
+            try:
+                # A follower in this process waits on the event
+                start = time.monotonic()
+                follower = coalesce.get_flight(self.make_request())
+                self.assertIsNone(follower.join())
+                self.assertLess(time.monotonic() - start, 2)
+                self.assertFalse(follower.leader)
+                # A follower in another process polls the cache
+                with mock.patch.dict(coalesce._flights, clear = True):
+                    start = time.monotonic()
+                    self.assertIsNone(coalesce.get_flight(self.make_request()).join())
+                    self.assertLess(time.monotonic() - start, 2)
+            finally:
+                leader.release()
+
+    def test_cache_is_not_accessed_under_lock(self):
+        cache = get_cache()
+        add = cache.add
+        def checked_add(*args, **kwargs):
+            self.assertFalse(coalesce._flights_lock.locked())
+            return add(*args, **kwargs)
+        with override_settings(JASMIN_AUTH = self.settings):
+            flight = coalesce.get_flight(self.make_request())
+            with mock.patch.object(cache, 'add', checked_add):
+                self.assertIsNone(flight.join())
+            flight.release()
+        self.assertEqual(coalesce._flights, {})
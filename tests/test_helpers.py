@@ -0,0 +1,134 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import Resolver404
+
+from jasmin_auth import helpers
+from jasmin_auth.helpers import asave_user_from_profile, save_user_from_profile
+
+
+UserModel = get_user_model()
+
+
+PROFILE = dict(
+    username = 'jbloggs',
+    first_name = 'Joe',
+    last_name = 'Bloggs',
+    email = 'joe.bloggs@example.com'
+)
+
+
+class SaveUserFromProfileTestCase(TestCase):
+    """
+    Tests for creating and updating users from profiles.
+    """
+    def test_create(self):
+        user, written = save_user_from_profile(PROFILE)
+        self.assertTrue(written)
+        self.assertEqual(user.email, PROFILE['email'])
+        # Users are created with create_user
+        self.assertFalse(user.has_usable_password())
+
+    def test_unchanged_profile_is_not_written(self):
+        save_user_from_profile(PROFILE)
+        with self.assertNumQueries(1):
+            user, written = save_user_from_profile(PROFILE)
+        self.assertFalse(written)
+
+    def test_only_changed_fields_are_written(self):
+        user, _ = save_user_from_profile(PROFILE)
+        # Changes to fields that are not in the profile must not be overwritten
+        UserModel.objects.filter(pk = user.pk).update(is_staff = True)
+        with self.assertNumQueries(2):
+            user, written = save_user_from_profile(dict(PROFILE, email = 'jb@example.com'))
+        self.assertTrue(written)
+        user = UserModel.objects.get()
+        self.assertEqual(user.email, 'jb@example.com')
+        self.assertTrue(user.is_staff)
+
+    async def test_async(self):
+        user, written = await asave_user_from_profile(PROFILE)
+        self.assertTrue(written)
+        user, written = await asave_user_from_profile(PROFILE)
+        self.assertFalse(written)
+        user, written = await asave_user_from_profile(dict(PROFILE, email = 'jb@example.com'))
+        self.assertTrue(written)
+        self.assertEqual((await UserModel.objects.aget()).email, 'jb@example.com')
+
+
+class ImpersonationPermittedRequestTestCase(SimpleTestCase):
+    """
+    Tests for checking whether impersonation is permitted for a request.
+    """
+    def setUp(self):
+        helpers.clear_path_decisions()
+        self.addCleanup(helpers.clear_path_decisions)
+
+    def permitted(self, path, urlconf = None):
+        request = RequestFactory().get(path)
+        if urlconf:
+            request.urlconf = urlconf
+        return helpers.impersonation_permitted_request(request)
+
+    def settings(self, **settings):
+        return override_settings(JASMIN_AUTH = dict(CLIENT_ID = 'tests', **settings))
+
+    def test_disabled_patterns(self):
+        with self.settings(IMPERSONATE_DISABLED_PATTERNS = ('^/admin', '^/who')):
+            self.assertEqual(len(helpers.compile_disabled_patterns(('^/admin', '^/who'))), 1)
+            self.assertFalse(self.permitted('/admin/'))
+            self.assertFalse(self.permitted('/whoami/'))
+            self.assertTrue(self.permitted('/plain/'))
+
+    def test_patterns_with_backreferences_are_not_combined(self):
+        patterns = ('^/(admin|staff)/', r'^/(\w+)/\1/')
+        self.assertEqual(len(helpers.compile_disabled_patterns(patterns)), 2)
+        with self.settings(IMPERSONATE_DISABLED_PATTERNS = patterns):
+            # The path would not resolve, so it must be matched by the second pattern
+            self.assertFalse(self.permitted('/foo/foo/'))
+
+    def test_patterns_with_flags_are_not_combined(self):
+        patterns = ('(?i)^/admin', '^/who')
+        self.assertEqual(len(helpers.compile_disabled_patterns(patterns)), 2)
+        with self.settings(IMPERSONATE_DISABLED_PATTERNS = patterns):
+            self.assertFalse(self.permitted('/ADMIN/'))
+
+    def test_decisions_are_cached(self):
+        with self.settings(IMPERSONATE_PATH_CACHE_SIZE = 2):
+            self.assertTrue(self.permitted('/plain/'))
+            with mock.patch.object(helpers, 'resolve') as resolve:
+                self.assertTrue(self.permitted('/plain/'))
+                resolve.assert_not_called()
+
+    def test_least_recently_used_path_is_evicted(self):
+        with self.settings(IMPERSONATE_PATH_CACHE_SIZE = 2):
+            self.permitted('/plain/')
+            self.permitted('/whoami/')
+            # Using the first path again makes the second the least recently used
+            self.permitted('/plain/')
+            self.permitted('/cached/')
+            self.assertEqual(
+                list(helpers._path_decisions),
+                [(None, '/plain/'), (None, '/cached/')]
+            )
+
+    def test_unknown_paths_are_not_cached(self):
+        with self.settings(IMPERSONATE_PATH_CACHE_SIZE = 2):
+            with self.assertRaises(Resolver404):
+                self.permitted('/does-not-exist/')
+            self.assertEqual(len(helpers._path_decisions), 0)
+
+    def test_decisions_are_per_urlconf(self):
+        with self.settings(IMPERSONATE_PATH_CACHE_SIZE = 2):
+            self.assertTrue(self.permitted('/plain/'))
+            self.assertFalse(self.permitted('/plain/', 'tests.other_urls'))
+            self.assertTrue(self.permitted('/plain/'))
+
+    def test_decisions_are_cleared_when_settings_change(self):
+        self.assertTrue(self.permitted('/plain/'))
+        with self.settings(IMPERSONATE_DISABLED_PATTERNS = ('^/plain', )):
+            self.assertFalse(self.permitted('/plain/'))
+        self.assertTrue(self.permitted('/plain/'))
+        with override_settings(ROOT_URLCONF = 'tests.other_urls'):
+            self.assertFalse(self.permitted('/plain/'))
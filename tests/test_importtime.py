@@ -0,0 +1,18 @@
+from django.test import SimpleTestCase
+
+from benchmarks import importtime
+
+
+class ImportTimeTestCase(SimpleTestCase):
+    """
+    Tests for the modules that are imported when a worker starts.
+
+    The import time budget depends on the machine, so it is only checked by
+    ``python -m benchmarks.importtime``.
+    """
+    def test_lazy_packages_are_not_imported(self):
+        # The child process inherits the test settings
+        entries = importtime.measure()
+        outermost, _ = importtime.package_imports(entries)
+        self.assertIn('jasmin_auth.middleware', dict(outermost))
+        self.assertEqual(importtime.lazy_imports(entries), [])
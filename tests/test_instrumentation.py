@@ -0,0 +1,58 @@
+from django.test import SimpleTestCase, override_settings
+
+from oauthlib.oauth2.rfc6749.errors import CustomOAuth2Error, InvalidGrantError
+
+from jasmin_auth import instrumentation
+from jasmin_auth.oidc import IdTokenError
+
+
+@override_settings(JASMIN_AUTH = dict(CLIENT_ID = 'tests', METRICS_ENABLED = True))
+class MetricsTestCase(SimpleTestCase):
+    """
+    Tests for collecting phase metrics.
+    """
+    def setUp(self):
+        instrumentation.configure_metrics()
+
+    def tearDown(self):
+        with self.settings(JASMIN_AUTH = dict(CLIENT_ID = 'tests')):
+            instrumentation.configure_metrics()
+
+    def time_error(self, exc):
+        try:
+            with instrumentation.timed('fetch_token'):
+                raise exc
+        except Exception:
+            pass
+
+    def test_render(self):
+        with instrumentation.timed('fetch_token') as phase:
+            phase.outcome = 'not_modified'
+        output = instrumentation.collector.render()
+        self.assertIn('jasmin_auth_phase_duration_seconds_count{phase="fetch_token"} 1', output)
+        self.assertIn(
+            'jasmin_auth_phase_total{phase="fetch_token",outcome="not_modified"} 1',
+            output
+        )
+
+    def test_known_errors_are_outcomes(self):
+        self.time_error(InvalidGrantError())
+        self.time_error(IdTokenError('bad signature'))
+        self.time_error(ValueError())
+        outcomes = instrumentation.collector.outcomes
+        self.assertEqual(outcomes[('fetch_token', 'invalid_grant')], 1)
+        self.assertEqual(outcomes[('fetch_token', 'invalid_id_token')], 1)
+        self.assertEqual(outcomes[('fetch_token', 'error')], 1)
+
+    def test_unknown_provider_errors_are_bounded(self):
+        for index in range(10):
+            self.time_error(CustomOAuth2Error('made_up_{}'.format(index)))
+        self.assertEqual(instrumentation.collector.outcomes, { ('fetch_token', 'error'): 10 })
+
+    def test_label_values_are_escaped(self):
+        instrumentation.send('a"b\\c\nd', 0.1, 'ok')
+        output = instrumentation.collector.render()
+        self.assertIn('phase="a\\"b\\\\c\\nd"', output)
+        # Each sample is on its own line
+        for line in output.splitlines():
+            self.assertTrue(line.startswith(('#', 'jasmin_auth_')), line)
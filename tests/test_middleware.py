@@ -0,0 +1,170 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+
+from jasmin_auth.middleware import ImpersonateMiddleware
+from jasmin_auth.settings import app_settings
+
+
+UserModel = get_user_model()
+
+
+class ImpersonateMiddlewareTestCase(TestCase):
+    """
+    Tests for the impersonation middleware.
+    """
+    def setUp(self):
+        self.staff = UserModel.objects.create_user('staff', is_staff = True)
+        self.target = UserModel.objects.create_user('target')
+
+    def impersonate(self, user):
+        self.client.force_login(self.staff)
+        session = self.client.session
+        session[app_settings.IMPERSONATE_SESSION_KEY] = str(user.pk)
+        session.save()
+
+    def make_request(self, path, impersonated_pk = None):
+        """
+        Passes a request for the given path through the middleware and returns it.
+        """
+        session = SessionStore()
+        if impersonated_pk is not None:
+            session[app_settings.IMPERSONATE_SESSION_KEY] = impersonated_pk
+        session.save()
+        request = RequestFactory().get(path)
+        request.COOKIES['sessionid'] = session.session_key
+        request.session = SessionStore(session.session_key)
+        request.user = self.staff
+        ImpersonateMiddleware(lambda request: HttpResponse())(request)
+        return request
+
+    def test_untouched_user_makes_no_queries(self):
+        self.impersonate(self.target)
+        # The only query is for the session, which is loaded to find the impersonated user
+        with self.assertNumQueries(1):
+            self.client.get('/plain/')
+
+    def test_impersonation(self):
+        self.impersonate(self.target)
+        response = self.client.get('/whoami/')
+        self.assertEqual(response.json(), dict(user = 'target', impersonator = 'staff'))
+
+    def test_no_impersonation(self):
+        self.client.force_login(self.staff)
+        response = self.client.get('/whoami/')
+        self.assertEqual(response.json(), dict(user = 'staff', impersonator = None))
+
+    def test_attributes_are_users_or_none(self):
+        request = self.make_request('/plain/', self.target.pk)
+        self.assertEqual(request.user, self.target)
+        self.assertIs(type(request.impersonator), UserModel)
+        self.assertEqual(request.impersonator, self.staff)
+        self.assertIsNone(request.impersonatee)
+
+    def test_disabled_path(self):
+        request = self.make_request('/admin/', self.target.pk)
+        self.assertEqual(request.user, self.staff)
+        self.assertIsNone(request.impersonator)
+        self.assertEqual(request.impersonatee, self.target)
+
+    def test_unknown_path(self):
+        # The path cannot be resolved, so impersonation is disabled for the request
+        request = self.make_request('/does-not-exist/', self.target.pk)
+        self.assertEqual(request.user, self.staff)
+        self.assertIsNone(request.impersonator)
+        self.assertEqual(request.impersonatee, self.target)
+
+    def test_unknown_path_is_not_found(self):
+        # The user is first looked at by the 404 handler
+        self.impersonate(self.target)
+        response = self.client.get('/does-not-exist/')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.content, b'staff')
+
+    def test_not_permitted(self):
+        other = UserModel.objects.create_user('other', is_staff = True)
+        request = self.make_request('/plain/', other.pk)
+        self.assertEqual(request.user, self.staff)
+        self.assertIsNone(request.impersonator)
+        self.assertIsNone(request.impersonatee)
+
+    def test_without_impersonation(self):
+        request = self.make_request('/plain/')
+        self.assertIs(request.user, self.staff)
+        self.assertIsNone(request.impersonator)
+        self.assertIsNone(request.impersonatee)
+
+    def test_missing_user_is_removed_from_session(self):
+        self.impersonate(self.target)
+        self.target.delete()
+        self.assertEqual(self.client.get('/whoami/').json()['user'], 'staff')
+        self.assertNotIn(app_settings.IMPERSONATE_SESSION_KEY, self.client.session)
+
+    def test_end_impersonation(self):
+        self.impersonate(self.target)
+        response = self.client.get('/admin/')
+        self.assertContains(response, 'Currently impersonating')
+        self.client.get('/admin/impersonate_end/')
+        self.assertEqual(self.client.get('/whoami/').json()['user'], 'staff')
+
+
+@override_settings(JASMIN_AUTH = dict(
+    CLIENT_ID = 'tests',
+    AUDIT_BACKGROUND = False,
+    IMPERSONATE_EXEMPT_PATH_PREFIXES = ['/plain/']
+))
+class SessionNotLoadedTestCase(TestCase):
+    """
+    Tests that the impersonation middleware does not load the session when it can tell
+    that the request is not impersonated.
+    """
+    def setUp(self):
+        self.staff = UserModel.objects.create_user('staff', is_staff = True)
+        # Spy on the session store, so that the tests do not depend on the session engine
+        # making queries
+        for name in ('load', 'exists'):
+            patcher = mock.patch.object(
+                SessionStore,
+                name,
+                autospec = True,
+                side_effect = getattr(SessionStore, name)
+            )
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def resetSpies(self):
+        # Logging in creates and loads the session, so start counting from here
+        self.load.reset_mock()
+        self.exists.reset_mock()
+
+    def assertSessionNotLoaded(self):
+        self.load.assert_not_called()
+        self.exists.assert_not_called()
+
+    def test_anonymous(self):
+        self.client.get('/whoami/')
+        self.assertSessionNotLoaded()
+
+    async def test_anonymous_async(self):
+        await self.async_client.get('/whoami/')
+        self.assertSessionNotLoaded()
+
+    def test_exempt_path(self):
+        self.client.force_login(self.staff)
+        self.resetSpies()
+        self.client.get('/plain/')
+        self.assertSessionNotLoaded()
+        # Other paths do load the session
+        self.client.get('/whoami/')
+        self.load.assert_called()
+
+    async def test_exempt_path_async(self):
+        await self.async_client.aforce_login(self.staff)
+        self.resetSpies()
+        await self.async_client.get('/plain/')
+        self.assertSessionNotLoaded()
+        await self.async_client.get('/whoami/')
+        self.load.assert_called()
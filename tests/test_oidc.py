@@ -0,0 +1,169 @@
+import time
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+
+from jasmin_auth import oidc
+from jasmin_auth.cache import get_cache
+
+from .stub_idp import StubIdentityProvider
+
+
+UserModel = get_user_model()
+
+
+def make_rsa_key():
+    return rsa.generate_private_key(public_exponent = 65537, key_size = 2048)
+
+
+def make_jwk(private_key, kid):
+    """
+    Returns the public JWK for the given private key.
+    """
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        jwk = jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key(), as_dict = True)
+    else:
+        jwk = jwt.algorithms.ECAlgorithm.to_jwk(private_key.public_key(), as_dict = True)
+    return dict(jwk, kid = kid)
+
+
+class IdTokenTestCase(TestCase):
+    """
+    Tests for building the user from a verified ID token, using locally generated keys.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.idp = StubIdentityProvider().start()
+        cls.rsa_key = make_rsa_key()
+        cls.ec_key = ec.generate_private_key(ec.SECP256R1())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.idp.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.idp.reset()
+        oidc.clear_documents()
+        get_cache().clear()
+        self.idp.documents['/.well-known/openid-configuration'] = dict(
+            issuer = self.idp.base_url,
+            jwks_uri = self.idp.base_url + '/jwks'
+        )
+        self.set_keys(('rsa', self.rsa_key), ('ec', self.ec_key))
+        # By default, the token response contains an ID token signed with the RSA key
+        self.signing_key = ('rsa', self.rsa_key, 'RS256')
+        self.claims = {}
+        self.idp.token_extra = lambda username: dict(id_token = self.make_id_token(username))
+        self.settings = self.idp.settings(
+            SCOPES = ['openid', 'profile', 'email'],
+            ID_TOKEN_PROFILE = True,
+            ID_TOKEN_ALGORITHMS = ('RS256', 'ES256'),
+            OIDC_DISCOVERY_URL = self.idp.base_url + '/.well-known/openid-configuration',
+            OIDC_JWKS_MIN_REFRESH_INTERVAL = 0
+        )
+
+    def set_keys(self, *keys):
+        self.idp.documents['/jwks'] = dict(keys = [make_jwk(key, kid) for kid, key in keys])
+
+    def make_id_token(self, username):
+        kid, key, algorithm = self.signing_key
+        now = int(time.time())
+        claims = dict(
+            iss = self.idp.base_url,
+            aud = 'tests',
+            sub = username,
+            iat = now,
+            exp = now + 300,
+            preferred_username = username,
+            given_name = 'Joe',
+            family_name = 'Token',
+            email = '{}@token.example.com'.format(username),
+        )
+        claims.update(self.claims)
+        claims = { name: value for name, value in claims.items() if value is not None }
+        return jwt.encode(claims, key, algorithm = algorithm, headers = dict(kid = kid))
+
+    def login(self, username, **settings):
+        """
+        Runs the login flow for the given username and returns the callback response.
+        """
+        with override_settings(JASMIN_AUTH = dict(self.settings, **settings)):
+            response = self.client.get('/auth/login/')
+            state = parse_qs(urlparse(response.url).query)['state'][0]
+            return self.client.get('/auth/callback/', dict(code = username, state = state))
+
+    def test_user_from_id_token(self):
+        response = self.login('jbloggs')
+        self.assertRedirects(response, '/whoami/', fetch_redirect_response = False)
+        user = UserModel.objects.get(username = 'jbloggs')
+        self.assertEqual(user.last_name, 'Token')
+        self.assertEqual(user.email, 'jbloggs@token.example.com')
+        self.assertEqual(self.idp.counts['profile'], 0)
+        # The discovery document and keys are kept in memory after the first login
+        self.login('jbloggs2')
+        self.assertEqual(self.idp.counts['/.well-known/openid-configuration'], 1)
+        self.assertEqual(self.idp.counts['/jwks'], 1)
+
+    def test_ec_key(self):
+        self.signing_key = ('ec', self.ec_key, 'ES256')
+        self.login('jbloggs')
+        self.assertEqual(UserModel.objects.get().last_name, 'Token')
+        self.assertEqual(self.idp.counts['profile'], 0)
+
+    def test_key_rotation_refreshes_keys(self):
+        self.login('jbloggs')
+        new_key = make_rsa_key()
+        self.set_keys(('rsa2', new_key))
+        self.signing_key = ('rsa2', new_key, 'RS256')
+        self.login('jbloggs2')
+        self.assertEqual(UserModel.objects.get(username = 'jbloggs2').last_name, 'Token')
+        self.assertEqual(self.idp.counts['/jwks'], 2)
+
+    def test_invalid_signature(self):
+        # Sign with a key that has the same key ID as a published key
+        self.signing_key = ('rsa', make_rsa_key(), 'RS256')
+        response = self.login('jbloggs')
+        self.assertEqual(response.context['error'], 'invalid_id_token')
+        self.assertFalse(UserModel.objects.exists())
+
+    def test_wrong_audience(self):
+        self.claims = dict(aud = 'other')
+        response = self.login('jbloggs')
+        self.assertEqual(response.context['error'], 'invalid_id_token')
+
+    def test_missing_claims_fall_back_to_profile(self):
+        self.claims = dict(family_name = None)
+        self.login('jbloggs')
+        self.assertEqual(UserModel.objects.get().last_name, 'Bloggs')
+        self.assertEqual(self.idp.counts['profile'], 1)
+
+    def test_id_token_is_decoded_once(self):
+        self.idp.etags = True
+        settings = dict(PROFILE_FRESHNESS_WINDOW = 300, PROFILE_CONDITIONAL_REQUESTS = True)
+        with mock.patch.object(oidc, 'decode_id_token', wraps = oidc.decode_id_token) as decode:
+            self.login('jbloggs', **settings)
+            self.assertEqual(decode.call_count, 1)
+            # The second login is within the freshness window
+            self.login('jbloggs', **settings)
+            self.assertEqual(decode.call_count, 2)
+        self.assertEqual(self.idp.counts['profile'], 0)
+
+    def test_keys_are_fetched_outside_lock(self):
+        self.login('jbloggs')
+        new_key = make_rsa_key()
+        self.set_keys(('rsa2', new_key))
+        self.signing_key = ('rsa2', new_key, 'RS256')
+        fetch_json = oidc.fetch_json
+        def checked_fetch_json(url):
+            self.assertFalse(oidc._documents_lock.locked())
+            return fetch_json(url)
+        with mock.patch.object(oidc, 'fetch_json', checked_fetch_json):
+            self.login('jbloggs2')
+        self.assertEqual(self.idp.counts['/jwks'], 2)
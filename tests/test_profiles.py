@@ -0,0 +1,129 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+
+from jasmin_auth import profiles
+from jasmin_auth.cache import get_cache
+
+
+UserModel = get_user_model()
+
+
+PROFILE = dict(
+    username = 'jbloggs',
+    first_name = 'Joe',
+    last_name = 'Bloggs',
+    email = 'joe.bloggs@example.com'
+)
+
+
+class Response:
+    """
+    Minimal stand-in for a profile response.
+    """
+    def __init__(self, status_code, profile = None, etag = None):
+        self.status_code = status_code
+        self.profile = profile
+        self.headers = { 'ETag': etag } if etag else {}
+
+    def json(self):
+        return self.profile
+
+
+class Provider:
+    """
+    Stand-in for the OAuth session that returns the given responses in order and records
+    the headers of each request.
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers = None):
+        self.requests.append(headers or {})
+        return self.responses.pop(0)
+
+
+@override_settings(JASMIN_AUTH = dict(
+    CLIENT_ID = 'tests',
+    PROFILE_URL = 'https://idp.example.com/profile',
+    TOKEN_USERNAME_KEY = 'username',
+    PROFILE_FRESHNESS_WINDOW = 300,
+    PROFILE_CONDITIONAL_REQUESTS = True
+))
+class GetUserForTokenTestCase(TestCase):
+    """
+    Tests for getting the user for a token response.
+    """
+    token = dict(access_token = 'token', username = 'jbloggs')
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_profile_is_fetched_and_recorded(self):
+        provider = Provider(Response(200, PROFILE, '"v1"'))
+        user = profiles.get_user_for_token(provider, self.token)
+        self.assertEqual(user.email, PROFILE['email'])
+        self.assertEqual(profiles.get_sync_record('jbloggs')['etag'], '"v1"')
+
+    def test_fresh_user_is_not_fetched(self):
+        profiles.get_user_for_token(Provider(Response(200, PROFILE, '"v1"')), self.token)
+        provider = Provider()
+        with self.assertNumQueries(1):
+            user = profiles.get_user_for_token(provider, self.token)
+        self.assertEqual(user.username, 'jbloggs')
+        self.assertEqual(provider.requests, [])
+
+    def test_fresh_but_deleted_user_is_fetched(self):
+        profiles.get_user_for_token(Provider(Response(200, PROFILE, '"v1"')), self.token)
+        UserModel.objects.all().delete()
+        provider = Provider(Response(200, PROFILE, '"v1"'))
+        profiles.get_user_for_token(provider, self.token)
+        self.assertEqual(UserModel.objects.get().username, 'jbloggs')
+
+    def test_not_modified(self):
+        profiles.get_user_for_token(Provider(Response(200, PROFILE, '"v1"')), self.token)
+        # Expire the record so that a conditional request is made
+        record = profiles.get_sync_record('jbloggs')
+        get_cache().set(profiles.sync_record_key('jbloggs'), dict(record, synced_at = 0))
+        provider = Provider(Response(304))
+        with self.assertNumQueries(1):
+            user = profiles.get_user_for_token(provider, self.token)
+        self.assertEqual(user.username, 'jbloggs')
+        self.assertEqual(provider.requests, [{ 'If-None-Match': '"v1"' }])
+        # The sync time is refreshed and the ETag kept
+        record = profiles.get_sync_record('jbloggs')
+        self.assertGreater(record['synced_at'], 0)
+        self.assertEqual(record['etag'], '"v1"')
+
+    def test_not_modified_without_record_is_a_miss(self):
+        # The user exists but the record has been evicted from the cache
+        UserModel.objects.create_user('jbloggs')
+        provider = Provider(Response(304), Response(200, PROFILE, '"v1"'))
+        user = profiles.get_user_for_token(provider, self.token)
+        self.assertEqual(user.email, PROFILE['email'])
+        self.assertEqual(provider.requests, [{}, {}])
+        self.assertEqual(profiles.get_sync_record('jbloggs')['etag'], '"v1"')
+
+    def test_not_modified_for_deleted_user_refetches(self):
+        profiles.get_user_for_token(Provider(Response(200, PROFILE, '"v1"')), self.token)
+        UserModel.objects.all().delete()
+        # Deleting the user clears the record, but it may be restored by a concurrent login
+        get_cache().set(profiles.sync_record_key('jbloggs'), dict(synced_at = 0, etag = '"v1"'))
+        provider = Provider(Response(304), Response(200, PROFILE, '"v1"'))
+        profiles.get_user_for_token(provider, self.token)
+        self.assertEqual(UserModel.objects.get().username, 'jbloggs')
+        self.assertEqual(provider.requests, [{ 'If-None-Match': '"v1"' }, {}])
+
+    async def test_async(self):
+        responses = [Response(304), Response(200, PROFILE, '"v1"')]
+        async def aget(client, url, headers = None):
+            return responses.pop(0)
+        with mock.patch.object(profiles, 'aget', aget):
+            user = await profiles.aget_user_for_token(None, self.token)
+            self.assertEqual(user.email, PROFILE['email'])
+            # The second login is within the freshness window
+            user = await profiles.aget_user_for_token(None, self.token)
+        self.assertEqual(user.username, 'jbloggs')
+        self.assertEqual(responses, [])
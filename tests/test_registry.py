@@ -0,0 +1,87 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from jasmin_auth import registry
+from jasmin_auth.models import ActiveImpersonation
+
+
+UserModel = get_user_model()
+
+
+class RegistryTestCase(TestCase):
+    """
+    Tests for the registry of active impersonations.
+    """
+    def setUp(self):
+        self.staff = UserModel.objects.create_user('staff', is_staff = True)
+        self.target = UserModel.objects.create_user('target')
+        self.client.force_login(self.staff)
+
+    def start(self):
+        self.client.get('/admin/impersonate/{}/'.format(self.target.pk))
+        return ActiveImpersonation.objects.get()
+
+    def make_entry(self, session_key, expires_at):
+        return ActiveImpersonation.objects.create(
+            session_key = session_key,
+            impersonator = self.staff,
+            impersonatee = self.target,
+            expires_at = expires_at
+        )
+
+    def test_start_and_end(self):
+        entry = self.start()
+        self.assertEqual(entry.session_key, self.client.session.session_key)
+        self.assertEqual(entry.impersonator, self.staff)
+        self.client.get('/admin/impersonate_end/')
+        self.assertFalse(ActiveImpersonation.objects.exists())
+
+    def test_new_session_key_moves_entry(self):
+        entry = self.start()
+        self.client.get('/cycle-session/')
+        self.assertNotEqual(self.client.session.session_key, entry.session_key)
+        entry = ActiveImpersonation.objects.get()
+        self.assertEqual(entry.session_key, self.client.session.session_key)
+        # The impersonation carries on in the new session
+        self.assertEqual(self.client.get('/whoami/').json()['user'], 'target')
+        # So it can still be revoked
+        self.assertEqual(registry.revoke(ActiveImpersonation.objects.all()), 1)
+        self.assertEqual(self.client.get('/whoami/').json()['user'], 'staff')
+
+    def test_login_as_other_user_removes_entry(self):
+        self.start()
+        self.client.get('/login-as/target/')
+        self.assertFalse(ActiveImpersonation.objects.exists())
+
+    def test_prune(self):
+        active = self.start()
+        self.make_entry('expired', timezone.now() - timedelta(seconds = 1))
+        self.make_entry('deleted', timezone.now() + timedelta(days = 1))
+        stdout = StringIO()
+        call_command('jasmin_auth_prune_impersonations', stdout = stdout)
+        self.assertIn('Removed 2 impersonation registry entries.', stdout.getvalue())
+        self.assertEqual(ActiveImpersonation.objects.get(), active)
+
+    @override_settings(SESSION_SAVE_EVERY_REQUEST = True)
+    def test_rolling_sessions_ignore_expiry(self):
+        entry = self.start()
+        ActiveImpersonation.objects.update(expires_at = timezone.now() - timedelta(days = 1))
+        self.assertEqual(list(ActiveImpersonation.objects.active()), [entry])
+        self.assertFalse(ActiveImpersonation.objects.expired().exists())
+        # Pruning only removes entries whose session has gone
+        self.make_entry('deleted', timezone.now())
+        self.assertEqual(registry.prune(), 1)
+        self.assertEqual(ActiveImpersonation.objects.get(), entry)
+
+    @override_settings(SESSION_ENGINE = 'django.contrib.sessions.backends.signed_cookies')
+    def test_not_maintained_for_signed_cookies(self):
+        self.assertFalse(registry.registry_enabled())
+        self.client.force_login(self.staff)
+        self.client.get('/admin/impersonate/{}/'.format(self.target.pk))
+        self.assertEqual(self.client.get('/whoami/').json()['user'], 'target')
+        self.assertFalse(ActiveImpersonation.objects.exists())
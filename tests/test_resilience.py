@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+from django.test import SimpleTestCase
+
+from jasmin_auth.resilience import CircuitBreaker, Limiter, ProviderGuard, ProviderUnavailable
+
+
+class LimiterTestCase(SimpleTestCase):
+    """
+    Tests for the concurrency limiter.
+    """
+    def test_queue_timeout(self):
+        limiter = Limiter(1, 1, 0.01)
+        limiter.acquire()
+        with self.assertRaises(ProviderUnavailable):
+            limiter.acquire()
+
+    async def test_cancelled_wait_does_not_leak_slot(self):
+        limiter = Limiter(1, 1, 5)
+        limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.aacquire())
+        # Wait until the thread is waiting for a slot
+        while not limiter.waiting:
+            await asyncio.sleep(0.001)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        # The thread gets the slot once it is released, and gives it back
+        limiter.release()
+        deadline = time.monotonic() + 5
+        while (limiter.waiting or limiter.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.001)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertTrue(limiter.try_acquire())
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+    """
+    Tests for the circuit breaker.
+    """
+    def make_breaker(self):
+        return CircuitBreaker(
+            window = 4,
+            min_calls = 2,
+            failure_rate = 0.5,
+            reset_timeout = 0,
+            half_open_calls = 1
+        )
+
+    def fail(self, breaker, count):
+        for _ in range(count):
+            breaker.after_call(True, breaker.before_call())
+
+    def test_opens_and_closes(self):
+        breaker = self.make_breaker()
+        self.fail(breaker, 2)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        probe = breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(ProviderUnavailable):
+            breaker.before_call()
+        breaker.after_call(False, probe)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_stale_success_is_not_a_probe(self):
+        breaker = self.make_breaker()
+        slow = breaker.before_call()
+        self.fail(breaker, 2)
+        probe = breaker.before_call()
+        # A call that started before the circuit opened finishes while it is half open
+        breaker.after_call(False, slow)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(ProviderUnavailable):
+            breaker.before_call()
+        breaker.after_call(False, probe)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_stale_failure_does_not_reopen(self):
+        breaker = self.make_breaker()
+        slow = breaker.before_call()
+        self.fail(breaker, 2)
+        breaker.before_call()
+        breaker.after_call(True, slow)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+    def test_stale_cancel_does_not_free_probe(self):
+        breaker = self.make_breaker()
+        slow = breaker.before_call()
+        self.fail(breaker, 2)
+        breaker.before_call()
+        breaker.cancel_call(slow)
+        with self.assertRaises(ProviderUnavailable):
+            breaker.before_call()
+
+
+class ProviderGuardTestCase(SimpleTestCase):
+    """
+    Tests for the guard that combines the limiter and the circuit breaker.
+    """
+    async def test_cancelled_call_is_not_a_failure(self):
+        breaker = CircuitBreaker(4, 1, 0.5, 30, 1)
+        guard = ProviderGuard(Limiter(1, 1, 5), breaker)
+        started = asyncio.Event()
+        async def request():
+            started.set()
+            await asyncio.sleep(10)
+        call = asyncio.ensure_future(guard.acall(request))
+        await started.wait()
+        call.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await call
+        self.assertEqual(guard.limiter.in_flight, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(list(breaker.outcomes), [])
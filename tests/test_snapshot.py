@@ -0,0 +1,95 @@
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from jasmin_auth import snapshot
+from jasmin_auth.cache import get_cache, invalidate_users
+
+
+UserModel = get_user_model()
+
+
+@override_settings(
+    MIDDLEWARE = [
+        'jasmin_auth.middleware.SnapshotAuthenticationMiddleware'
+        if name == 'django.contrib.auth.middleware.AuthenticationMiddleware'
+        else name
+        for name in settings.MIDDLEWARE
+    ],
+    JASMIN_AUTH = dict(CLIENT_ID = 'tests', USER_SNAPSHOT = True)
+)
+class SnapshotTestCase(TestCase):
+    """
+    Tests for serving the user from a snapshot in the session.
+    """
+    def setUp(self):
+        get_cache().clear()
+        self.user = UserModel.objects.create_user('jbloggs')
+        self.client.force_login(self.user)
+        # The first request takes the snapshot
+        self.client.get('/whoami/')
+
+    def assertSnapshotUsed(self):
+        # Only the session is loaded
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/whoami/').json()['user'], 'jbloggs')
+
+    def assertSnapshotNotUsed(self):
+        # The user is loaded, and the session is saved with the new snapshot
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/whoami/')
+        self.assertTrue(any(
+            query['sql'].startswith('SELECT "auth_user"')
+            for query in context.captured_queries
+        ))
+        return response
+
+    def test_snapshot_is_used(self):
+        self.assertSnapshotUsed()
+
+    def test_save_makes_snapshot_stale(self):
+        with self.captureOnCommitCallbacks(execute = True):
+            self.user.first_name = 'Joe'
+            self.user.save()
+        self.assertSnapshotNotUsed()
+        self.assertSnapshotUsed()
+
+    def test_update_with_invalidation_makes_snapshot_stale(self):
+        with self.captureOnCommitCallbacks(execute = True):
+            UserModel.objects.filter(pk = self.user.pk).update(is_active = False)
+            invalidate_users([self.user.pk])
+        response = self.assertSnapshotNotUsed()
+        self.assertEqual(response.json()['user'], '')
+
+    def test_update_without_invalidation_is_bounded_by_max_age(self):
+        UserModel.objects.filter(pk = self.user.pk).update(is_active = False)
+        # The change is missed until the snapshot expires
+        self.assertSnapshotUsed()
+        later = time.time() + 61
+        with mock.patch('django.core.signing.time.time', return_value = later):
+            response = self.assertSnapshotNotUsed()
+        self.assertEqual(response.json()['user'], '')
+
+    def test_change_while_loading_makes_snapshot_stale(self):
+        session = self.client.session
+        del session[snapshot.app_settings.USER_SNAPSHOT_SESSION_KEY]
+        session.save()
+        get_user = auth.get_user
+        def get_user_then_change(request):
+            user = get_user(request)
+            # Another request changes the user after it has been loaded
+            with self.captureOnCommitCallbacks(execute = True):
+                UserModel.objects.filter(pk = self.user.pk).update(is_staff = True)
+                invalidate_users([self.user.pk])
+            return user
+        with mock.patch.object(snapshot.auth, 'get_user', get_user_then_change):
+            self.client.get('/whoami/')
+        # The snapshot taken with the old values must not be used
+        self.assertSnapshotNotUsed()
+        self.assertSnapshotUsed()
@@ -0,0 +1,136 @@
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+
+from jasmin_auth.cache import get_cache, user_generation_key
+
+from .stub_idp import StubIdentityProvider
+
+
+UserModel = get_user_model()
+
+
+class SyncCommandTestCase(TestCase):
+    """
+    Tests for the jasmin_auth_sync management command against the stub portal.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.idp = StubIdentityProvider().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.idp.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.idp.reset()
+        for index in range(10):
+            UserModel.objects.create_user('user{}'.format(index))
+        self.state_file = os.path.join(tempfile.mkdtemp(), 'sync.state')
+
+    def sync(self, settings = None, **options):
+        settings = dict(
+            dict(
+                SYNC_PROFILE_URL = self.idp.base_url + '/users/{username}/',
+                HTTP_MAX_RETRIES = 0
+            ),
+            **(settings or {})
+        )
+        options.setdefault('chunk_size', 3)
+        options.setdefault('workers', 2)
+        options.setdefault('state_file', self.state_file)
+        stdout = StringIO()
+        with override_settings(JASMIN_AUTH = self.idp.settings(**settings)):
+            call_command('jasmin_auth_sync', stdout = stdout, **options)
+        return stdout.getvalue()
+
+    def test_sync(self):
+        local = UserModel.objects.create_user('local', password = 'password')
+        output = self.sync()
+        self.assertIn('Synchronised 10 users, 0 missing from the portal, 0 failed.', output)
+        self.assertEqual(UserModel.objects.get(username = 'user3').email, 'user3@example.com')
+        # Users with a usable password are assumed to be local users
+        self.assertEqual(UserModel.objects.get(pk = local.pk).email, '')
+        # The state is removed once all the users have been processed
+        self.assertFalse(os.path.exists(self.state_file))
+
+    def test_bulk(self):
+        output = self.sync(dict(
+            SYNC_PROFILE_URL = None,
+            SYNC_BULK_PROFILE_URL = self.idp.base_url + '/bulk'
+        ))
+        self.assertIn('Synchronised 10 users', output)
+        self.assertEqual(self.idp.counts['users'], 0)
+        self.assertEqual(UserModel.objects.get(username = 'user9').email, 'user9@example.com')
+
+    def test_missing_users(self):
+        self.idp.missing = {'user1', 'user5'}
+        output = self.sync()
+        self.assertIn('Synchronised 8 users, 2 missing from the portal', output)
+        self.assertIn('User "user5" does not exist in the portal.', output)
+        self.assertTrue(UserModel.objects.get(username = 'user5').is_active)
+
+    @override_settings(JASMIN_AUTH = dict(CLIENT_ID = 'tests', IMPERSONATE_CACHE_TIMEOUT = 300))
+    def test_deactivate_missing(self):
+        self.idp.missing = {'user5'}
+        user = UserModel.objects.get(username = 'user5')
+        key = user_generation_key(user.pk)
+        get_cache().set(key, 'before', None)
+        with self.captureOnCommitCallbacks(execute = True):
+            self.sync(dict(IMPERSONATE_CACHE_TIMEOUT = 300), deactivate_missing = True)
+        self.assertFalse(UserModel.objects.get(username = 'user5').is_active)
+        self.assertTrue(UserModel.objects.get(username = 'user4').is_active)
+        # Cached data for the deactivated user must be invalidated
+        self.assertNotEqual(get_cache().get(key), 'before')
+
+    def test_broken_user_is_skipped(self):
+        self.idp.broken = {'user4'}
+        output = self.sync()
+        self.assertIn('Error fetching profile for user "user4"', output)
+        self.assertIn('Synchronised 9 users, 0 missing from the portal, 1 failed.', output)
+        # The users after the broken user are still processed
+        self.assertEqual(UserModel.objects.get(username = 'user9').email, 'user9@example.com')
+        self.assertEqual(UserModel.objects.get(username = 'user4').email, '')
+
+    def test_broken_user_in_bulk_falls_back_to_single_profiles(self):
+        self.idp.broken = {'user4'}
+        output = self.sync(dict(SYNC_BULK_PROFILE_URL = self.idp.base_url + '/bulk'))
+        self.assertIn('Synchronised 9 users, 0 missing from the portal, 1 failed.', output)
+        self.assertEqual(UserModel.objects.get(username = 'user5').email, 'user5@example.com')
+
+    def test_portal_unavailable(self):
+        # Resume after the first chunk, and make the portal unavailable
+        first_chunk = UserModel.objects.order_by('pk')[3].pk
+        with open(self.state_file, 'w') as fh:
+            fh.write(str(first_chunk))
+        self.idp.unavailable = True
+        with self.assertRaises(CommandError):
+            self.sync()
+        # The state is left so that the next run resumes from the same place
+        with open(self.state_file) as fh:
+            self.assertEqual(int(fh.read()), first_chunk)
+        self.idp.unavailable = False
+        self.sync()
+        users = UserModel.objects.order_by('pk')
+        self.assertEqual([user.email for user in users[:4]], [''] * 4)
+        self.assertTrue(all(user.email for user in users[4:]))
+
+    def test_dry_run(self):
+        self.sync()
+        UserModel.objects.filter(username = 'user2').update(email = 'old@example.com')
+        self.idp.missing = {'user7'}
+        output = self.sync(dry_run = True, deactivate_missing = True)
+        self.assertIn(
+            'Would update user "user2": email \'old@example.com\' -> \'user2@example.com\'',
+            output
+        )
+        self.assertIn('Would deactivate user "user7".', output)
+        self.assertIn('Found 9 users, 1 of which would change, 1 missing from the portal', output)
+        self.assertEqual(UserModel.objects.get(username = 'user2').email, 'old@example.com')
+        self.assertTrue(UserModel.objects.get(username = 'user7').is_active)
@@ -0,0 +1,188 @@
+import socket
+import time
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from asgiref.sync import async_to_sync
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.test import TestCase, override_settings
+
+from jasmin_auth.resilience import get_guard
+
+from .stub_idp import StubIdentityProvider
+
+
+UserModel = get_user_model()
+
+
+def closed_port_url():
+    """
+    Returns the URL of a local port that nothing is listening on.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'http://{}:{}'.format(*sock.getsockname())
+
+
+class LoginTestCase(TestCase):
+    """
+    Tests for the login and callback views against the stub identity provider.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.idp = StubIdentityProvider().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.idp.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.idp.reset()
+        self.settings = self.idp.settings()
+
+    def get(self, path, data = None):
+        return self.client.get(path, data)
+
+    def start_login(self, next_url = None, **settings):
+        """
+        Starts a login and returns the state from the redirect to the provider.
+        """
+        with override_settings(JASMIN_AUTH = dict(self.settings, **settings)):
+            response = self.get('/auth/login/', dict(next = next_url) if next_url else {})
+        self.assertTrue(response.url.startswith(self.idp.base_url + '/authorize'))
+        return parse_qs(urlparse(response.url).query)['state'][0]
+
+    def callback(self, code, state, **settings):
+        with override_settings(JASMIN_AUTH = dict(self.settings, **settings)):
+            return self.get('/auth/callback/', dict(code = code, state = state))
+
+    def test_login(self):
+        state = self.start_login('/plain/')
+        response = self.callback('jbloggs', state)
+        self.assertRedirects(response, '/plain/', fetch_redirect_response = False)
+        self.assertEqual(self.get('/whoami/').json()['user'], 'jbloggs')
+        self.assertEqual(UserModel.objects.get().email, 'jbloggs@example.com')
+
+    def test_state_mismatch(self):
+        self.start_login()
+        response = self.callback('jbloggs', 'other')
+        self.assertEqual(response.context['error'], 'mismatching_state')
+        self.assertFalse(UserModel.objects.exists())
+
+    def test_token_error(self):
+        state = self.start_login()
+        response = self.callback('bad', state)
+        self.assertEqual(response.context['error'], 'invalid_grant')
+
+    def test_provider_rejected(self):
+        state = self.start_login()
+        with override_settings(JASMIN_AUTH = dict(self.settings, CIRCUIT_BREAKER_ENABLED = True)):
+            get_guard().breaker.open()
+            response = self.get('/auth/callback/', dict(code = 'jbloggs', state = state))
+        self.assertEqual(response.context['error'], 'provider_unavailable')
+        self.assertEqual(self.idp.counts['token'], 0)
+
+    def test_token_endpoint_unreachable(self):
+        state = self.start_login()
+        response = self.callback(
+            'jbloggs',
+            state,
+            ACCESS_TOKEN_URL = closed_port_url() + '/token',
+            HTTP_MAX_RETRIES = 0
+        )
+        self.assertEqual(response.context['error'], 'provider_unavailable')
+        self.assertFalse(UserModel.objects.exists())
+
+    def test_profile_endpoint_unreachable(self):
+        state = self.start_login()
+        response = self.callback(
+            'jbloggs',
+            state,
+            PROFILE_URL = closed_port_url() + '/profile',
+            HTTP_MAX_RETRIES = 0
+        )
+        self.assertEqual(response.context['error'], 'provider_unavailable')
+        self.assertFalse(UserModel.objects.exists())
+
+    def test_profile_error(self):
+        self.idp.broken.add('jbloggs')
+        state = self.start_login()
+        response = self.callback('jbloggs', state, HTTP_MAX_RETRIES = 0)
+        self.assertEqual(response.context['error'], 'provider_unavailable')
+        self.assertFalse(UserModel.objects.exists())
+
+
+class StatelessLoginTestCase(LoginTestCase):
+    """
+    Tests for the login and callback views with the state in a signed cookie.
+    """
+    def setUp(self):
+        super().setUp()
+        self.settings = self.idp.settings(STATELESS_STATE = True)
+
+    def test_login_does_not_create_session(self):
+        self.start_login('/plain/')
+        self.assertFalse(Session.objects.exists())
+        self.assertIn('jasmin_auth_state', self.client.cookies)
+
+    def test_login(self):
+        super().test_login()
+        # The nonce cookie is deleted once it has been used
+        self.assertEqual(self.client.cookies['jasmin_auth_state'].value, '')
+
+    def test_tampered_state(self):
+        state = self.start_login('/plain/')
+        response = self.callback('jbloggs', state[:-1] + ('A' if state[-1] != 'A' else 'B'))
+        self.assertEqual(response.context['error'], 'mismatching_state')
+        self.assertFalse(UserModel.objects.exists())
+
+    def test_missing_cookie(self):
+        state = self.start_login()
+        del self.client.cookies['jasmin_auth_state']
+        response = self.callback('jbloggs', state)
+        self.assertEqual(response.context['error'], 'mismatching_state')
+
+    def test_state_from_another_browser(self):
+        state = self.start_login()
+        # Start a second login, which replaces the nonce cookie
+        self.start_login()
+        response = self.callback('jbloggs', state)
+        self.assertEqual(response.context['error'], 'mismatching_state')
+
+    def test_expired_state(self):
+        state = self.start_login()
+        later = time.time() + 601
+        with mock.patch('django.core.signing.time.time', return_value = later):
+            response = self.callback('jbloggs', state)
+        self.assertEqual(response.context['error'], 'mismatching_state')
+
+
+class AsyncViewsMixin:
+    """
+    Mixin that runs the login tests against the async views using the async test client.
+    """
+    def setUp(self):
+        super().setUp()
+        # Share the cookies, so that the tests can look at them using self.client
+        self.async_client.cookies = self.client.cookies
+
+    def get(self, path, data = None):
+        return async_to_sync(self.async_client.get)(path, data)
+
+
+@override_settings(ROOT_URLCONF = 'tests.async_urls')
+class AsyncLoginTestCase(AsyncViewsMixin, LoginTestCase):
+    """
+    Tests for the async login and callback views against the stub identity provider.
+    """
+
+
+@override_settings(ROOT_URLCONF = 'tests.async_urls')
+class AsyncStatelessLoginTestCase(AsyncViewsMixin, StatelessLoginTestCase):
+    """
+    Tests for the async login and callback views with the state in a signed cookie.
+    """
@@ -0,0 +1,73 @@
+"""
+URLconf for the tests.
+"""
+
+from django.contrib import admin
+from django.contrib.auth import get_user_model, login
+from django.http import HttpResponse, JsonResponse
+from django.urls import include, path
+
+from jasmin_auth.decorators import cache_page_per_identity
+
+
+def whoami(request):
+    """
+    Returns the usernames of the effective user and the impersonator.
+    """
+    return JsonResponse(dict(
+        user = request.user.username,
+        impersonator = request.impersonator.username if request.impersonator else None
+    ))
+
+
+def plain(request):
+    """
+    A view that does not look at the user.
+    """
+    return HttpResponse('ok')
+
+
+def login_as(request, username):
+    """
+    Logs in the given user, which cycles or flushes the session.
+    """
+    user = get_user_model().objects.get(username = username)
+    login(request, user, 'django.contrib.auth.backends.ModelBackend')
+    return HttpResponse('ok')
+
+
+def cycle_session(request):
+    """
+    Changes the session key, as Django does when the password of the user changes.
+    """
+    request.session.cycle_key()
+    return HttpResponse('ok')
+
+
+def not_found(request, exception):
+    """
+    Handler for 404 responses that looks at the user, as many site templates do.
+    """
+    return HttpResponse(request.user.username, status = 404)
+
+
+@cache_page_per_identity(60)
+def cached_whoami(request):
+    """
+    Version of :py:func:`whoami` that is cached per identity.
+    """
+    return whoami(request)
+
+
+handler404 = not_found
+
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('auth/', include('jasmin_auth.urls')),
+    path('whoami/', whoami),
+    path('plain/', plain),
+    path('cached/', cached_whoami),
+    path('login-as/<username>/', login_as),
+    path('cycle-session/', cycle_session),
+]